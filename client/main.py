@@ -5,23 +5,60 @@ import os
 import json
 import threading
 import modules.logger as logger
-from modules.socket_utils import Socket, ClientSocket
-from modules.command_utils import Command, ClientCommand
+from modules.socket_utils import Socket, ClientSocket, TRANSFER_PLAIN, TRANSFER_RESUME, TRANSFER_DELTA, STREAMS_MAX, PROTOCOL_FRAMED
+from modules.command_utils import CommandRegistry, ClientCommand, join_command
+from modules.compression_utils import COMPRESSION_NONE, COMPRESSION_AUTO, available_codecs
+from modules.relay_utils import RelayNode, RELAY_TIMEOUT
+from modules.cache_utils import ContentCache
+from modules.session_utils import reconnect
 
 
+SERVER_HOST = ""
+SERVER_PORT = 1234
+
 client = ClientSocket()
+client.cache = ContentCache()
+client.on_received = lambda _, dest_path, stats: logger.log(f"Received file:  {dest_path} ({stats})")
+stopping = threading.Event()
+server_close_order = False
+
+
+def open_connection() -> bool:
+	while reconnect(client, SERVER_HOST, SERVER_PORT, stopping):
+		try:
+			logger.log_embed(f"Connected as {client.sock.getsockname()},",
+							 f" to {client.sock.getpeername()}",
+							 before=[], after=["", ""])
+			logger.log(client.receive_msg(), "")
+			logger.log(f"Using protocol {client.negotiate()}.", "")
+			if client.protocol >= PROTOCOL_FRAMED:
+				resumed = client.open_session()
+				if client.session is not None:
+					logger.log(f"Session {'resumed' if resumed else 'opened'} as #{client.id}.", "")
+			return True
+		except (OSError, RuntimeError) as e:
+			logger.log_exception(e, "Handshake failed.", print_stack_trace=False, before=[])
+	return False
+
+
 try:
-	client.connect("", 1234)
-except ConnectionRefusedError:
-	logger.log("Connection refused.", "Aborting.", flag=logger.FLAG_ERROR)
+	if not open_connection():
+		sys.exit(1)
+except KeyboardInterrupt:
+	logger.log("Aborting.", flag=logger.FLAG_ERROR)
 	sys.exit(1)
-server_close_order = False
 
-logger.log_embed(f"Connected as {client.sock.getsockname()},",
-				 f" to {client.sock.getpeername()}",
-				 before=[], after=["", ""])
 
-logger.log(client.receive_msg(), "")
+relay_nodes: dict[str, RelayNode] = {}
+
+
+def cancel_relay(token: str) -> bool:
+	node = relay_nodes.pop(token, None)
+	if node is None:
+		return False
+	node.close()
+	logger.log(f"Relay {token} cancelled.")
+	return True
 
 
 config = {
@@ -63,10 +100,10 @@ class SendCommand(ClientCommand):
 		if len(args) == 0:
 			logger.log("Error: Parameter '<command...>' is missing.", flag=logger.FLAG_ERROR)
 			return False
-		command = "".join(args)
-		logger.log(f"Sending:  {command}", flag=logger.FLAG_COMMAND)
+		cmd = join_command(args)
 		try:
-			self.client.send_cmd(command)
+			logger.log(f"Sending:  {cmd}", flag=logger.FLAG_COMMAND)
+			self.client.send_cmd(cmd)
 		except Exception as e:
 			logger.log_exception(e, before=[], after=[])
 			return False
@@ -78,6 +115,33 @@ class FileTransferCommand(ClientCommand):
 		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
 			self.log_usage()
 			return True
+		compression = COMPRESSION_NONE
+		for i in range(len(args) - 1):
+			if args[i].lower() == "-z":
+				compression = args[i + 1].lower()
+				del args[i:i + 2]
+				break
+		if compression not in (COMPRESSION_NONE, COMPRESSION_AUTO, *available_codecs()):
+			logger.log(f"Error: Unknown compression '{compression}'.", flag=logger.FLAG_ERROR)
+			return False
+		streams = 1
+		for i in range(len(args) - 1):
+			if args[i].lower() == "-p":
+				try:
+					streams = int(args[i + 1])
+				except ValueError:
+					logger.log("Error: Parameter '<streams>' is incorrect.", flag=logger.FLAG_ERROR)
+					return False
+				del args[i:i + 2]
+				break
+		mode = TRANSFER_PLAIN
+		for flag, flag_mode in (("-r", TRANSFER_RESUME), ("-d", TRANSFER_DELTA)):
+			if flag in args:
+				if mode != TRANSFER_PLAIN:
+					logger.log("Error: Options '-r' and '-d' cannot be combined.", flag=logger.FLAG_ERROR)
+					return False
+				args.remove(flag)
+				mode = flag_mode
 		if len(args) == 0:
 			logger.log("Error: Parameter '<src_path>' is missing.", flag=logger.FLAG_ERROR)
 			return False
@@ -89,12 +153,16 @@ class FileTransferCommand(ClientCommand):
 		logger.log(f"Sending file:",
 			 f"  from {self.client.sock.getsockname()}:  {src_path}",
 			 f"  to {self.client.sock.getpeername()}:  {dst_path}", flag=logger.FLAG_COMMAND)
-		try:
-			client.send_cmd("filereceive")
-			client.send_file(src_path, dst_path)
-		except Exception as e:
-			logger.log_exception(e, before=[], after=[])
-			return False
+
+		def send():
+			try:
+				stats = self.client.send_file(src_path, dst_path, compression=compression, mode=mode, streams=streams,
+					announce="filereceive")
+				logger.log(f"Sent file:  {dst_path} ({stats})")
+			except Exception as e:
+				logger.log_exception(e, before=[], after=[])
+
+		threading.Thread(target=send).start()
 		return True
 
 
@@ -105,7 +173,7 @@ class FileReceiveCommand(ClientCommand):
 			return True
 		try:
 			result = self.client.receive_file()
-			logger.log(f"Received file:  {result[0]} ({result[1]} bytes)")
+			logger.log(f"Received file:  {result[0]} ({result[2]})")
 		except Exception as e:
 			logger.log_exception(e, before=[], after=[])
 			return False
@@ -115,6 +183,87 @@ class FileReceiveCommand(ClientCommand):
 		return True
 
 
+class RelayPrepareCommand(ClientCommand):
+	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
+		if len(args) == 0:
+			logger.log("Error: Parameter '<token>' is missing.", flag=logger.FLAG_ERROR)
+			return False
+		try:
+			node = RelayNode(args[0])
+			relay_nodes[args[0]] = node
+			self.client.send_reply(args[0], port=node.port)
+		except Exception as e:
+			logger.log_exception(e, before=[], after=[])
+			return False
+		expiry = threading.Timer(2 * RELAY_TIMEOUT, cancel_relay, args=(args[0],))
+		expiry.daemon = True
+		expiry.start()
+		return True
+
+
+class RelayCancelCommand(ClientCommand):
+	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
+		if len(args) == 0:
+			logger.log("Error: Parameter '<token>' is missing.", flag=logger.FLAG_ERROR)
+			return False
+		return cancel_relay(args[0])
+
+
+class RelayStartCommand(ClientCommand):
+	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
+		if len(args) == 0:
+			logger.log("Error: Parameter '<token>' is missing.", flag=logger.FLAG_ERROR)
+			return False
+		if len(args) == 1:
+			logger.log("Error: Parameter '<meta>' is missing.", flag=logger.FLAG_ERROR)
+			return False
+		token = args[0]
+		try:
+			meta = json.loads(args[1])
+			node = relay_nodes.pop(token)
+		except Exception as e:
+			logger.log_exception(e, before=[], after=[])
+			return False
+		logger.log(f"Relaying file {token}:  {meta['dest_path']} ({meta['length']} bytes, {len(meta['children'])} children)")
+
+		def report(received: int, state: str):
+			try:
+				self.client.send_cmd(f"relayprogress {token} {received} {state}")
+			except Exception as e:
+				logger.log_exception(e, before=[], after=[])
+
+		node.start(meta["dest_path"], meta["length"], meta["digest"], meta["children"], report)
+		return True
+
+
+class CacheCommand(ClientCommand):
+	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
+		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
+			self.log_usage()
+			return True
+		if len(args) > 0 and args[0] == "clear":
+			self.client.cache.clear()
+			logger.log("File cache cleared.")
+			return True
+		if len(args) > 0 and args[0] != "stats":
+			logger.log(f"Error: Unknown action '{args[0]}'.", flag=logger.FLAG_ERROR)
+			return False
+		stats = self.client.cache.stats()
+		if len(args) > 1:
+			try:
+				self.client.send_reply(args[1], **stats)
+			except Exception as e:
+				logger.log_exception(e, before=[], after=[])
+				return False
+			return True
+		logger.log(f"File cache ({self.client.cache.root}):",
+			f"  > Entries: {stats['entries']}",
+			f"  > Size: {stats['size']} / {stats['max_size']} bytes",
+			f"  > Hits: {stats['hits']}, misses: {stats['misses']} ({stats['hit_rate']:.1%})",
+			f"  > Saved: {stats['saved_bytes']} bytes")
+		return True
+
+
 class ConfigCommand(ClientCommand):
 	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
 		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
@@ -161,103 +310,100 @@ class LaunchCommand(ClientCommand):
 		return True
 
 
-class SendCommand(ClientCommand):
-	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
-		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
-			self.log_usage()
-			return True
-		if len(args) == 0:
-			logger.log("Error: Parameter '<command...>' is missing.", flag=logger.FLAG_ERROR)
-			return False
-		cmd = ""
-		for arg in args:
-			cmd += "'" + arg.replace("'", "\'") + "'"
-		try:
-			logger.log(f"Sending:  {cmd}", flag=logger.FLAG_COMMAND)
-			self.client.send_cmd(cmd)
-		except Exception as e:
-			logger.log_exception(e, before=[], after=[])
-			return False
-		return True
-
-
-commands: list[Command] = [
+commands = CommandRegistry([
 	HelpCommand(client, "help", "?",
 		description="Display all available commands", syntax="help"),
 	InfoCommand(client, "info", "infos",
 		description="Display information about the client",
 		syntax="info"),
-	SendCommand(client, "send",
+	SendCommand(client, "send", "s",
 		description="Send command to server",
 		syntax="send <command...>"),
 	FileTransferCommand(client, "filesend", "fs",
 		description="Transfer file to server",
-		syntax="filesend <src_path> <dst_path>"),
+		syntax=[
+			"filesend <src_path> <dst_path> [-z <compression>] [-r | -d] [-p <streams>]",
+			"-r: resume a broken transfer, -d: only send blocks that changed",
+			f"-p: number of parallel data connections (default: 1, max {STREAMS_MAX})",
+			f"Compression can be: {COMPRESSION_NONE}, {COMPRESSION_AUTO}, {', '.join(available_codecs())}",
+			f"Default compression: '{COMPRESSION_NONE}'"
+		]),
 	FileReceiveCommand(client, "filereceive", "fr",
 		description="Waiting for file from server",
 		syntax="filereceive"),
+	RelayPrepareCommand(client, "relayprepare",
+		description="Open a relay listener for a file broadcast (sent by the server)",
+		syntax="relayprepare <token>"),
+	RelayStartCommand(client, "relaystart",
+		description="Receive and forward a file broadcast (sent by the server)",
+		syntax="relaystart <token> <meta>"),
+	RelayCancelCommand(client, "relaycancel",
+		description="Close a relay listener that will not be used (sent by the server)",
+		syntax="relaycancel <token>"),
+	CacheCommand(client, "cache",
+		description="Show or clear the received files cache",
+		syntax=["cache [stats]", "cache clear"]),
 	ConfigCommand(client, "config", "c",
 		description="Set config value",
 		syntax=["config all","config list", "config <key> [<value>]"]),
 	LaunchCommand(client, "launch", "l",
 		description="Launch stable-diffusion",
 		syntax="launch"),
-	SendCommand(client, "send", "s",
-		description="Send command to server",
-		syntax="send <command...>"),
-]
+])
+client.on_call = commands.answer
 
 
 def receive_thread_func():
 	global server_close_order
 
-	try:
-		while not client.is_closed():
+	while not stopping.is_set():
+		try:
+			while not client.is_closed():
+
+				cmd = client.receive_cmd()
+				if not cmd or cmd == "end":
+					break
+				logger.log(f"Received:  {cmd}", flag=logger.FLAG_COMMAND)
+				if cmd == "quit":
+					server_close_order = True
+					stopping.set()
+					client.close()
+					logger.log_embed("Server order. Closing client...",
+						"Press enter to close...", flag=logger.FLAG_ERROR)
+					break
+				elif cmd == "reconnect":
+					client.sock.close()
+					break
+				else:
+					if commands.dispatch(client, cmd) is None:
+						logger.log(f"Command not found:  {cmd}", flag=logger.FLAG_ERROR)
 
-			cmd = client.receive_cmd()
-			if not cmd or cmd == "end":
-				break
-			logger.log(f"Received:  {cmd}", flag=logger.FLAG_COMMAND)
-			if cmd == "quit":
-				server_close_order = True
-				client.close()
-				logger.log_embed("Server order. Closing client...",
-					"Press enter to close...", flag=logger.FLAG_ERROR)
-				break
-			else:
-				command_found = False
-				for command in commands:
-					result = command.handle(client, cmd)
-					if result is not None:
-						command_found = True
-						break
-				if not command_found:
-					logger.log(f"Command not found:  {cmd}", flag=logger.FLAG_ERROR)
+		except Exception as e:
+			if not stopping.is_set():
+				logger.log_exception(e, print_stack_trace=False)
 
-	except Exception as e:
-		logger.log_exception(e)
+		if stopping.is_set():
+			break
+		logger.log("Connection lost. Reconnecting...", flag=logger.FLAG_ERROR)
+		if not open_connection():
+			break
 
 
 def input_thread_func():
-	while not client.is_closed():
+	while not stopping.is_set():
 		try:
 
 			cmd = input()
-			if client.is_closed():
+			if stopping.is_set():
 				break
 			if not cmd:
 				continue
 			if cmd == "quit":
+				stopping.set()
 				client.close()
 				break
 			else:
-				command_found = False
-				for command in commands:
-					result = command.handle(client, cmd)
-					if result is not None:
-						command_found = True
-						break
-				if not command_found:
+				if commands.dispatch(client, cmd) is None:
 					logger.log(f"Command not found:  {cmd}", flag=logger.FLAG_ERROR)
 
 		except Exception as e:
@@ -276,6 +422,7 @@ try:
 	input_thread.join()
 
 except KeyboardInterrupt:
+	stopping.set()
 	logger.log_embed("Keyboard interrupt. Closing client...",
 		"Press enter to close...", flag=logger.FLAG_ERROR)
 
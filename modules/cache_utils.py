@@ -0,0 +1,176 @@
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from modules.delta_utils import file_digest
+
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "qg-autopilot", "objects")
+CACHE_MAX_SIZE = 2 * 1024 ** 3
+CACHE_OFFER_MIN = 65536
+
+_PREFIX = re.compile(r"[0-9a-f]{2}")
+_DIGEST = re.compile(r"[0-9a-f]{128}")
+_PLACING = re.compile(r"([0-9a-f]{128})\.\d+\.\d+\.tmp")
+
+_digests: dict[str, tuple[int, int, str]] = {}
+_digests_lock = threading.Lock()
+
+
+def cached_digest(path: str) -> str:
+	stat = os.stat(path)
+	with _digests_lock:
+		known = _digests.get(path)
+	if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+		return known[2]
+	digest = file_digest(path)
+	with _digests_lock:
+		_digests[path] = (stat.st_size, stat.st_mtime_ns, digest)
+	return digest
+
+
+def _place(src_path: str, dest_path: str):
+	if os.path.exists(dest_path) and os.path.samefile(src_path, dest_path):
+		return
+	tmp_path = f"{dest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+	try:
+		os.link(src_path, tmp_path)
+	except OSError:
+		shutil.copyfile(src_path, tmp_path)
+	os.replace(tmp_path, dest_path)
+
+
+class ContentCache:
+	def __init__(self, root: str = CACHE_DIR, max_size: int = CACHE_MAX_SIZE):
+		self.root = root
+		self.max_size = max_size
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.saved_bytes = 0
+		self._entries: OrderedDict[str, tuple[int, int]] = OrderedDict()
+		self._inodes: dict[tuple[int, int], str] = {}
+		self._lock = threading.Lock()
+		os.makedirs(root, exist_ok=True)
+		found = []
+		with os.scandir(root) as prefixes:
+			prefixes = [prefix for prefix in prefixes if _PREFIX.fullmatch(prefix.name) and prefix.is_dir(follow_symlinks=False)]
+		for prefix in prefixes:
+			with os.scandir(prefix.path) as files:
+				for file in files:
+					placing = _PLACING.fullmatch(file.name)
+					if placing is not None and placing.group(1).startswith(prefix.name):
+						os.remove(file.path)
+					elif _DIGEST.fullmatch(file.name) and file.name.startswith(prefix.name) and file.is_file(follow_symlinks=False):
+						stat = file.stat()
+						found.append((stat.st_atime, file.name, stat.st_size, stat.st_mtime_ns, (stat.st_dev, stat.st_ino)))
+		for _, digest, size, mtime, inode in sorted(found):
+			self._entries[digest] = (size, mtime)
+			self._inodes[inode] = digest
+			self.size += size
+		self._evict()
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	def path(self, digest: str) -> str:
+		return os.path.join(self.root, digest[:2], digest)
+
+	def fetch(self, digest: str, dest_path: str, length: int) -> bool:
+		path = self.path(digest)
+		with self._lock:
+			entry = self._entries.get(digest)
+			try:
+				stat = os.stat(path)
+			except FileNotFoundError:
+				stat = None
+			if entry is None or stat is None or entry != (stat.st_size, stat.st_mtime_ns) or entry[0] != length:
+				if entry is not None:
+					self._drop(digest)
+				self.misses += 1
+				return False
+			self._entries.move_to_end(digest)
+			self.hits += 1
+			self.saved_bytes += length
+		try:
+			_place(path, dest_path)
+		except FileNotFoundError:
+			with self._lock:
+				self.hits -= 1
+				self.misses += 1
+				self.saved_bytes -= length
+			return False
+		return True
+
+	def store(self, src_path: str, digest: str):
+		size = os.path.getsize(src_path)
+		if size > self.max_size:
+			return
+		with self._lock:
+			if digest in self._entries:
+				self._entries.move_to_end(digest)
+				return
+		path = self.path(digest)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		_place(src_path, path)
+		stat = os.stat(path)
+		with self._lock:
+			if digest not in self._entries:
+				self._entries[digest] = (size, stat.st_mtime_ns)
+				self._inodes[(stat.st_dev, stat.st_ino)] = digest
+				self.size += size
+			self._evict()
+
+	def detach(self, path: str):
+		"""
+		Unlinks `path` if it is a hard link to a cache entry, so that writing
+		to it in place cannot corrupt the cache.
+		"""
+		try:
+			stat = os.stat(path)
+		except FileNotFoundError:
+			return
+		inode = (stat.st_dev, stat.st_ino)
+		with self._lock:
+			digest = self._inodes.get(inode)
+		if digest is None:
+			return
+		try:
+			entry = os.stat(self.path(digest))
+		except FileNotFoundError:
+			return
+		if (entry.st_dev, entry.st_ino) == inode:
+			os.remove(path)
+
+	def clear(self):
+		with self._lock:
+			for digest in list(self._entries):
+				self._drop(digest)
+
+	def stats(self) -> dict:
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				"entries": len(self._entries),
+				"size": self.size,
+				"max_size": self.max_size,
+				"hits": self.hits,
+				"misses": self.misses,
+				"hit_rate": self.hits / lookups if lookups else 0.0,
+				"saved_bytes": self.saved_bytes,
+			}
+
+	def _evict(self):
+		while self.size > self.max_size and self._entries:
+			self._drop(next(iter(self._entries)))
+
+	def _drop(self, digest: str):
+		self.size -= self._entries.pop(digest, (0, 0))[0]
+		path = self.path(digest)
+		try:
+			stat = os.stat(path)
+			self._inodes.pop((stat.st_dev, stat.st_ino), None)
+			os.remove(path)
+		except FileNotFoundError:
+			pass
@@ -1,40 +1,70 @@
+import re
+import time
+from functools import lru_cache
 import modules.logger as logger
 from modules.socket_utils import Socket, ServerSocket, ClientSocket
 
 
+COMMAND_CACHE = 1024
+
+_TOKEN = re.compile(r"""
+	[ ]+
+	| '([^'\\]*(?:(?:\\+(?![\\'])|(?:\\\\)*\\')[^'\\]*)*(?:\\\\)*)'
+	| "([^"\\]*(?:(?:\\+(?![\\"])|(?:\\\\)*\\")[^"\\]*)*(?:\\\\)*)"
+	| ((?:[^ '"\\]|\\[ ]|\\(?![ ]))[^ \\]*(?:(?:\\[ ]|\\(?![ ]))[^ \\]*)*)
+""", re.VERBOSE)
+_QUOTED_ESCAPES = {quote: re.compile(rf"(\\+)({quote}|\Z)") for quote in "'\""}
+_QUOTING = re.compile(r"(\\*)('|\Z)")
+
+
 def split_command(command: str) -> list[str] | None:
-	length = len(command)
+	"""
+	Splits on spaces. A quoted argument runs to the matching quote; inside,
+	backslashes are literal except before a quote, where each pair is one
+	backslash and an odd one escapes the quote. Outside quotes a backslash
+	escapes a space. Returns None if a quote is left open.
+	"""
+	args = _split_command(command)
+	return None if args is None else list(args)
+
+
+@lru_cache(maxsize=COMMAND_CACHE)
+def _split_command(command: str) -> tuple[str, ...] | None:
+	if "'" not in command and '"' not in command and "\\" not in command:
+		return tuple(arg for arg in command.split(" ") if arg)
 	args = []
-	arg = None
-	separator = None
-	i = 0
-	while i < length:
-		if arg is None:
-			arg = ""
-			if command[i] in " '\"":
-				separator = command[i]
-			else:
-				arg += command[i]
-				separator = " "
+	position = 0
+	length = len(command)
+	while position < length:
+		match = _TOKEN.match(command, position)
+		if match is None:
+			return None
+		single, double, bare = match.groups()
+		if single is not None:
+			args.append(_unquote(single, "'"))
+		elif double is not None:
+			args.append(_unquote(double, '"'))
+		elif bare is not None:
+			args.append(bare.replace("\\ ", " "))
+		position = match.end()
+	return tuple(args)
+
+
+def _unquote(arg: str, quote: str) -> str:
+	return _QUOTED_ESCAPES[quote].sub(lambda match: "\\" * (len(match[1]) // 2) + match[2], arg)
+
+
+def join_command(args: list[str]) -> str:
+	"""
+	Inverse of `split_command`.
+	"""
+	quoted = []
+	for arg in args:
+		if arg and not any(c in arg for c in " '\"") and not arg.endswith("\\"):
+			quoted.append(arg)
 		else:
-			if command[i] == "\\" and len(command) >= i and command[i + 1] == separator:
-				arg += separator
-				i += 1
-			elif command[i] == separator:
-				if args != "" or separator != " ":
-					args.append(arg)
-				arg = None
-			else:
-				arg += command[i]
-		i += 1
-	if arg is None:
-		pass
-	elif separator == " ":
-		if args != "":
-			args.append(arg)
-	else:
-		return None
-	return args
+			quoted.append("'" + _QUOTING.sub(lambda match: match[1] * 2 + ("\\'" if match[2] else ""), arg) + "'")
+	return " ".join(quoted)
 
 
 def parse_addr(address: str) -> tuple[str, int]:
@@ -69,21 +99,14 @@ class Command:
 			f"Usage: {usage}"
 		)
 	
+	def matches(self, label: str) -> bool:
+		if self.case_sensitive:
+			return label in self.aliases
+		return label.casefold() in (alias.casefold() for alias in self.aliases)
+
 	def handle(self, sender: Socket | None, command: str) -> bool | None:
 		splitted = split_command(command)
-		if splitted is None or len(splitted) == 0:
-			return None
-		found = False
-		for alias in self.aliases:
-			if self.case_sensitive:
-				if splitted[0] == alias:
-					found = True
-					break
-			else:
-				if splitted[0].lower() == alias.lower():
-					found = True
-					break
-		if not found:
+		if splitted is None or len(splitted) == 0 or not self.matches(splitted[0]):
 			return None
 		return self.execute(sender, splitted[0], list(splitted[1:]))
 	
@@ -105,3 +128,56 @@ class ClientCommand(Command):
 		super().__init__(name, *aliases, case_sensitive=case_sensitive,
 			description=description, syntax=syntax)
 		self.client = client
+
+
+class CommandRegistry:
+	def __init__(self, commands: list[Command] = ()):
+		self._commands: list[Command] = []
+		self._by_alias: dict[str, Command] = {}
+		for command in commands:
+			self.register(command)
+
+	def __len__(self) -> int:
+		return len(self._commands)
+
+	def __iter__(self):
+		return iter(self._commands)
+
+	def register(self, command: Command):
+		keys = {alias.casefold(): alias for alias in command.aliases}
+		for key, alias in keys.items():
+			other = self._by_alias.get(key)
+			if other is not None:
+				raise ValueError(f"Alias '{alias}' of command '{command.aliases[0]}' is already registered by '{other.aliases[0]}'.")
+		for key in keys:
+			self._by_alias[key] = command
+		self._commands.append(command)
+
+	def get(self, label: str) -> Command | None:
+		command = self._by_alias.get(label.casefold())
+		if command is None or (command.case_sensitive and label not in command.aliases):
+			return None
+		return command
+
+	def dispatch(self, sender: Socket | None, line: str) -> bool | None:
+		splitted = split_command(line)
+		if not splitted:
+			return None
+		command = self.get(splitted[0])
+		if command is None:
+			return None
+		return command.execute(sender, splitted[0], splitted[1:])
+
+	def answer(self, sender: Socket, token: str, line: str):
+		started = time.perf_counter()
+		error = None
+		try:
+			result = self.dispatch(sender, line)
+		except Exception as e:
+			logger.log_exception(e, before=[], after=[])
+			result = False
+			error = f"{type(e).__name__}: {e}"
+		if not isinstance(result, (bool, int, float, str, list, dict, type(None))):
+			result = str(result)
+		sender.post_reply(token, found=error is not None or result is not None, result=result, error=error,
+			elapsed=time.perf_counter() - started)
@@ -0,0 +1,132 @@
+import os
+import lzma
+import zlib
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+
+COMPRESSION_NONE = "none"
+COMPRESSION_AUTO = "auto"
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_LZMA = "lzma"
+COMPRESSION_ZSTD = "zstd"
+
+SAMPLE_SIZE = 262144
+SAMPLE_MIN = 4096
+SKIP_RATIO = 0.9
+
+INCOMPRESSIBLE_EXTENSIONS = {
+	".mp4", ".mov", ".mkv", ".avi", ".webm", ".m4v",
+	".jpg", ".jpeg", ".png", ".gif", ".webp",
+	".mp3", ".aac", ".ogg", ".flac",
+	".zip", ".gz", ".tgz", ".xz", ".bz2", ".zst", ".7z", ".rar",
+}
+
+
+class _Passthrough:
+	def compress(self, data: bytes) -> bytes:
+		return data
+
+	def decompress(self, data: bytes) -> bytes:
+		return data
+
+	def flush(self) -> bytes:
+		return b""
+
+
+class _ZstdCompressor:
+	def __init__(self, level: int):
+		self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+	def compress(self, data: bytes) -> bytes:
+		return self._compressor.compress(data)
+
+	def flush(self) -> bytes:
+		return self._compressor.flush()
+
+
+class _ZstdDecompressor:
+	def __init__(self):
+		self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+	def decompress(self, data: bytes) -> bytes:
+		return self._decompressor.decompress(data)
+
+	def flush(self) -> bytes:
+		return b""
+
+
+class _ZlibDecompressor:
+	def __init__(self):
+		self._decompressor = zlib.decompressobj()
+
+	def decompress(self, data: bytes) -> bytes:
+		return self._decompressor.decompress(data)
+
+	def flush(self) -> bytes:
+		return self._decompressor.flush()
+
+
+class _LzmaDecompressor:
+	def __init__(self):
+		self._decompressor = lzma.LZMADecompressor()
+
+	def decompress(self, data: bytes) -> bytes:
+		return self._decompressor.decompress(data)
+
+	def flush(self) -> bytes:
+		return b""
+
+
+def available_codecs() -> list[str]:
+	codecs = [COMPRESSION_ZLIB, COMPRESSION_LZMA]
+	if zstandard is not None:
+		codecs.append(COMPRESSION_ZSTD)
+	return codecs
+
+
+def make_compressor(codec: str, level: int | None = None):
+	if codec == COMPRESSION_ZLIB:
+		return zlib.compressobj(1 if level is None else level)
+	if codec == COMPRESSION_LZMA:
+		return lzma.LZMACompressor(preset=1 if level is None else level)
+	if codec == COMPRESSION_ZSTD and zstandard is not None:
+		return _ZstdCompressor(3 if level is None else level)
+	if codec == COMPRESSION_NONE:
+		return _Passthrough()
+	raise ValueError(f"Unknown compression codec '{codec}'.")
+
+
+def make_decompressor(codec: str):
+	if codec == COMPRESSION_ZLIB:
+		return _ZlibDecompressor()
+	if codec == COMPRESSION_LZMA:
+		return _LzmaDecompressor()
+	if codec == COMPRESSION_ZSTD and zstandard is not None:
+		return _ZstdDecompressor()
+	if codec == COMPRESSION_NONE:
+		return _Passthrough()
+	raise ValueError(f"Unknown compression codec '{codec}'.")
+
+
+def choose_codec(file, file_path: str, requested: str | None) -> str:
+	if requested is None or requested == COMPRESSION_NONE:
+		return COMPRESSION_NONE
+	codec = requested
+	if requested == COMPRESSION_AUTO:
+		codec = COMPRESSION_ZSTD if zstandard is not None else COMPRESSION_ZLIB
+		if os.path.splitext(file_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+			return COMPRESSION_NONE
+	elif codec not in available_codecs():
+		raise ValueError(f"Unknown compression codec '{codec}'.")
+	position = file.tell()
+	sample = file.read(SAMPLE_SIZE)
+	file.seek(position)
+	if len(sample) < SAMPLE_MIN:
+		return COMPRESSION_NONE
+	if len(zlib.compress(sample, 1)) > len(sample) * SKIP_RATIO:
+		return COMPRESSION_NONE
+	return codec
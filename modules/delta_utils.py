@@ -0,0 +1,176 @@
+import os
+import math
+import zlib
+import hashlib
+
+
+RESUME_BLOCK = 1048576
+DELTA_BLOCK_MIN = 2048
+DELTA_BLOCK_MAX = 1048576
+DELTA_READ = 8388608
+DELTA_LITERAL_MAX = 1048576
+DELTA_SKIP_MAX = 64
+
+_ADLER_MOD = 65521
+
+
+def strong_hash(data: bytes | bytearray | memoryview) -> str:
+	return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_digest(path: str, length: int | None = None, offset: int = 0, buffer_size: int = DELTA_READ) -> str:
+	digest = hashlib.blake2b()
+	buffer = bytearray(buffer_size)
+	with open(path, "rb") as file, memoryview(buffer) as view:
+		file.seek(offset)
+		remaining = os.fstat(file.fileno()).st_size - offset if length is None else length
+		while remaining > 0:
+			size = file.readinto(view[:min(remaining, buffer_size)])
+			if not size:
+				break
+			digest.update(view[:size])
+			remaining -= size
+	return digest.hexdigest()
+
+
+def delta_block_size(length: int) -> int:
+	return max(DELTA_BLOCK_MIN, min(DELTA_BLOCK_MAX, math.isqrt(length)))
+
+
+def block_hashes(path: str, block_size: int, length: int | None = None) -> list[str]:
+	hashes = []
+	if not os.path.exists(path):
+		return hashes
+	with open(path, "rb") as file:
+		remaining = os.fstat(file.fileno()).st_size if length is None else length
+		while remaining >= block_size:
+			block = file.read(block_size)
+			if len(block) < block_size:
+				break
+			hashes.append(strong_hash(block))
+			remaining -= block_size
+	return hashes
+
+
+def block_signatures(path: str, block_size: int) -> list[tuple[int, str]]:
+	signatures = []
+	if not os.path.exists(path):
+		return signatures
+	with open(path, "rb") as file:
+		while True:
+			block = file.read(block_size)
+			if len(block) < block_size:
+				break
+			signatures.append((zlib.adler32(block), strong_hash(block)))
+	return signatures
+
+
+class DeltaEncoder:
+	def __init__(self, file, block_size: int, signatures: list[tuple[int, str]] | list[list]):
+		self.file = file
+		self.block_size = block_size
+		self.digest = hashlib.blake2b()
+		self.matched_blocks = 0
+		self._index: dict[int, dict[str, int]] = {}
+		for i, (weak, strong) in enumerate(signatures):
+			self._index.setdefault(weak, {}).setdefault(strong, i)
+
+	def ops(self):
+		run = None
+		for op in self._raw_ops():
+			if isinstance(op, int):
+				if run is not None and run[0] + run[1] == op:
+					run[1] += 1
+					continue
+				if run is not None:
+					yield tuple(run)
+				run = [op, 1]
+			else:
+				if run is not None:
+					yield tuple(run)
+					run = None
+				yield op
+		if run is not None:
+			yield tuple(run)
+
+	def _raw_ops(self):
+		"""
+		Rolls byte by byte after a mismatch. Once a whole block was rolled over
+		without a match, steps block by block instead, rolling again after 1,
+		2, 4... up to `DELTA_SKIP_MAX` blocks.
+		"""
+		block_size = self.block_size
+		data = bytearray()
+		pos = 0
+		literal_start = 0
+		eof = False
+		weak = None
+		a = b = 0
+		rolled = 0
+		steps = 0
+		skip = 1
+		while True:
+			if len(data) - pos < block_size and not eof:
+				if pos > literal_start:
+					yield bytes(data[literal_start:pos])
+				del data[:pos]
+				pos = literal_start = 0
+				chunk = self.file.read(DELTA_READ)
+				if chunk:
+					self.digest.update(chunk)
+					data += chunk
+				else:
+					eof = True
+				weak = None
+				continue
+			if len(data) - pos < block_size or not self._index:
+				break
+			if weak is None:
+				weak = zlib.adler32(data[pos:pos + block_size])
+				a = weak & 0xffff
+				b = weak >> 16
+			match = None
+			candidates = self._index.get(weak)
+			if candidates is not None:
+				match = candidates.get(strong_hash(data[pos:pos + block_size]))
+			if match is not None:
+				if pos > literal_start:
+					yield bytes(data[literal_start:pos])
+				self.matched_blocks += 1
+				yield match
+				pos += block_size
+				literal_start = pos
+				weak = None
+				rolled = steps = 0
+				skip = 1
+				continue
+			if rolled >= block_size:
+				rolled = 0
+				steps = skip
+				skip = min(skip * 2, DELTA_SKIP_MAX)
+			if steps:
+				steps -= 1
+				pos += block_size
+				weak = None
+			else:
+				if pos + block_size < len(data):
+					out_byte = data[pos]
+					a = (a - out_byte + data[pos + block_size]) % _ADLER_MOD
+					b = (b - block_size * out_byte + a - 1) % _ADLER_MOD
+					weak = (b << 16) | a
+				else:
+					weak = None
+				pos += 1
+				rolled += 1
+			if pos - literal_start >= DELTA_LITERAL_MAX:
+				yield bytes(data[literal_start:pos])
+				literal_start = pos
+		for start in range(literal_start, len(data), DELTA_LITERAL_MAX):
+			yield bytes(data[start:start + DELTA_LITERAL_MAX])
+		while not eof:
+			chunk = self.file.read(DELTA_READ)
+			if not chunk:
+				break
+			self.digest.update(chunk)
+			for start in range(0, len(chunk), DELTA_LITERAL_MAX):
+				yield chunk[start:start + DELTA_LITERAL_MAX]
@@ -0,0 +1,304 @@
+import time
+import socket
+import threading
+import selectors
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import modules.logger as logger
+from modules.socket_utils import ServerSocket, ClientSocket, HEARTBEAT_INTERVAL, HEARTBEAT_MISSES
+
+
+EVENT_WORKERS = 32
+OUTBOUND_RETRY = 0.05
+TRIM_IDLE = 1.0
+
+
+class FanoutStats:
+	def __init__(self, count: int):
+		self.count = count
+		self.dropped = 0
+		self.failed = 0
+		self.latencies: list[float] = []
+		self._started = time.perf_counter()
+		self._lock = threading.Lock()
+
+	def __str__(self) -> str:
+		return (f"{self.count} clients, {self.written} written, {self.queued} queued, {self.dropped} dropped, {self.failed} failed, "
+			f"latency p50={self.percentile(50) * 1000:.2f} ms, p99={self.percentile(99) * 1000:.2f} ms, max={self.percentile(100) * 1000:.2f} ms")
+
+	@property
+	def written(self) -> int:
+		return len(self.latencies)
+
+	@property
+	def queued(self) -> int:
+		return self.count - self.written - self.dropped - self.failed
+
+	def percentile(self, p: float) -> float:
+		with self._lock:
+			latencies = sorted(self.latencies)
+		if not latencies:
+			return 0.0
+		return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+	def done(self):
+		latency = time.perf_counter() - self._started
+		with self._lock:
+			self.latencies.append(latency)
+
+
+def fanout(clients: list[ClientSocket], cmd: str) -> FanoutStats:
+	stats = FanoutStats(len(clients))
+	for client in list(clients):
+		try:
+			if not client.post_cmd(cmd, stats.done):
+				stats.dropped += 1
+		except (OSError, ValueError):
+			stats.failed += 1
+	return stats
+
+
+class EventLoop:
+	"""
+	Serves every client of `server` from one selector thread. A readable
+	client is handed to a worker running `on_ready(client)`, and stays
+	registered while that returns True. Queued outbound data is drained when
+	writable; clients stalled past their `send_timeout`, or missing
+	`heartbeat_misses` pings, are evicted.
+	"""
+
+	def __init__(self, server: ServerSocket, on_accept, on_ready, on_close=None, workers: int = EVENT_WORKERS):
+		self.server = server
+		self.on_accept = on_accept
+		self.on_ready = on_ready
+		self.on_close = on_close
+		self.executor = ThreadPoolExecutor(workers, thread_name_prefix="worker")
+		self.evicted = 0
+		self.heartbeat_interval = HEARTBEAT_INTERVAL
+		self.heartbeat_misses = HEARTBEAT_MISSES
+		self._next_beat = time.monotonic() + HEARTBEAT_INTERVAL
+		self._selector = selectors.DefaultSelector()
+		self._calls = deque()
+		self._reading: set[ClientSocket] = set()
+		self._writing: set[ClientSocket] = set()
+		self._deferred: set[ClientSocket] = set()
+		self._events: dict[ClientSocket, tuple[int, int]] = {}
+		self._running = False
+		self._waker, self._wakeup = socket.socketpair()
+		self._waker.setblocking(False)
+		self._wakeup.setblocking(False)
+
+	def run(self):
+		self._running = True
+		self._selector.register(self.server.sock, selectors.EVENT_READ)
+		self._selector.register(self._wakeup, selectors.EVENT_READ)
+		try:
+			while self._running:
+				timeout = None
+				if self.heartbeat_interval > 0:
+					timeout = max(self._next_beat - time.monotonic(), 0)
+				if self._writing or self._deferred:
+					timeout = OUTBOUND_RETRY if timeout is None else min(timeout, OUTBOUND_RETRY)
+				for key, mask in self._selector.select(timeout):
+					if key.fileobj is self.server.sock:
+						self._accept()
+					elif key.fileobj is self._wakeup:
+						self._drain()
+					else:
+						self._ready(key.data, mask)
+				if self._writing or self._deferred:
+					self._check_backlogs()
+				if self.heartbeat_interval > 0 and time.monotonic() >= self._next_beat:
+					self._beat()
+		finally:
+			self._selector.close()
+			self.executor.shutdown(wait=False, cancel_futures=True)
+			self._waker.close()
+			self._wakeup.close()
+
+	def stop(self):
+		self._running = False
+		self._wake()
+
+	def wake(self):
+		self._next_beat = min(self._next_beat, time.monotonic() + max(self.heartbeat_interval, 0))
+		self._wake()
+
+	def submit(self, fn, *args):
+		return self.executor.submit(fn, *args)
+
+	def evict(self, client: ClientSocket, reason: str):
+		self._call_soon(self._evict, client, reason)
+
+	def _call_soon(self, fn, *args):
+		self._calls.append((fn, args))
+		self._wake()
+
+	def _accept(self):
+		try:
+			client = self.server.accept(add_to_clients=False)
+		except OSError as e:
+			if self._running and not self.server.is_closed():
+				logger.log_exception(e)
+			return
+		if self.server.is_closed():
+			client.sock.close()
+			return
+		client.on_backlog = lambda c: self._call_soon(self._backlogged, c)
+		try:
+			self.on_accept(client)
+		except Exception as e:
+			logger.log_exception(e)
+			self._close(client)
+			return
+		self._reading.add(client)
+		self._update(client)
+
+	def _ready(self, client: ClientSocket, mask: int):
+		if mask & selectors.EVENT_WRITE:
+			self._flush(client)
+		if mask & selectors.EVENT_READ and client in self._reading:
+			self._reading.discard(client)
+			self.executor.submit(self._serve, client)
+		self._update(client)
+
+	def _serve(self, client: ClientSocket):
+		idle = self._idle(client)
+		try:
+			keep = self.on_ready(client)
+		except Exception as e:
+			if self._running and not self.server.is_closed():
+				logger.log_exception(e)
+			self._call_soon(self._close, client)
+			return
+		if not keep:
+			self._call_soon(self._release, client)
+			return
+		if client.has_buffered() or client._pending:
+			self.executor.submit(self._serve, client)
+			return
+		if idle:
+			client.trim()
+		self._call_soon(self._rearm, client)
+
+	def _rearm(self, client: ClientSocket):
+		self._reading.add(client)
+		self._update(client)
+
+	def _backlogged(self, client: ClientSocket):
+		if client.evicting:
+			self._evict(client, "outbound queue full")
+			return
+		if client.outbound_bytes:
+			self._writing.add(client)
+			self._update(client)
+
+	def _flush(self, client: ClientSocket):
+		if not client._send_lock.acquire(blocking=False):
+			self._writing.discard(client)
+			self._deferred.add(client)
+			return
+		try:
+			empty = client.drain_outbound()
+		except OSError:
+			empty = True
+			self._call_soon(self._close, client)
+		finally:
+			client._send_lock.release()
+		if empty:
+			self._writing.discard(client)
+
+	def _check_backlogs(self):
+		for client in list(self._deferred):
+			self._deferred.discard(client)
+			self._writing.add(client)
+			self._update(client)
+		for client in list(self._writing):
+			if not client.outbound_bytes:
+				self._writing.discard(client)
+				self._update(client)
+			elif client.outbound_stalled() > client.send_timeout:
+				self._evict(client, f"no progress for {client.send_timeout:.0f} s")
+
+	def _beat(self):
+		self._next_beat = time.monotonic() + self.heartbeat_interval
+		for client in self.server.clients:
+			if client in self._reading:
+				missed = client.heartbeat.missed(self.heartbeat_interval, client.last_received)
+				if missed >= self.heartbeat_misses:
+					self._evict(client, f"{missed} heartbeats missed")
+					continue
+				if self._idle(client):
+					client.trim()
+			try:
+				client.ping()
+			except OSError:
+				self._close(client)
+
+	def _idle(self, client: ClientSocket) -> bool:
+		idle = TRIM_IDLE if self.heartbeat_interval <= 0 else min(TRIM_IDLE, self.heartbeat_interval / 2)
+		return time.monotonic() - client.last_received >= idle
+
+	def _evict(self, client: ClientSocket, reason: str):
+		if client.is_closed():
+			self._release(client)
+			return
+		self.evicted += 1
+		logger.log(f"Evicting client {client.address} ({reason}).", flag=logger.FLAG_ERROR)
+		self._close(client)
+
+	def _update(self, client: ClientSocket):
+		events = 0
+		if not client.is_closed():
+			if client in self._reading:
+				events |= selectors.EVENT_READ
+			if client in self._writing:
+				events |= selectors.EVENT_WRITE
+		fd, current = self._events.get(client, (-1, 0))
+		if events == current:
+			return
+		if not events:
+			self._selector.unregister(fd)
+			del self._events[client]
+			return
+		if not current:
+			fd = client.sock.fileno()
+			self._selector.register(fd, events, client)
+		else:
+			self._selector.modify(fd, events, client)
+		self._events[client] = (fd, events)
+
+	def _release(self, client: ClientSocket):
+		self._reading.discard(client)
+		self._writing.discard(client)
+		self._deferred.discard(client)
+		self._update(client)
+
+	def _close(self, client: ClientSocket):
+		self._release(client)
+		self.server.clients.discard(client)
+		try:
+			client.sock.close()
+		except OSError:
+			pass
+		if self.on_close is not None:
+			try:
+				self.on_close(client)
+			except Exception as e:
+				logger.log_exception(e)
+
+	def _drain(self):
+		try:
+			while self._wakeup.recv(4096):
+				pass
+		except BlockingIOError:
+			pass
+		while self._calls:
+			fn, args = self._calls.popleft()
+			fn(*args)
+
+	def _wake(self):
+		try:
+			self._waker.send(b"\0")
+		except (BlockingIOError, OSError):
+			pass
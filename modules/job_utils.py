@@ -0,0 +1,230 @@
+import os
+import sys
+import time
+import signal
+import itertools
+import threading
+import multiprocessing
+from collections import deque
+
+
+JOB_WORKERS = os.cpu_count() or 1
+JOB_HISTORY = 64
+JOB_GRACE = 5.0
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+_job = threading.local()
+
+
+class Job:
+	def __init__(self, job_id: int, name: str, fn, args: tuple):
+		self.id = job_id
+		self.name = name
+		self.fn = fn
+		self.args = args
+		self.state = JOB_QUEUED
+		self.result = None
+		self.error: str | None = None
+		self.on_done = None
+		self.submitted = time.monotonic()
+		self.started: float | None = None
+		self.finished: float | None = None
+		self.cores = 1
+		self._process = None
+
+	def __str__(self) -> str:
+		detail = f", {self.error}" if self.error else ""
+		return f"#{self.id} {self.name}: {self.state} ({self.elapsed:.1f} s{detail})"
+
+	@property
+	def elapsed(self) -> float:
+		if self.started is None:
+			return (self.finished or time.monotonic()) - self.submitted
+		return (self.finished or time.monotonic()) - self.started
+
+	def is_finished(self) -> bool:
+		return self.state in (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+
+class JobEngine:
+	"""
+	Runs jobs in the background, `workers` at a time. With `processes`,
+	each runs in its own process group, so a running job can be cancelled:
+	the group is terminated, then killed after `JOB_GRACE` seconds. On
+	threads only queued jobs can be cancelled.
+	"""
+
+	def __init__(self, workers: int = JOB_WORKERS, history: int = JOB_HISTORY, processes: bool = True):
+		self.workers = max(workers, 1)
+		self.history = history
+		self._context = process_context() if processes else None
+		self._jobs: dict[int, Job] = {}
+		self._queue: deque[Job] = deque()
+		self._finished: deque[int] = deque()
+		self._running = 0
+		self._ids = itertools.count(1)
+		self._lock = threading.Lock()
+
+	def submit(self, name: str, fn, *args, on_done=None) -> Job:
+		with self._lock:
+			job = Job(next(self._ids), name, fn, args)
+			job.on_done = on_done
+			self._jobs[job.id] = job
+			self._queue.append(job)
+		self._start()
+		return job
+
+	def get(self, job_id: int) -> Job | None:
+		with self._lock:
+			return self._jobs.get(job_id)
+
+	def jobs(self) -> list[Job]:
+		with self._lock:
+			return list(self._jobs.values())
+
+	def counts(self) -> tuple[int, int]:
+		with self._lock:
+			return self._running, len(self._queue)
+
+	def cancel(self, job_id: int) -> bool:
+		with self._lock:
+			job = self._jobs.get(job_id)
+			if job is None or job.is_finished():
+				return False
+			if job.state == JOB_QUEUED:
+				self._queue.remove(job)
+				self._finish(job, JOB_CANCELLED)
+				queued = True
+			elif self._context is None:
+				return False
+			else:
+				job.state = JOB_CANCELLED
+				if job._process is not None:
+					_signal(job._process, signal.SIGTERM)
+				queued = False
+		if queued:
+			self._done(job)
+		return True
+
+	def shutdown(self):
+		for job in self.jobs():
+			self.cancel(job.id)
+
+	def _start(self):
+		while True:
+			with self._lock:
+				if self._running >= self.workers or not self._queue:
+					return
+				job = self._queue.popleft()
+				job.state = JOB_RUNNING
+				job.started = time.monotonic()
+				self._running += 1
+				job.cores = max((os.cpu_count() or 1) // self._running, 1)
+			threading.Thread(target=self._run, args=(job,), name=f"job-{job.id}", daemon=True).start()
+
+	def _run(self, job: Job):
+		state = JOB_DONE
+		try:
+			if self._context is None:
+				_job.cores = job.cores
+				job.result = job.fn(*job.args)
+			else:
+				job.result = self._run_process(job)
+		except Exception as e:
+			state = JOB_FAILED
+			job.error = str(e) or type(e).__name__
+		with self._lock:
+			self._running -= 1
+			self._finish(job, JOB_CANCELLED if job.state == JOB_CANCELLED else state)
+		self._done(job)
+		self._start()
+
+	def _run_process(self, job: Job):
+		receiver, sender = self._context.Pipe(duplex=False)
+		process = self._context.Process(target=_run_child, args=(sender, job.fn, job.args, job.cores), name=f"job-{job.id}")
+		try:
+			with self._lock:
+				if job.state == JOB_CANCELLED:
+					return None
+				process.start()
+				job._process = process
+			sender.close()
+			try:
+				ok, value = receiver.recv()
+			except EOFError:
+				if job.state == JOB_CANCELLED:
+					return None
+				process.join()
+				raise RuntimeError(f"Job process exited with code {process.exitcode}.")
+			if not ok:
+				raise RuntimeError(value)
+			return value
+		finally:
+			sender.close()
+			receiver.close()
+			if process.pid is not None:
+				process.join(JOB_GRACE if job.state == JOB_CANCELLED else None)
+				if job.state == JOB_CANCELLED:
+					_signal(process, signal.SIGKILL)
+					process.join()
+			job._process = None
+
+	def _finish(self, job: Job, state: str):
+		job.state = state
+		job.finished = time.monotonic()
+		self._finished.append(job.id)
+		while len(self._finished) > self.history:
+			self._jobs.pop(self._finished.popleft(), None)
+
+	@staticmethod
+	def _done(job: Job):
+		if job.on_done is not None:
+			job.on_done(job)
+
+
+def job_share() -> int:
+	"""
+	Returns how many cores the calling job may use, or every core outside
+	of a job. The n-th job running when it starts gets 1/n of the cores and
+	keeps them, so three jobs on 8 cores get 8, 4 and 2.
+	"""
+	return getattr(_job, "cores", os.cpu_count() or 1)
+
+
+def process_context():
+	"""
+	Forkserver where available, else spawn: children do not inherit the
+	caller's locks or sockets, so job functions and arguments must pickle.
+	"""
+	methods = multiprocessing.get_all_start_methods()
+	return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def _signal(process, signum: int):
+	try:
+		os.killpg(process.pid, signum)
+	except ProcessLookupError:
+		# The child has not made its own group yet.
+		try:
+			os.kill(process.pid, signum)
+		except ProcessLookupError:
+			pass
+
+
+def _run_child(conn, fn, args: tuple, cores: int):
+	os.setpgrp()
+	_job.cores = cores
+	signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+	try:
+		result = fn(*args)
+	except BaseException as e:
+		conn.send((False, f"{type(e).__name__}: {e}"))
+	else:
+		conn.send((True, result))
+	finally:
+		conn.close()
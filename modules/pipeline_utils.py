@@ -0,0 +1,92 @@
+import queue
+import threading
+
+
+PIPELINE_DEPTH = 8
+
+_END = object()
+
+
+class Pipeline:
+	"""
+	Streams items from `read` through `transforms` to `write`, each stage on
+	its own thread. At most `depth` items are in flight: written items go
+	back to `read(buffer)` to be refilled (`buffer` is None until then).
+	`read` returns None at the end.
+	"""
+
+	def __init__(self, read, write, *transforms, depth: int = PIPELINE_DEPTH):
+		self.read = read
+		self.write = write
+		self.transforms = transforms
+		self.depth = max(depth, 1)
+		self.count = 0
+		self._free: queue.Queue = queue.Queue()
+		self._error: BaseException | None = None
+		self._stopped = threading.Event()
+
+	def run(self) -> int:
+		"""
+		Returns how many items were written. Raises what a stage raised, once
+		every stage has stopped.
+		"""
+		for _ in range(self.depth):
+			self._free.put(None)
+		queues = [queue.Queue() for _ in range(len(self.transforms) + 1)]
+		threads = [threading.Thread(target=self._read, args=(queues[0],), name="pipeline-read", daemon=True)]
+		for i, transform in enumerate(self.transforms):
+			threads.append(threading.Thread(target=self._stage, args=(transform, queues[i], queues[i + 1]),
+				name=f"pipeline-{i}", daemon=True))
+		for thread in threads:
+			thread.start()
+		self._stage(self._write, queues[-1], None)
+		for thread in threads:
+			thread.join()
+		if self._error is not None:
+			raise self._error
+		return self.count
+
+	def _read(self, out: queue.Queue):
+		try:
+			while True:
+				buffer = self._free.get()
+				if self._stopped.is_set():
+					break
+				item = self.read(buffer)
+				if item is None:
+					break
+				out.put(item)
+		except BaseException as e:
+			self._fail(e)
+		finally:
+			out.put(_END)
+
+	def _stage(self, fn, source: queue.Queue, out: queue.Queue | None):
+		while True:
+			item = source.get()
+			if item is _END:
+				if out is not None:
+					out.put(_END)
+				return
+			if not self._stopped.is_set():
+				try:
+					result = fn(item)
+				except BaseException as e:
+					self._fail(e)
+				else:
+					if out is not None:
+						out.put(result)
+						continue
+					item = result
+			self._free.put(item)
+
+	def _write(self, item):
+		self.write(item)
+		self.count += 1
+		return item
+
+	def _fail(self, error: BaseException):
+		if self._error is None:
+			self._error = error
+		self._stopped.set()
+		self._free.put(None)
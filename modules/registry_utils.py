@@ -0,0 +1,141 @@
+import threading
+
+
+SELECT_ALL = "*"
+SELECT_TAG = "@"
+SELECT_ID = "#"
+
+
+class ClientRegistry:
+	"""
+	Iteration walks an immutable snapshot, so it is safe while clients come
+	and go.
+	"""
+
+	def __init__(self):
+		self._by_id: dict[int, object] = {}
+		self._by_address: dict[tuple, object] = {}
+		self._by_host: dict[str, dict[int, object]] = {}
+		self._by_tag: dict[str, dict[int, object]] = {}
+		self._snapshot: tuple = ()
+		self._dirty = False
+		self._next_id = 1
+		self._lock = threading.Lock()
+
+	def __len__(self) -> int:
+		return len(self._by_id)
+
+	def __iter__(self):
+		return iter(self.snapshot())
+
+	def __contains__(self, client) -> bool:
+		return self._by_id.get(getattr(client, "id", None)) is client
+
+	def __repr__(self) -> str:
+		return repr(list(self.snapshot()))
+
+	def snapshot(self) -> tuple:
+		with self._lock:
+			if self._dirty:
+				self._snapshot = tuple(self._by_id.values())
+				self._dirty = False
+			return self._snapshot
+
+	def append(self, client):
+		with self._lock:
+			if not client.id or client.id in self._by_id:
+				client.id = self._next_id
+			self._next_id = max(self._next_id, client.id + 1)
+			self._by_id[client.id] = client
+			self._by_address[client.address] = client
+			self._by_host.setdefault(client.address[0], {})[client.id] = client
+			for tag in client.tags:
+				self._by_tag.setdefault(tag, {})[client.id] = client
+			self._dirty = True
+
+	def reserve(self, client_id: int):
+		with self._lock:
+			self._next_id = max(self._next_id, client_id + 1)
+
+	def remove(self, client):
+		with self._lock:
+			if self._by_id.get(getattr(client, "id", None)) is not client:
+				raise ValueError(f"{client} is not registered.")
+			del self._by_id[client.id]
+			self._by_address.pop(client.address, None)
+			self._unindex(self._by_host, client.address[0], client.id)
+			for tag in client.tags:
+				self._unindex(self._by_tag, tag, client.id)
+			self._dirty = True
+
+	def discard(self, client):
+		try:
+			self.remove(client)
+		except ValueError:
+			pass
+
+	def get(self, client_id: int):
+		return self._by_id.get(client_id)
+
+	def by_address(self, address: tuple[str, int]) -> list:
+		with self._lock:
+			if address[1]:
+				client = self._by_address.get(address)
+				return [] if client is None else [client]
+			return list(self._by_host.get(address[0], {}).values())
+
+	def group(self, tag: str) -> list:
+		with self._lock:
+			return list(self._by_tag.get(tag, {}).values())
+
+	def tags(self) -> dict[str, int]:
+		with self._lock:
+			return {tag: len(members) for tag, members in self._by_tag.items()}
+
+	def tag(self, client, *tags: str):
+		with self._lock:
+			for tag in tags:
+				client.tags.add(tag)
+				if self._by_id.get(client.id) is client:
+					self._by_tag.setdefault(tag, {})[client.id] = client
+
+	def untag(self, client, *tags: str):
+		with self._lock:
+			for tag in tags:
+				client.tags.discard(tag)
+				self._unindex(self._by_tag, tag, client.id)
+
+	def select(self, selector: str) -> list:
+		"""
+		Resolves a comma separated selector: `*`, `@<tag>`, `#<id>` or an
+		address (`host` for every client of a host).
+		"""
+		from modules.command_utils import parse_addr
+		selected = {}
+		for part in selector.split(","):
+			part = part.strip()
+			if not part:
+				continue
+			if part == SELECT_ALL:
+				return list(self.snapshot())
+			if part.startswith(SELECT_TAG):
+				clients = self.group(part[1:])
+			elif part.startswith(SELECT_ID):
+				try:
+					client = self.get(int(part[1:]))
+				except ValueError:
+					client = None
+				clients = [] if client is None else [client]
+			else:
+				clients = self.by_address(parse_addr(part))
+			for client in clients:
+				selected[client.id] = client
+		return list(selected.values())
+
+	@staticmethod
+	def _unindex(index: dict[str, dict[int, object]], key: str, client_id: int):
+		members = index.get(key)
+		if members is not None:
+			members.pop(client_id, None)
+			if not members:
+				del index[key]
@@ -0,0 +1,243 @@
+import hmac
+import time
+import queue
+import socket
+import hashlib
+import threading
+import modules.logger as logger
+from modules.socket_utils import Socket, ServerSocket, BUFFER_1MB
+
+
+RELAY_FANOUT = 2
+RELAY_TIMEOUT = 60.0
+RELAY_REPORT = 1.0
+RELAY_QUEUE = 8
+RELAY_AUTH_TIMEOUT = 5.0
+
+STATE_WAITING = "waiting"
+STATE_RECEIVING = "receiving"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+
+def relay_tree(count: int, fanout: int = RELAY_FANOUT) -> dict[int, list[int]]:
+	"""
+	Returns the children of every node of a `fanout`-ary tree over `count`
+	clients. Key `-1` is the server.
+	"""
+	tree = {-1: list(range(min(fanout, count)))}
+	for index in range(count):
+		first = fanout * (index + 1)
+		tree[index] = list(range(first, min(first + fanout, count)))
+	return tree
+
+
+def relay_send(file_path: str, length: int, children: list[tuple[str, int]], token: str, buffer_size: int = BUFFER_1MB):
+	errors = []
+
+	def send(address: tuple[str, int]):
+		child = Socket()
+		try:
+			child.sock.connect(address)
+			child.sock.settimeout(RELAY_TIMEOUT)
+			child.send(token.encode("ascii"), len(token))
+			with open(file_path, "rb") as file, child.scheduler.track(child, file_path, length) as transfer:
+				child._send_file_raw(file, 0, length, buffer_size, True, transfer)
+		except Exception as e:
+			errors.append(e)
+		finally:
+			child.close()
+
+	threads = [threading.Thread(target=send, args=(tuple(address),)) for address in children]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	if errors:
+		raise errors[0]
+
+
+class RelayTracker:
+	def __init__(self):
+		self._relays: dict[str, dict] = {}
+		self._lock = threading.Lock()
+		self._changed = threading.Condition(self._lock)
+
+	def start(self, token: str, dest_path: str, length: int, addresses: list[str]):
+		with self._lock:
+			self._relays[token] = {
+				"dest_path": dest_path,
+				"length": length,
+				"started": time.monotonic(),
+				"updated": time.monotonic(),
+				"clients": {address: [0, STATE_WAITING] for address in addresses},
+			}
+
+	def update(self, token: str, address: str, received: int, state: str):
+		with self._lock:
+			relay = self._relays.get(token)
+			if relay is not None and address in relay["clients"]:
+				relay["clients"][address] = [received, state]
+				relay["updated"] = time.monotonic()
+				self._changed.notify_all()
+
+	def unfinished(self, token: str, handled: set[str], idle: float = RELAY_TIMEOUT) -> list[str]:
+		"""
+		Waits until clients of relay `token` not in `handled` failed, and returns
+		them. If none reported for `idle` seconds, returns those not done.
+		"""
+		with self._lock:
+			relay = self._relays[token]
+			while True:
+				states = {address: state for address, (_, state) in relay["clients"].items() if address not in handled}
+				failed = [address for address, state in states.items() if state == STATE_FAILED]
+				if failed:
+					return failed
+				remaining = relay["updated"] + idle - time.monotonic()
+				if remaining <= 0:
+					return [address for address, state in states.items() if state != STATE_DONE]
+				if all(state == STATE_DONE for state in states.values()):
+					return []
+				self._changed.wait(remaining)
+
+	def snapshot(self) -> dict[str, dict]:
+		with self._lock:
+			return {token: {**relay, "clients": dict(relay["clients"])} for token, relay in self._relays.items()}
+
+
+class RelayChild:
+	"""
+	Sends queued chunks to one child on its own thread. A child that does
+	not take a chunk within `RELAY_TIMEOUT` is dropped.
+	"""
+	def __init__(self, token: str, address: tuple[str, int]):
+		self.token = token
+		self.address = address
+		self.failed = False
+		self.socket = Socket()
+		try:
+			self.socket.sock.connect(address)
+			self.socket.sock.settimeout(RELAY_TIMEOUT)
+			self.socket.send(token.encode("ascii"), len(token))
+		except OSError:
+			self.socket.close()
+			raise
+		self._queue = queue.Queue(RELAY_QUEUE)
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def put(self, chunk: bytes):
+		if self.failed:
+			return
+		try:
+			self._queue.put(chunk, timeout=RELAY_TIMEOUT)
+		except queue.Full:
+			self._fail(f"{self.address} is too slow, dropped.")
+
+	def close(self):
+		self._queue.put(None)
+		self._thread.join()
+
+	def _fail(self, message: str):
+		if not self.failed:
+			self.failed = True
+			logger.log(f"Relay {self.token}: {message}", flag=logger.FLAG_ERROR)
+		try:
+			self.socket.sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+
+	def _run(self):
+		try:
+			while (chunk := self._queue.get()) is not None:
+				if not self.failed:
+					self.socket.send(chunk, len(chunk))
+		except Exception as e:
+			self._fail(f"sending to {self.address} failed: {e}")
+			while self._queue.get() is not None:
+				pass
+		finally:
+			self.socket.close()
+
+
+class RelayNode:
+	def __init__(self, token: str):
+		self.token = token
+		self.listener = ServerSocket()
+		self.listener.bind("", 0)
+		self.listener.listen(1)
+		self.port = self.listener.sock.getsockname()[1]
+
+	def start(self, dest_path: str, length: int, digest: str, children: list[tuple[str, int]], report) -> threading.Thread:
+		thread = threading.Thread(target=self._run, args=(dest_path, length, digest, children, report))
+		thread.start()
+		return thread
+
+	def close(self):
+		self.listener.sock.close()
+
+	def _accept(self) -> Socket:
+		expected = self.token.encode("ascii")
+		deadline = time.monotonic() + RELAY_TIMEOUT
+		while True:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				raise TimeoutError(f"No parent connected within {RELAY_TIMEOUT} seconds.")
+			self.listener.sock.settimeout(remaining)
+			parent = self.listener.accept(add_to_clients=False)
+			try:
+				parent.sock.settimeout(RELAY_AUTH_TIMEOUT)
+				if hmac.compare_digest(parent.receive(len(expected)), expected):
+					parent.sock.settimeout(RELAY_TIMEOUT)
+					return parent
+			except (OSError, RuntimeError):
+				pass
+			logger.log(f"Relay {self.token}: rejected a connection from {parent.address}.", flag=logger.FLAG_ERROR)
+			Socket.close(parent)
+
+	def _run(self, dest_path: str, length: int, digest: str, children: list[tuple[str, int]], report):
+		received = 0
+		parent = None
+		outputs = []
+		try:
+			parent = self._accept()
+			for address in children:
+				try:
+					outputs.append(RelayChild(self.token, tuple(address)))
+				except OSError as e:
+					logger.log_exception(e, f"Relay {self.token}: cannot reach {address}.", print_stack_trace=False, before=[])
+			received, actual = self._forward(parent, outputs, dest_path, length, report)
+			report(received, STATE_DONE if actual == digest else STATE_FAILED)
+		except Exception as e:
+			report(received, STATE_FAILED)
+			logger.log_exception(e, f"Relay {self.token} failed.", before=[])
+		finally:
+			for child in outputs:
+				child.close()
+			if parent is not None:
+				Socket.close(parent)
+			self.close()
+
+	def _forward(self, parent: Socket, outputs: list[RelayChild], dest_path: str, length: int, report) -> tuple[int, str]:
+		received = 0
+		digest = hashlib.blake2b()
+		reported = time.monotonic()
+		buffer = parent.pool.acquire(BUFFER_1MB)
+		try:
+			with open(dest_path, "wb") as file, memoryview(buffer) as view:
+				while received < length:
+					size = parent.receive_some(view, min(length - received, BUFFER_1MB))
+					if size == 0:
+						raise RuntimeError(f"Relay broken. Total received: {received} bytes.")
+					chunk = bytes(view[:size])
+					for child in outputs:
+						child.put(chunk)
+					file.write(chunk)
+					digest.update(chunk)
+					received += size
+					if time.monotonic() - reported >= RELAY_REPORT:
+						report(received, STATE_RECEIVING)
+						reported = time.monotonic()
+		finally:
+			parent.pool.release(buffer)
+		return received, digest.hexdigest()
@@ -0,0 +1,275 @@
+import time
+import heapq
+import itertools
+import threading
+import weakref
+from collections import deque
+from contextlib import contextmanager
+
+
+PRIORITY_CONTROL = 0
+PRIORITY_MESSAGE = 1
+PRIORITY_BULK = 2
+
+QUANTUM_MAX = 262144
+QUANTUM_MIN = 16384
+QUANTUM_UNSHAPED = 4194304
+BURST_TIME = 0.1
+RATE_WINDOW = 2.0
+RATE_SAMPLE = 0.1
+
+_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_rate(text: str) -> float:
+	text = text.strip().upper().removesuffix("/S").removesuffix("B")
+	if text in ("OFF", "NONE"):
+		return 0.0
+	unit = text[-1:] if text[-1:] in _UNITS else ""
+	rate = float(text[:len(text) - len(unit)]) * _UNITS[unit]
+	if rate < 0:
+		raise ValueError(f"Negative rate '{text}'.")
+	return rate
+
+
+def format_rate(rate: float) -> str:
+	return "unlimited" if not rate else f"{rate / 1024 ** 2:.2f} MB/s"
+
+
+class TokenBucket:
+	def __init__(self, rate: float = 0.0, burst: float | None = None):
+		self._lock = threading.Lock()
+		self.set_rate(rate, burst)
+
+	def set_rate(self, rate: float, burst: float | None = None):
+		with self._lock:
+			self.rate = max(rate, 0.0)
+			self.burst = max(self.rate * BURST_TIME, QUANTUM_MIN) if burst is None else burst
+			self._tokens = self.burst
+			self._stamp = time.monotonic()
+
+	def reserve(self, size: int) -> float:
+		with self._lock:
+			if not self.rate:
+				return 0.0
+			now = time.monotonic()
+			self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+			self._stamp = now
+			self._tokens -= size
+			return max(-self._tokens / self.rate, 0.0)
+
+
+class PriorityLock:
+	"""
+	Reentrant lock handed to waiters by priority class (control, messages,
+	bulk), in arrival order within a class.
+	"""
+
+	def __init__(self):
+		self._cond = threading.Condition(threading.Lock())
+		self._owner = None
+		self._depth = 0
+		self._queues = (deque(), deque(), deque())
+
+	def acquire(self, blocking: bool = True, priority: int = PRIORITY_CONTROL) -> bool:
+		me = threading.get_ident()
+		with self._cond:
+			if self._owner == me:
+				self._depth += 1
+				return True
+			if self._owner is None and not any(self._queues[:priority + 1]):
+				self._owner = me
+				self._depth = 1
+				return True
+			if not blocking:
+				return False
+			ticket = object()
+			queue = self._queues[priority]
+			queue.append(ticket)
+			try:
+				while self._owner is not None or self._head() is not ticket:
+					self._cond.wait()
+			except BaseException:
+				queue.remove(ticket)
+				self._cond.notify_all()
+				raise
+			queue.popleft()
+			self._owner = me
+			self._depth = 1
+			return True
+
+	def release(self):
+		with self._cond:
+			if self._owner != threading.get_ident():
+				raise RuntimeError("Cannot release un-acquired lock.")
+			self._depth -= 1
+			if not self._depth:
+				self._owner = None
+				if any(self._queues):
+					self._cond.notify_all()
+
+	@contextmanager
+	def hold(self, priority: int):
+		self.acquire(priority=priority)
+		try:
+			yield self
+		finally:
+			self.release()
+
+	def __enter__(self):
+		self.acquire()
+		return self
+
+	def __exit__(self, *exc):
+		self.release()
+
+	def _head(self):
+		for queue in self._queues:
+			if queue:
+				return queue[0]
+		return None
+
+
+class Transfer:
+	def __init__(self, scheduler: "TransferScheduler", transfer_id: int, flow, dest_path: str, length: int):
+		self.scheduler = scheduler
+		self.id = transfer_id
+		self.flow = flow
+		self.dest_path = dest_path
+		self.length = length
+		self.sent = 0
+		self.wire = 0
+		self.started = time.monotonic()
+		self._window: deque[tuple[float, int]] = deque([(self.started, 0)])
+		self._lock = threading.Lock()
+
+	def __str__(self) -> str:
+		progress = f" ({self.sent / self.length * 100:.1f}%)" if self.length else ""
+		return (f"{self.dest_path}: {self.sent}/{self.length} bytes{progress}, "
+			f"{self.rate / 1024 ** 2:.1f} MB/s now, {self.average / 1024 ** 2:.1f} MB/s average")
+
+	@property
+	def quantum(self) -> int:
+		rate = self.scheduler.limit(self.flow)
+		if not rate:
+			return QUANTUM_UNSHAPED
+		return int(min(QUANTUM_MAX, max(QUANTUM_MIN, rate * BURST_TIME)))
+
+	@property
+	def rate(self) -> float:
+		now = time.monotonic()
+		with self._lock:
+			stamp, wire = self._window[0]
+			if now - stamp < RATE_SAMPLE:
+				return 0.0
+			return (self.wire - wire) / (now - stamp)
+
+	@property
+	def average(self) -> float:
+		elapsed = time.monotonic() - self.started
+		return self.wire / elapsed if elapsed else 0.0
+
+	def advance(self, wire: int, raw: int | None = None):
+		self.scheduler.throttle(self.flow, wire)
+		now = time.monotonic()
+		with self._lock:
+			self.wire += wire
+			self.sent += wire if raw is None else raw
+			if now - self._window[-1][0] >= RATE_SAMPLE:
+				self._window.append((now, self.wire))
+			while len(self._window) > 1 and self._window[0][0] < now - RATE_WINDOW:
+				self._window.popleft()
+
+
+class _Flow:
+	def __init__(self, rate: float):
+		self.bucket = TokenBucket(rate)
+		self.finish = 0.0
+
+
+class TransferScheduler:
+	"""
+	One token bucket per flow and one for the process; when the global
+	bucket is the bottleneck, waiting flows are served fairly.
+	"""
+
+	def __init__(self, rate: float = 0.0, client_rate: float = 0.0):
+		self.bucket = TokenBucket(rate)
+		self.client_rate = client_rate
+		self._flows: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+		self._transfers: dict[int, Transfer] = {}
+		self._ids = itertools.count(1)
+		self._sequence = itertools.count()
+		self._waiting: list[tuple[float, int]] = []
+		self._busy = False
+		self._clock = 0.0
+		self._cond = threading.Condition()
+
+	@property
+	def rate(self) -> float:
+		return self.bucket.rate
+
+	def set_rate(self, rate: float):
+		self.bucket.set_rate(rate)
+
+	def flow_rate(self, flow) -> float:
+		return self._flow(flow).bucket.rate
+
+	def set_flow_rate(self, flow, rate: float):
+		self._flow(flow).bucket.set_rate(rate)
+
+	def limit(self, flow) -> float:
+		rates = [rate for rate in (self.bucket.rate, self.flow_rate(flow)) if rate]
+		return min(rates) if rates else 0.0
+
+	def transfers(self) -> list[Transfer]:
+		with self._cond:
+			return list(self._transfers.values())
+
+	@contextmanager
+	def track(self, flow, dest_path: str, length: int):
+		with self._cond:
+			transfer = Transfer(self, next(self._ids), flow, dest_path, length)
+			self._transfers[transfer.id] = transfer
+		try:
+			yield transfer
+		finally:
+			with self._cond:
+				del self._transfers[transfer.id]
+
+	def throttle(self, flow, size: int):
+		state = self._flow(flow)
+		delay = state.bucket.reserve(size)
+		if delay:
+			time.sleep(delay)
+		if not self.bucket.rate or not size:
+			return
+		with self._cond:
+			entry = (max(self._clock, state.finish) + size, next(self._sequence))
+			state.finish = entry[0]
+			heapq.heappush(self._waiting, entry)
+			while self._busy or self._waiting[0] is not entry:
+				self._cond.wait()
+			heapq.heappop(self._waiting)
+			self._busy = True
+		try:
+			delay = self.bucket.reserve(size)
+			if delay:
+				time.sleep(delay)
+		finally:
+			with self._cond:
+				self._clock = entry[0]
+				self._busy = False
+				self._cond.notify_all()
+
+	def _flow(self, flow) -> _Flow:
+		state = self._flows.get(flow)
+		if state is None:
+			with self._cond:
+				state = self._flows.get(flow)
+				if state is None:
+					state = self._flows[flow] = _Flow(self.client_rate)
+		return state
+
+
+default_scheduler = TransferScheduler()
@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import random
+import secrets
+import threading
+import modules.logger as logger
+from modules.socket_utils import ClientSocket
+from modules.registry_utils import ClientRegistry
+
+
+SESSION_PATH = os.path.join(os.environ.get("XDG_STATE_HOME") or os.path.join(os.path.expanduser("~"), ".local", "state"),
+	"qg-autopilot", "sessions.json")
+SESSION_TTL = 600.0
+SESSION_RETRIES = 3
+
+RECONNECT_INITIAL = 0.5
+RECONNECT_MAX = 30.0
+
+
+def backoff(attempt: int, initial: float = RECONNECT_INITIAL, maximum: float = RECONNECT_MAX) -> float:
+	return random.uniform(0, min(maximum, initial * 2 ** min(attempt, 32)))
+
+
+def reconnect(client: ClientSocket, host: str, port: int, stop: threading.Event,
+			  initial: float = RECONNECT_INITIAL, maximum: float = RECONNECT_MAX) -> bool:
+	attempt = 0
+	while not stop.is_set():
+		try:
+			client.reconnect(host, port)
+			return True
+		except OSError as e:
+			delay = backoff(attempt, initial, maximum)
+			logger.log(f"Connection failed ({e}). Retrying in {delay:.1f} s...", flag=logger.FLAG_ERROR)
+			attempt += 1
+			stop.wait(delay)
+	return False
+
+
+class SessionStore:
+	"""
+	Server side sessions, persisted to `path`. Presenting a token again
+	restores the client's id, tags and unfinished transfers. Sessions gone
+	for longer than `ttl`, or closed with `quit`, are forgotten.
+	"""
+
+	def __init__(self, registry: ClientRegistry, path: str = SESSION_PATH, ttl: float = SESSION_TTL):
+		self.registry = registry
+		self.path = path
+		self.ttl = ttl
+		self._sessions: dict[str, dict] = {}
+		self._clients: dict[str, ClientSocket] = {}
+		self.on_replaced = None
+		self._lock = threading.Lock()
+		self._save_lock = threading.Lock()
+		try:
+			with open(path, "r") as file:
+				self._sessions = json.load(file)
+		except FileNotFoundError:
+			pass
+		except (OSError, ValueError) as e:
+			logger.log_exception(e, f"Cannot load sessions from '{path}'.", print_stack_trace=False, before=[])
+		now = time.time()
+		for session in self._sessions.values():
+			session["lost"] = session.get("lost") or now
+			registry.reserve(session["id"])
+
+	def __len__(self) -> int:
+		return len(self._sessions)
+
+	def handle(self, client: ClientSocket, cmd: str) -> str | None:
+		"""
+		Returns "new" or "resumed", or None if `cmd` is not a session request.
+		"""
+		if cmd != "session" and not cmd.startswith("session "):
+			return None
+		token = cmd.removeprefix("session").strip()
+		previous = None
+		with self._lock:
+			self._prune()
+			session = self._sessions.get(token)
+			state = "new" if session is None else "resumed"
+			if session is None:
+				token = secrets.token_hex(16)
+				session = self._sessions[token] = {"id": client.id, "tags": [], "transfers": {}, "lost": None}
+			else:
+				previous = self._clients.get(token)
+				self.registry.discard(client)
+				if previous is not None:
+					self.registry.discard(previous)
+				client.id = session["id"]
+				client.tags = set(session["tags"])
+				self.registry.append(client)
+				session["id"] = client.id
+				session["lost"] = None
+			client.session = token
+			self._clients[token] = client
+		client.send_cmd(f"session {token} {client.id} {state}")
+		if previous is not None and previous is not client and self.on_replaced is not None:
+			self.on_replaced(previous)
+		self.save()
+		return state
+
+	def transfers(self, client: ClientSocket) -> list[dict]:
+		with self._lock:
+			session = self._sessions.get(client.session)
+			return [] if session is None else list(session["transfers"].values())
+
+	def track(self, client: ClientSocket, transfer: dict):
+		with self._lock:
+			session = self._sessions.get(client.session)
+			if session is None:
+				return
+			session["transfers"][transfer["dest_path"]] = {"attempts": 1, **transfer}
+		self.save()
+
+	def untrack(self, client: ClientSocket, dest_path: str):
+		with self._lock:
+			session = self._sessions.get(client.session)
+			if session is None or session["transfers"].pop(dest_path, None) is None:
+				return
+		self.save()
+
+	def lost(self, client: ClientSocket):
+		with self._lock:
+			if self._clients.get(client.session) is not client:
+				return
+			del self._clients[client.session]
+			self._sessions[client.session]["tags"] = sorted(client.tags)
+			self._sessions[client.session]["lost"] = time.time()
+		self.save()
+
+	def close(self, client: ClientSocket):
+		with self._lock:
+			if self._clients.get(client.session) is not client:
+				return
+			del self._clients[client.session]
+			del self._sessions[client.session]
+		self.save()
+
+	def save(self):
+		try:
+			with self._save_lock:
+				with self._lock:
+					for token, client in self._clients.items():
+						self._sessions[token]["tags"] = sorted(client.tags)
+					data = json.dumps(self._sessions)
+				os.makedirs(os.path.dirname(self.path), exist_ok=True)
+				tmp_path = f"{self.path}.{os.getpid()}.tmp"
+				with open(tmp_path, "w") as file:
+					file.write(data)
+				os.replace(tmp_path, self.path)
+		except OSError as e:
+			logger.log_exception(e, f"Cannot save sessions to '{self.path}'.", print_stack_trace=False, before=[])
+
+	def _prune(self):
+		expired = time.time() - self.ttl
+		for token in [token for token, session in self._sessions.items() if session["lost"] is not None and session["lost"] < expired]:
+			del self._sessions[token]
@@ -1,5 +1,23 @@
+import os
+import json
+import mmap
+import hashlib
 import socket
+import time
+import select
+import struct
+import secrets
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+from contextlib import contextmanager, nullcontext
 import modules.logger as logger
+from modules.compression_utils import COMPRESSION_NONE, choose_codec, make_compressor, make_decompressor
+from modules.delta_utils import RESUME_BLOCK, DeltaEncoder, block_hashes, block_signatures, delta_block_size, file_digest
+from modules.cache_utils import ContentCache, CACHE_OFFER_MIN, cached_digest
+from modules.registry_utils import ClientRegistry
+from modules.scheduler_utils import PriorityLock, Transfer, default_scheduler, PRIORITY_CONTROL, PRIORITY_MESSAGE, PRIORITY_BULK
 
 BUFFER_256 = 256
 BUFFER_512 = 512
@@ -10,6 +28,254 @@ BUFFER_1MB = 1048576
 BUFFER_10MB = 10485760
 
 BUFFER_CMD = BUFFER_256
+MMAP_THRESHOLD = BUFFER_10MB
+POOL_MAX_BUFFER = BUFFER_10MB
+READ_AHEAD = BUFFER_100KB
+BATCH_INLINE = 65536
+
+PROTOCOL_LEGACY = 1
+PROTOCOL_FRAMED = 2
+PROTOCOL_CHANNELS = 3
+PROTOCOL_CALLS = 4
+PROTOCOL_DATA_FRAMES = 5
+PROTOCOL_VERSION = PROTOCOL_DATA_FRAMES
+
+FRAME_HEADER = struct.Struct("!BBI")
+FRAME_INLINE = BUFFER_1KB
+FRAME_CMD = 1
+FRAME_MSG = 2
+FRAME_FILE = 3
+FRAME_DATA = 4
+FRAME_REPLY = 5
+FRAME_PING = 6
+FRAME_PONG = 7
+FRAME_OPEN = 8
+FRAME_CHUNK = 9
+FRAME_CALL = 10
+
+FRAME_FLAG_ENCODING = 0x01
+FRAME_FLAG_END = 0x02
+FRAME_FLAG_COPY = 0x04
+FRAME_FLAG_ABORT = 0x08
+
+CHANNEL_CHUNK = 262144
+
+TRANSFER_PLAIN = "plain"
+TRANSFER_RESUME = "resume"
+TRANSFER_DELTA = "delta"
+TRANSFER_CACHED = "cached"
+TRANSFER_CONTINUE = "continue"
+
+REPLY_POLL = 0.5
+REPLY_TIMEOUT = 300.0
+CALL_TIMEOUT = 30.0
+
+OUTBOUND_MAX = BUFFER_1MB
+OUTBOUND_TIMEOUT = 30.0
+SLOW_DROP = "drop"
+SLOW_EVICT = "evict"
+
+HEARTBEAT_INTERVAL = 5.0
+HEARTBEAT_MISSES = 3
+HEARTBEAT_WINDOW = 64
+
+STREAMS_MAX = 8
+STREAM_TIMEOUT = 30.0
+
+_COPY_RUN = struct.Struct("!QQ")
+_RANGE = struct.Struct("!QQ")
+_BEAT = struct.Struct("!Q")
+_CHANNEL = struct.Struct("!I")
+_FRAME_PRIORITY = {FRAME_MSG: PRIORITY_MESSAGE, FRAME_FILE: PRIORITY_BULK, FRAME_DATA: PRIORITY_BULK, FRAME_OPEN: PRIORITY_BULK,
+	FRAME_CHUNK: PRIORITY_BULK}
+
+
+def split_ranges(length: int, count: int) -> list[tuple[int, int]]:
+	size = -(-length // count)
+	return [(offset, min(size, length - offset)) for offset in range(0, length, size)] if length else []
+
+_RECV_FLAGS = getattr(socket, "MSG_WAITALL", 0)
+_SEND_MORE = getattr(socket, "MSG_MORE", 0)
+_IOV_MAX = 1024
+_ZEROS = memoryview(bytes(BUFFER_CMD))
+
+
+def _readable(sock: socket.socket, timeout: float) -> bool:
+	if hasattr(select, "poll"):
+		poller = select.poll()
+		poller.register(sock, select.POLLIN)
+		return bool(poller.poll(max(timeout, 0) * 1000))
+	return bool(select.select([sock], [], [], timeout)[0])
+
+
+class BufferPool:
+	def __init__(self, max_buffer: int = POOL_MAX_BUFFER):
+		self.max_buffer = max_buffer
+		self._buffers: dict[int, list[bytearray]] = {}
+		self._lock = threading.Lock()
+
+	def acquire(self, size: int) -> bytearray:
+		size_class = 1 << max(size - 1, 0).bit_length()
+		with self._lock:
+			free = self._buffers.get(size_class)
+			if free:
+				return free.pop()
+		return bytearray(size_class)
+
+	def release(self, buffer: bytearray):
+		size_class = len(buffer)
+		if size_class > self.max_buffer:
+			return
+		with self._lock:
+			free = self._buffers.get(size_class)
+			if free is None:
+				free = self._buffers[size_class] = []
+			free.append(buffer)
+
+	def clear(self):
+		with self._lock:
+			self._buffers.clear()
+
+
+class TransferStats:
+	def __init__(self, codec: str = COMPRESSION_NONE, mode: str = TRANSFER_PLAIN):
+		self.codec = codec
+		self.mode = mode
+		self.streams = 1
+		self.raw_bytes = 0
+		self.wire_bytes = 0
+		self.elapsed = 0.0
+		self._started = time.perf_counter()
+
+	def __str__(self) -> str:
+		return f"{self.raw_bytes} bytes, mode={self.mode}, codec={self.codec}, streams={self.streams}, ratio={self.ratio:.3f}, {self.throughput / BUFFER_1MB:.1f} MB/s"
+
+	@property
+	def ratio(self) -> float:
+		return self.wire_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+	@property
+	def throughput(self) -> float:
+		return self.raw_bytes / self.elapsed if self.elapsed else 0.0
+
+	def finish(self) -> "TransferStats":
+		self.elapsed = time.perf_counter() - self._started
+		return self
+
+
+class Heartbeat:
+	def __init__(self, window: int = HEARTBEAT_WINDOW):
+		self.rtts: deque[float] = deque(maxlen=window)
+		self.sequence = 0
+		self._outstanding: list | None = None
+		self._lock = threading.Lock()
+
+	def __str__(self) -> str:
+		if not self.rtts:
+			return "rtt n/a"
+		return f"rtt p50={self.percentile(50) * 1000:.2f} ms, p99={self.percentile(99) * 1000:.2f} ms"
+
+	def next(self) -> int | None:
+		with self._lock:
+			if self._outstanding is not None:
+				return None
+			self.sequence += 1
+			self._outstanding = [self.sequence, time.monotonic(), False]
+			return self.sequence
+
+	def written(self, sequence: int):
+		with self._lock:
+			if self._outstanding is not None and self._outstanding[0] == sequence:
+				self._outstanding[1:] = [time.monotonic(), True]
+
+	def answered(self, sequence: int):
+		now = time.monotonic()
+		with self._lock:
+			if self._outstanding is not None and self._outstanding[0] == sequence:
+				self.rtts.append(now - self._outstanding[1])
+				self._outstanding = None
+
+	def forget(self, sequence: int):
+		with self._lock:
+			if self._outstanding is not None and self._outstanding[0] == sequence:
+				self._outstanding = None
+
+	def missed(self, interval: float, last_received: float = 0.0) -> int:
+		with self._lock:
+			if self._outstanding is None or not self._outstanding[2]:
+				return 0
+			return int((time.monotonic() - max(self._outstanding[1], last_received)) / interval)
+
+	def percentile(self, p: float) -> float:
+		with self._lock:
+			rtts = sorted(self.rtts)
+		if not rtts:
+			return 0.0
+		return rtts[min(len(rtts) - 1, int(len(rtts) * p / 100))]
+
+
+class ChannelSink:
+	"""
+	Receiving end of a file multiplexed on a channel: chunks are written as
+	they arrive, in between whatever else the connection carries.
+	"""
+
+	def __init__(self, header: dict):
+		self.header = header
+		self.received = 0
+		self.stats = TransferStats(header.get("compression", COMPRESSION_NONE))
+		self.stats.raw_bytes = header["length"]
+		self._decompressor = None if self.stats.codec == COMPRESSION_NONE else make_decompressor(self.stats.codec)
+		self._digest = hashlib.blake2b() if "digest" in header else None
+		self._file = open(header["dest_path"], "w+b")
+		self._mapped = None
+		self._view = None
+		if self._decompressor is None and header["length"] >= MMAP_THRESHOLD:
+			self._file.truncate(header["length"])
+			self._mapped = mmap.mmap(self._file.fileno(), header["length"])
+			self._view = memoryview(self._mapped)
+
+	def target(self, size: int) -> memoryview | None:
+		if self._view is None or self.received + size > self.header["length"]:
+			return None
+		return self._view[self.received:self.received + size]
+
+	def advance(self, size: int):
+		self.stats.wire_bytes += size
+		if self._digest is not None:
+			self._digest.update(self._view[self.received:self.received + size])
+		self.received += size
+
+	def write(self, data: memoryview):
+		self.stats.wire_bytes += len(data)
+		self._write(data if self._decompressor is None else self._decompressor.decompress(data))
+
+	def finish(self) -> TransferStats:
+		if self._decompressor is not None:
+			self._write(self._decompressor.flush())
+		self.close()
+		if self.received != self.header["length"]:
+			raise RuntimeError(f"File receive error. Expected {self.header['length']} bytes, received {self.received} bytes.")
+		if self._digest is not None and self._digest.hexdigest() != self.header["digest"]:
+			raise RuntimeError(f"File receive error. Checksum mismatch for '{self.header['dest_path']}'.")
+		return self.stats.finish()
+
+	def close(self):
+		if self._mapped is not None:
+			self._view.release()
+			self._mapped.close()
+			self._mapped = None
+		self._file.close()
+
+	def _write(self, data: bytes | memoryview):
+		if self._mapped is not None:
+			self._view[self.received:self.received + len(data)] = data
+		else:
+			self._file.write(data)
+		if self._digest is not None:
+			self._digest.update(data)
+		self.received += len(data)
+
 
 class Socket:
 	def __init__(self, sock: socket.socket = None):
@@ -18,6 +284,51 @@ class Socket:
 			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		else:
 			self.sock = sock
+		self.pool = BufferPool()
+		self._send_lock = PriorityLock()
+		self.scheduler = default_scheduler
+		self._cmd_out = bytearray(BUFFER_CMD)
+		self._cmd_in = bytearray(BUFFER_CMD)
+		self._cmd_out_view = memoryview(self._cmd_out)
+		self._cmd_in_view = memoryview(self._cmd_in)
+		self._frame_out = bytearray(FRAME_HEADER.size + FRAME_INLINE)
+		self._frame_in = bytearray(FRAME_HEADER.size)
+		self._frame_out_view = memoryview(self._frame_out)
+		self._frame_in_view = memoryview(self._frame_in)
+		self._pending = deque()
+		self._recv_lock = threading.RLock()
+		self._replies: dict[str, deque] = {}
+		self._reply_cond = threading.Condition()
+		self._batch_out = bytearray()
+		self._batch_depth = 0
+		self._batch_more = False
+		self._in_view: memoryview | None = None
+		self._in_start = 0
+		self._in_end = 0
+		self.protocol = PROTOCOL_LEGACY
+		self.cache: ContentCache | None = None
+		self.outbound_max = OUTBOUND_MAX
+		self.send_timeout = OUTBOUND_TIMEOUT
+		self.slow_policy = SLOW_DROP
+		self.outbound_bytes = 0
+		self.evicting = False
+		self.on_backlog = None
+		self._outbound: deque[list] = deque()
+		self._outbound_lock = threading.Lock()
+		self._outbound_progress = 0.0
+		self._outbound_partial = False
+		self._draining = False
+		self._transfer_lock = threading.RLock()
+		self.heartbeat = Heartbeat()
+		self.last_received = 0.0
+		self.on_received = None
+		self.on_call = None
+		self._calls: dict[str, tuple[Future, float, float | None]] = {}
+		self._call_ids = itertools.count(1)
+		self._calls_lock = threading.Lock()
+		self._channels: dict[int, ChannelSink | None] = {}
+		self._next_channel = 0
+		self._chunk_out = bytearray(FRAME_HEADER.size + _CHANNEL.size)
 		
 	def __repr__(self) -> str:
 		return str(self)
@@ -27,6 +338,29 @@ class Socket:
 	
 	def close(self):
 		self.sock.close()
+		self._fail_calls(ConnectionError("Connection closed."))
+
+	def reset(self):
+		with self._outbound_lock:
+			self._outbound.clear()
+			self.outbound_bytes = 0
+			self._outbound_partial = False
+		with self._reply_cond:
+			self._replies.clear()
+		self._fail_calls(ConnectionError("Connection reset."))
+		self._pending.clear()
+		self._batch_out.clear()
+		self._in_view = None
+		self._in_start = 0
+		self._in_end = 0
+		self.protocol = PROTOCOL_LEGACY
+		self.evicting = False
+		self.heartbeat = Heartbeat()
+		self.last_received = 0.0
+		for sink in self._channels.values():
+			if sink is not None:
+				sink.close()
+		self._channels.clear()
 	
 	def is_closed(self) -> bool:
 		return self.sock._closed
@@ -37,116 +371,1223 @@ class Socket:
 	def get_rlink(self) -> str:
 		return f"{self.sock.getpeername()[0]}:{self.sock.getpeername()[1]}"
 
-	def send(self, data: bytes, length: int, buffer_size: int = -1):
+	def set_nodelay(self, enabled: bool = True):
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if enabled else 0)
+
+	@contextmanager
+	def batch(self, more: bool = False):
+		with self._send_lock:
+			self._batch_depth += 1
+			try:
+				yield self
+			finally:
+				self._batch_depth -= 1
+				if self._batch_depth == 0:
+					self.flush(more)
+
+	def flush(self, more: bool = False):
+		with self._send_lock:
+			if not self._batch_out:
+				return
+			try:
+				with memoryview(self._batch_out) as pending:
+					self._send_vectored((pending,), _SEND_MORE if more else 0)
+			finally:
+				self._batch_out.clear()
+
+	def send_vectored(self, *buffers: bytes | bytearray | memoryview):
+		with self._send_lock:
+			if self._batch_depth:
+				for buffer in buffers:
+					self.send(buffer, len(buffer))
+				return
+			self._send_vectored(buffers)
+
+	def _send_vectored(self, buffers, flags: int = 0):
+		if self._outbound_partial:
+			self.drain_outbound(True, True)
+		views = [memoryview(buffer).cast("B") for buffer in buffers if len(buffer)]
+		try:
+			if not hasattr(self.sock, "sendmsg"):
+				for view in views:
+					self.sock.sendall(view)
+				return
+			index = 0
+			while index < len(views):
+				sent = self.sock.sendmsg(views[index:index + _IOV_MAX], (), flags)
+				if sent == 0:
+					raise RuntimeError("Socket connection broken.")
+				while index < len(views) and sent >= len(views[index]):
+					sent -= len(views[index])
+					index += 1
+				if sent:
+					views[index] = views[index][sent:]
+		finally:
+			for view in views:
+				view.release()
+
+	def send(self, data: bytes | bytearray | memoryview, length: int, buffer_size: int = -1):
 		if buffer_size == -1:
 			buffer_size = length
-		totalsent = 0
-		while totalsent < length:
-			sent = self.sock.send(data[totalsent:totalsent + buffer_size])
-#			logger.log(f"  *** Sent {sent} bytes ***")
-			if sent == 0:
-				raise RuntimeError(f"Socket connection broken. Total sent: {totalsent} bytes.")
-			totalsent = totalsent + sent
-
-	def receive(self, length: int, buffer_size: int = -1):
+		with memoryview(data) as view:
+			if self._batch_depth:
+				if length <= BATCH_INLINE:
+					self._batch_out += view[:length]
+					if len(self._batch_out) >= BATCH_INLINE:
+						self.flush()
+				else:
+					try:
+						with memoryview(self._batch_out) as pending:
+							self._send_vectored((pending, view[:length]))
+					finally:
+						self._batch_out.clear()
+				return
+			if self._outbound_partial:
+				self.drain_outbound(True, True)
+			totalsent = 0
+			while totalsent < length:
+				size = min(length - totalsent, buffer_size)
+				self.sock.sendall(view[totalsent:totalsent + size])
+				totalsent += size
+
+	def post_cmd(self, cmd: str, done=None) -> bool:
+		data = cmd.encode("utf-8")
+		if self.protocol >= PROTOCOL_FRAMED:
+			return self.post(FRAME_HEADER.pack(FRAME_CMD, 0, len(data)) + data, done)
+		if len(data) > BUFFER_CMD:
+			raise ValueError(f"Command too long for the legacy protocol ({len(data)} > {BUFFER_CMD} bytes).")
+		return self.post(data.ljust(BUFFER_CMD, b"\0"), done)
+
+	def post(self, data: bytes, done=None) -> bool:
+		"""
+		Queues `data` and writes what the socket takes right away; the rest is
+		written when the event loop sees it writable, or by a writer thread.
+		Never waits for the send lock and never lands inside a file body.
+		`done()` runs once `data` is written. Returns False, dropping it, if the
+		queue is full; with `SLOW_EVICT` the socket is then marked for eviction.
+		"""
+		with self._outbound_lock:
+			if self._outbound and self.outbound_bytes + len(data) > self.outbound_max:
+				if self.slow_policy == SLOW_EVICT:
+					self.evicting = True
+				full = True
+			else:
+				if not self._outbound:
+					self._outbound_progress = time.monotonic()
+				self._outbound.append([memoryview(data), done])
+				self.outbound_bytes += len(data)
+				full = False
+		if full:
+			if self.evicting and self.on_backlog is not None:
+				self.on_backlog(self)
+			return False
+		if self.drain_outbound():
+			return True
+		if self.on_backlog is None:
+			self._drain_later()
+		else:
+			self.on_backlog(self)
+		return True
+
+	def _drain_later(self):
+		with self._outbound_lock:
+			if self._draining:
+				return
+			self._draining = True
+		threading.Thread(target=self._drain_queued, name="outbound", daemon=True).start()
+
+	def _drain_queued(self):
+		try:
+			while True:
+				self.drain_outbound(True)
+				with self._outbound_lock:
+					if not self._outbound:
+						self._draining = False
+						return
+		except OSError:
+			with self._outbound_lock:
+				self._draining = False
+
+	def drain_outbound(self, block: bool = False, head_only: bool = False) -> bool:
+		if not self._send_lock.acquire(blocking=block, priority=PRIORITY_MESSAGE):
+			return False
+		try:
+			while True:
+				with self._outbound_lock:
+					if not self._outbound:
+						return True
+					entry = self._outbound[0]
+				try:
+					sent = self.sock.send(entry[0], 0 if block else socket.MSG_DONTWAIT)
+				except BlockingIOError:
+					return False
+				self._outbound_progress = time.monotonic()
+				with self._outbound_lock:
+					self.outbound_bytes -= sent
+					if sent < len(entry[0]):
+						entry[0] = entry[0][sent:]
+						self._outbound_partial = True
+						continue
+					self._outbound.popleft()
+					self._outbound_partial = False
+				if entry[1] is not None:
+					entry[1]()
+				if head_only:
+					return not self._outbound
+		finally:
+			self._send_lock.release()
+
+	def outbound_stalled(self) -> float:
+		"""
+		Time spent behind a direct send (a file transfer) does not count.
+		"""
+		if not self._outbound:
+			return 0.0
+		if not self._send_lock.acquire(blocking=False):
+			self._outbound_progress = time.monotonic()
+			return 0.0
+		self._send_lock.release()
+		return time.monotonic() - self._outbound_progress
+
+	def trim(self):
+		if self._recv_lock.acquire(blocking=False):
+			try:
+				if not self.has_buffered():
+					self._in_view = None
+			finally:
+				self._recv_lock.release()
+		self.pool.clear()
+
+	def has_buffered(self) -> bool:
+		return self._in_start < self._in_end
+
+	def receive_some(self, view: memoryview, length: int, flags: int = 0) -> int:
+		available = self._in_end - self._in_start
+		if available == 0 and length < READ_AHEAD:
+			if self._in_view is None:
+				self._in_view = memoryview(bytearray(READ_AHEAD))
+			available = self.sock.recv_into(self._in_view, READ_AHEAD)
+			self.last_received = time.monotonic()
+			self._in_start = 0
+			self._in_end = available
+		if available == 0:
+			size = self.sock.recv_into(view, length, flags)
+			self.last_received = time.monotonic()
+			return size
+		size = min(available, length)
+		view[:size] = self._in_view[self._in_start:self._in_start + size]
+		self._in_start += size
+		return size
+
+	def receive_into(self, view: memoryview, length: int, buffer_size: int = -1):
 		if buffer_size == -1:
 			buffer_size = length
-		chunks = []
 		bytes_recd = 0
 		while bytes_recd < length:
-			chunk = self.sock.recv(min(length - bytes_recd, buffer_size))
-			if chunk == b'':
+			size = self.receive_some(view[bytes_recd:], min(length - bytes_recd, buffer_size), _RECV_FLAGS)
+			if size == 0:
 				raise RuntimeError(f"Socket connection broken. Total received: {bytes_recd} bytes.")
-			chunks.append(chunk)
-			bytes_recd = bytes_recd + len(chunk)
-		return b''.join(chunks)
+			bytes_recd += size
+
+	def receive(self, length: int, buffer_size: int = -1) -> bytes:
+		buffer = self.pool.acquire(length)
+		try:
+			with memoryview(buffer) as view:
+				self.receive_into(view, length, buffer_size)
+				return bytes(view[:length])
+		finally:
+			self.pool.release(buffer)
+
+	def send_frame(self, frame_type: int, payload: bytes | bytearray | memoryview, flags: int = 0):
+		length = len(payload)
+		with self._send_lock.hold(_FRAME_PRIORITY.get(frame_type, PRIORITY_CONTROL)):
+			FRAME_HEADER.pack_into(self._frame_out, 0, frame_type, flags, length)
+			if length <= FRAME_INLINE:
+				self._frame_out_view[FRAME_HEADER.size:FRAME_HEADER.size + length] = payload
+				self.send(self._frame_out_view, FRAME_HEADER.size + length)
+			else:
+				with self.batch():
+					self.send(self._frame_out_view, FRAME_HEADER.size)
+					self.send(payload, length)
+
+	def receive_frame(self, *expected: int, block: bool = True) -> tuple[int, int, int] | None:
+		"""
+		Reads the next frame of an `expected` type. Replies, heartbeats and
+		channel frames are handled on the way, and commands are queued for
+		`receive_cmd`; without `block`, returns None when only those were ready.
+		"""
+		with self._recv_lock:
+			while True:
+				self.receive_into(self._frame_in_view, FRAME_HEADER.size)
+				frame_type, flags, length = FRAME_HEADER.unpack_from(self._frame_in)
+				if frame_type == FRAME_REPLY and FRAME_REPLY not in expected:
+					self._route_reply(length)
+				elif frame_type == FRAME_PING:
+					self.post(FRAME_HEADER.pack(FRAME_PONG, 0, length) + self.receive(length))
+				elif frame_type == FRAME_PONG:
+					self.heartbeat.answered(_BEAT.unpack(self.receive(length))[0])
+				elif frame_type == FRAME_CALL:
+					self._receive_call(length)
+				elif frame_type == FRAME_OPEN:
+					self._open_channel(json.loads(self._receive_str(length, "utf-8")))
+				elif frame_type == FRAME_CHUNK:
+					self._receive_chunk(flags, length)
+				elif frame_type == FRAME_CMD and expected and FRAME_CMD not in expected:
+					self._pending.append(self._receive_str(length, "utf-8"))
+				elif expected and frame_type not in expected:
+					raise RuntimeError(f"Unexpected frame type {frame_type} (expected {expected}).")
+				else:
+					return frame_type, flags, length
+				if not block and not self.has_buffered() and not _readable(self.sock, 0):
+					return None
+
+	def ping(self) -> bool:
+		if self.protocol < PROTOCOL_FRAMED:
+			return False
+		sequence = self.heartbeat.next()
+		if sequence is None:
+			return False
+		if not self.post(FRAME_HEADER.pack(FRAME_PING, 0, _BEAT.size) + _BEAT.pack(sequence),
+				lambda: self.heartbeat.written(sequence)):
+			self.heartbeat.forget(sequence)
+			return False
+		return True
+
+	def send_reply(self, token: str, **fields):
+		fields["token"] = token
+		self.send_frame(FRAME_REPLY, json.dumps(fields).encode("utf-8"))
+
+	def post_reply(self, token: str, **fields):
+		"""
+		Like `send_reply`, but never waits for the send lock.
+		"""
+		fields["token"] = token
+		data = json.dumps(fields).encode("utf-8")
+		self.post(FRAME_HEADER.pack(FRAME_REPLY, 0, len(data)) + data)
+
+	def _has_reply(self, token: str) -> bool:
+		with self._reply_cond:
+			return token in self._replies
+
+	def _route_reply(self, length: int):
+		reply = json.loads(self._receive_str(length, "utf-8"))
+		if self._answer_call(reply):
+			return
+		with self._reply_cond:
+			replies = self._replies.get(reply["token"])
+			if replies is None:
+				replies = self._replies[reply["token"]] = deque()
+			replies.append(reply)
+			self._reply_cond.notify_all()
+
+	def wait_reply(self, token: str, timeout: float | None = REPLY_TIMEOUT) -> dict:
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while True:
+			with self._reply_cond:
+				replies = self._replies.get(token)
+				if replies:
+					reply = replies.popleft()
+					if not replies:
+						del self._replies[token]
+					return reply
+			remaining = REPLY_POLL if deadline is None else min(deadline - time.monotonic(), REPLY_POLL)
+			if remaining <= 0:
+				raise TimeoutError(f"No reply received for '{token}'.")
+			if self._recv_lock.acquire(blocking=False):
+				try:
+					if self.has_buffered() or _readable(self.sock, remaining):
+						frame_type, _, length = self.receive_frame(FRAME_REPLY, FRAME_CMD)
+						if frame_type == FRAME_REPLY:
+							self._route_reply(length)
+						else:
+							self._pending.append(self._receive_str(length, "utf-8"))
+				finally:
+					self._recv_lock.release()
+			else:
+				with self._reply_cond:
+					if token not in self._replies:
+						self._reply_cond.wait(remaining)
+
+	def call(self, cmd: str, timeout: float | None = CALL_TIMEOUT) -> Future:
+		"""
+		Runs `cmd` on the peer and returns a future for its reply: `found`,
+		`result`, `error`, `elapsed` and `latency`. Calls are pipelined; one
+		unanswered after `timeout` fails with TimeoutError on the next call.
+		"""
+		if self.protocol < PROTOCOL_CALLS:
+			raise RuntimeError(f"Peer cannot answer calls (protocol {self.protocol}).")
+		future = Future()
+		token = f"call-{next(self._call_ids)}"
+		now = time.monotonic()
+		self.expire_calls(now)
+		with self._calls_lock:
+			self._calls[token] = (future, now, None if timeout is None else now + timeout)
+		data = json.dumps({"token": token, "cmd": cmd}).encode("utf-8")
+		if not self.post(FRAME_HEADER.pack(FRAME_CALL, 0, len(data)) + data):
+			self._fail_call(token, RuntimeError("Outbound queue full."))
+		return future
+
+	def expire_calls(self, now: float | None = None):
+		if now is None:
+			now = time.monotonic()
+		with self._calls_lock:
+			expired = [token for token, (_, _, deadline) in self._calls.items() if deadline is not None and deadline <= now]
+		for token in expired:
+			self._fail_call(token, TimeoutError(f"No reply received for '{token}'."))
+
+	def _receive_call(self, length: int):
+		request = json.loads(self._receive_str(length, "utf-8"))
+		if self.on_call is None:
+			self.post_reply(request["token"], found=False, result=None, error="Calls are not supported.", elapsed=0.0)
+			return
+		self.on_call(self, request["token"], request["cmd"])
+
+	def _answer_call(self, reply: dict) -> bool:
+		with self._calls_lock:
+			call = self._calls.pop(reply["token"], None)
+		if call is None:
+			return False
+		reply["latency"] = time.monotonic() - call[1]
+		try:
+			call[0].set_result(reply)
+		except InvalidStateError:
+			pass
+		return True
+
+	def _fail_call(self, token: str, error: Exception):
+		with self._calls_lock:
+			call = self._calls.pop(token, None)
+		if call is None:
+			return
+		try:
+			call[0].set_exception(error)
+		except InvalidStateError:
+			pass
+
+	def _fail_calls(self, error: Exception):
+		with self._calls_lock:
+			tokens = list(self._calls)
+		for token in tokens:
+			self._fail_call(token, error)
 
 	def send_cmd(self, cmd: str, buffer_size: int = BUFFER_CMD):
 		data = cmd.encode("utf-8")
+		if self.protocol >= PROTOCOL_FRAMED:
+			self.send_frame(FRAME_CMD, data)
+			return
 		length = len(data)
-		if length < BUFFER_CMD:
-			data += b'\0' * (BUFFER_CMD - length)
-		self.send(data, BUFFER_CMD, buffer_size)
+		if length > BUFFER_CMD:
+			raise ValueError(f"Command too long for the legacy protocol ({length} > {BUFFER_CMD} bytes).")
+		with self._send_lock:
+			self._cmd_out_view[:length] = data
+			self._cmd_out_view[length:] = _ZEROS[length:]
+			self.send(self._cmd_out_view, BUFFER_CMD, buffer_size)
 	
 	def receive_cmd(self, buffer_size: int = BUFFER_CMD) -> str:
-		data = self.receive(BUFFER_CMD, buffer_size)
-		return data.decode("utf-8").rstrip('\0')
+		with self._recv_lock:
+			if self._pending:
+				return self._pending.popleft()
+			if self.protocol >= PROTOCOL_FRAMED:
+				_, _, length = self.receive_frame(FRAME_CMD)
+				return self._receive_str(length, "utf-8", buffer_size)
+			self.receive_into(self._cmd_in_view, BUFFER_CMD, buffer_size)
+			end = self._cmd_in.find(0)
+			return str(self._cmd_in_view[:BUFFER_CMD if end == -1 else end], "utf-8")
+
+	def poll_cmd(self) -> str | None:
+		with self._recv_lock:
+			if self._pending:
+				return self._pending.popleft()
+			if not self.has_buffered() and not _readable(self.sock, 0):
+				return None
+			if self.protocol < PROTOCOL_FRAMED:
+				return self.receive_cmd()
+			frame = self.receive_frame(FRAME_CMD, FRAME_REPLY, block=False)
+			if frame is None:
+				return None
+			if frame[0] == FRAME_REPLY:
+				self._route_reply(frame[2])
+				return None
+			return self._receive_str(frame[2], "utf-8")
 	
 	def send_msg(self, msg: str, encoding: str = "utf-8", buffer_size: int = BUFFER_1KB):
 		data = msg.encode(encoding)
 		length = len(data)
-		self.send_cmd(f"length={length}")
-		self.send_cmd(f"encoding={encoding}")
-		self.send(data, length, buffer_size)
+		if self.protocol >= PROTOCOL_FRAMED:
+			if encoding.lower() in ("utf-8", "utf8"):
+				self.send_frame(FRAME_MSG, data)
+			else:
+				name = encoding.encode("ascii")
+				self.send_frame(FRAME_MSG, bytes((len(name),)) + name + data, FRAME_FLAG_ENCODING)
+			return
+		with self.batch():
+			self.send_cmd(f"length={length}")
+			self.send_cmd(f"encoding={encoding}")
+			self.send(data, length, buffer_size)
 
 	def receive_msg(self, buffer_size: int = BUFFER_1KB) -> str:
-		length = int(self.receive_cmd().removeprefix("length="))
-		encoding = self.receive_cmd().removeprefix("encoding=")
-		data = self.receive(length, buffer_size)
-		return data.decode(encoding)
+		with self._recv_lock:
+			if self.protocol >= PROTOCOL_FRAMED:
+				_, flags, length = self.receive_frame(FRAME_MSG)
+				encoding = "utf-8"
+				if flags & FRAME_FLAG_ENCODING:
+					name_length = self.receive(1)[0]
+					encoding = self.receive(name_length).decode("ascii")
+					length -= 1 + name_length
+				return self._receive_str(length, encoding, buffer_size)
+			length = int(self.receive_cmd().removeprefix("length="))
+			encoding = self.receive_cmd().removeprefix("encoding=")
+			return self._receive_str(length, encoding, buffer_size)
 
-	def send_file(self, file_path: str, dest_path: str, buffer_size: int = BUFFER_1MB):
-		self.send_cmd(f"dest_path={dest_path}", BUFFER_1KB)
-		length = 0
-		with open(file_path, "rb") as file:
+	def _receive_str(self, length: int, encoding: str, buffer_size: int = -1) -> str:
+		buffer = self.pool.acquire(length)
+		try:
+			with memoryview(buffer) as view:
+				self.receive_into(view, length, buffer_size)
+				return str(view[:length], encoding)
+		finally:
+			self.pool.release(buffer)
+
+	def negotiate(self, timeout: float = 2.0) -> int:
+		self.send_cmd(f"protocol {PROTOCOL_VERSION}")
+		previous = self.sock.gettimeout()
+		pending, self._pending = self._pending, deque()
+		self.sock.settimeout(timeout)
+		try:
 			while True:
-				data = file.read(buffer_size)
-				if not data:
+				cmd = self.receive_cmd()
+				if cmd.startswith("protocol "):
+					self.protocol = int(cmd.removeprefix("protocol "))
 					break
-				length += len(data)
-		self.send_cmd(f"length={length}")
+				pending.append(cmd)
+		except socket.timeout:
+			pass
+		finally:
+			self.sock.settimeout(previous)
+			self._pending = pending
+		return self.protocol
+
+	def handle_negotiation(self, cmd: str) -> bool:
+		if not cmd.startswith("protocol "):
+			return False
+		try:
+			version = min(int(cmd.removeprefix("protocol ")), PROTOCOL_VERSION)
+		except ValueError:
+			version = PROTOCOL_LEGACY
+		with self._send_lock:
+			self.send_cmd(f"protocol {version}")
+			self.protocol = version
+		return True
+
+	def _send_file_header(self, header: dict):
+		if self.protocol >= PROTOCOL_FRAMED:
+			self.send_frame(FRAME_FILE, json.dumps(header).encode("utf-8"))
+		else:
+			self.send_cmd(f"dest_path={header['dest_path']}", BUFFER_1KB)
+			self.send_cmd(f"length={header['length']}")
+
+	def _receive_file_header(self) -> dict:
+		if self.protocol >= PROTOCOL_FRAMED:
+			_, _, length = self.receive_frame(FRAME_FILE)
+			return json.loads(self._receive_str(length, "utf-8"))
+		dest_path = self.receive_cmd(BUFFER_1KB).removeprefix("dest_path=")
+		length = int(self.receive_cmd().removeprefix("length="))
+		return {"dest_path": dest_path, "length": length}
+
+	def send_file(self, file_path: str, dest_path: str, buffer_size: int = BUFFER_1MB, zero_copy: bool = True,
+				  compression: str | None = None, mode: str = TRANSFER_PLAIN, streams: int = 1,
+				  offer: bool = True, announce: str | None = None) -> TransferStats:
+		"""
+		Plain transfers to peers with channels are multiplexed, and the
+		connection stays usable meanwhile. The others need the peer in
+		`receive_file` (`announce` is sent first to get it there) and hold the
+		send lock for raw bodies: plain ones without channels, resumed ones
+		before `PROTOCOL_DATA_FRAMES`, and whole transfers to legacy peers.
+		"""
+		with open(file_path, "rb") as file:
+			length = os.fstat(file.fileno()).st_size
+			with self.scheduler.track(self, dest_path, length) as transfer:
+				if self.protocol >= PROTOCOL_CHANNELS and mode == TRANSFER_PLAIN:
+					return self._send_file_channel(file, file_path, dest_path, length, buffer_size, zero_copy, compression, streams, offer, transfer)
+				held = self._send_lock.hold(PRIORITY_BULK) if self.protocol < PROTOCOL_FRAMED else nullcontext()
+				with self._transfer_lock, held:
+					if announce is not None:
+						self.send_cmd(announce)
+					return self._send_file_held(file, file_path, dest_path, length, buffer_size, zero_copy, compression, mode, streams, offer, transfer)
+
+	def _send_file_held(self, file, file_path: str, dest_path: str, length: int, buffer_size: int, zero_copy: bool,
+						compression: str | None, mode: str, streams: int, offer: bool, transfer: Transfer) -> TransferStats:
+		header = {"dest_path": dest_path, "length": length}
+		if self.protocol < PROTOCOL_FRAMED:
+			mode = TRANSFER_PLAIN
+			streams = 1
+		elif offer and length >= CACHE_OFFER_MIN and self._offer_file(file_path, header):
+			stats = TransferStats(COMPRESSION_NONE, TRANSFER_CACHED)
+			stats.raw_bytes = length
+			return stats.finish()
+		if mode != TRANSFER_PLAIN:
+			header["mode"] = mode
+			header["token"] = secrets.token_hex(8)
+			stats = TransferStats(COMPRESSION_NONE, mode)
+			stats.raw_bytes = length
+			if mode in (TRANSFER_RESUME, TRANSFER_CONTINUE):
+				stats.wire_bytes = self._send_file_resume(file, file_path, header, buffer_size, zero_copy, transfer)
+			elif mode == TRANSFER_DELTA:
+				stats.wire_bytes = self._send_file_delta(file, header, transfer)
+			else:
+				raise ValueError(f"Unknown transfer mode '{mode}'.")
+			return stats.finish()
+		codec = COMPRESSION_NONE
+		if self.protocol >= PROTOCOL_FRAMED:
+			codec = choose_codec(file, file_path, compression)
+		if codec != COMPRESSION_NONE:
+			header["compression"] = codec
+		stats = TransferStats(codec)
+		stats.raw_bytes = length
+		if codec != COMPRESSION_NONE:
+			self._send_file_header(header)
+			stats.wire_bytes = self._send_file_compressed(file, length, codec, buffer_size, transfer)
+			return stats.finish()
+		stats.streams = min(max(streams, 1), STREAMS_MAX)
+		if stats.streams > 1:
+			header["streams"] = stats.streams
+			header["token"] = secrets.token_hex(8)
+			self._send_file_header(header)
+			self._send_file_parallel(file_path, header, buffer_size, transfer)
+			stats.wire_bytes = length
+			return stats.finish()
+		with self._send_lock.hold(PRIORITY_BULK):
+			with self.batch(more=length > 0):
+				self._send_file_header(header)
+			self._send_file_raw(file, 0, length, buffer_size, zero_copy, transfer)
+		stats.wire_bytes = length
+		return stats.finish()
+
+	def _offer_file(self, file_path: str, header: dict) -> bool:
+		token = secrets.token_hex(8)
+		self._send_file_header({**header, "digest": cached_digest(file_path), "token": token, "offer": True})
+		return self.wait_reply(token)["hit"]
+
+	def _send_file_channel(self, file, file_path: str, dest_path: str, length: int, buffer_size: int, zero_copy: bool,
+						   compression: str | None, streams: int, offer: bool, transfer: Transfer) -> TransferStats:
+		codec = choose_codec(file, file_path, compression)
+		stats = TransferStats(codec)
+		stats.raw_bytes = length
+		with self._send_lock:
+			self._next_channel += 1
+			header = {"dest_path": dest_path, "length": length, "channel": self._next_channel, "token": secrets.token_hex(8)}
+		if codec != COMPRESSION_NONE:
+			header["compression"] = codec
+		else:
+			stats.streams = min(max(streams, 1), STREAMS_MAX)
+		if stats.streams > 1:
+			header["streams"] = stats.streams
+		if offer and length >= CACHE_OFFER_MIN:
+			header["offer"] = True
+			header["digest"] = cached_digest(file_path)
+		self.send_frame(FRAME_OPEN, json.dumps(header).encode("utf-8"))
+		if header.get("offer") and self.wait_reply(header["token"])["hit"]:
+			stats.mode = TRANSFER_CACHED
+			return stats.finish()
+		if stats.streams > 1:
+			self._send_file_parallel(file_path, header, buffer_size, transfer)
+			stats.wire_bytes = length
+			return stats.finish()
+		stats.wire_bytes = self._send_chunks(file, header, codec, buffer_size, zero_copy, transfer)
+		reply = self.wait_reply(header["token"])
+		if not reply["ok"]:
+			raise RuntimeError(f"File transfer error. {reply['error']}")
+		return stats.finish()
+
+	def _send_chunks(self, file, header: dict, codec: str, buffer_size: int, zero_copy: bool, transfer: Transfer) -> int:
+		"""
+		Takes the send lock one chunk at a time, so that other frames get in
+		between. Stops early if the peer has already answered (it failed).
+		"""
+		channel = header["channel"]
+		length = header["length"]
+		compressor = None if codec == COMPRESSION_NONE else make_compressor(codec)
+		buffer = None if compressor is None else self.pool.acquire(CHANNEL_CHUNK)
 		sent = 0
+		wire = 0
+		try:
+			while sent < length and not self._has_reply(header["token"]):
+				size = min(length - sent, CHANNEL_CHUNK, transfer.quantum)
+				if compressor is None:
+					transfer.advance(size)
+					with self._send_lock.hold(PRIORITY_BULK):
+						self.drain_outbound()
+						FRAME_HEADER.pack_into(self._chunk_out, 0, FRAME_CHUNK, 0, _CHANNEL.size + size)
+						_CHANNEL.pack_into(self._chunk_out, FRAME_HEADER.size, channel)
+						self._send_vectored((self._chunk_out,), _SEND_MORE)
+						self._send_file_raw(file, sent, sent + size, buffer_size, zero_copy)
+					wire += size
+				else:
+					with memoryview(buffer) as view:
+						size = file.readinto(view[:size])
+						if not size:
+							self._send_chunk(channel, b"", FRAME_FLAG_ABORT)
+							raise RuntimeError(f"File reading error. Total sent: {sent} bytes.")
+						data = compressor.compress(view[:size])
+					transfer.advance(len(data), size)
+					if data:
+						self._send_chunk(channel, data)
+						wire += len(data)
+				sent += size
+		finally:
+			if buffer is not None:
+				self.pool.release(buffer)
+		if sent < length:
+			self._send_chunk(channel, b"", FRAME_FLAG_ABORT)
+			return wire
+		data = b"" if compressor is None else compressor.flush()
+		transfer.advance(len(data), 0)
+		self._send_chunk(channel, data, FRAME_FLAG_END)
+		return wire + len(data)
+
+	def _send_chunk(self, channel: int, data: bytes, flags: int = 0):
+		with self._send_lock.hold(PRIORITY_BULK):
+			self.drain_outbound()
+			FRAME_HEADER.pack_into(self._chunk_out, 0, FRAME_CHUNK, flags, _CHANNEL.size + len(data))
+			_CHANNEL.pack_into(self._chunk_out, FRAME_HEADER.size, channel)
+			self._send_vectored((self._chunk_out, data))
+
+	def _send_file_raw(self, file, offset: int, length: int, buffer_size: int, zero_copy: bool, transfer: Transfer | None = None):
+		sent = offset
+		if self._outbound_partial:
+			self.drain_outbound(True, True)
+		if zero_copy:
+			position = file.tell()
+			try:
+				while sent < length:
+					size = length - sent
+					if transfer is not None:
+						size = min(size, transfer.quantum)
+						transfer.advance(size)
+					count = self.sock.sendfile(file, sent, size)
+					sent += count
+					if count < size:
+						break
+			except (OSError, ValueError) as e:
+				if file.tell() != position:
+					raise e
+		if sent != length:
+			file.seek(sent)
+			self._send_file_chunked(file, length, sent, buffer_size, transfer)
+
+	def _send_file_parallel(self, file_path: str, header: dict, buffer_size: int, transfer: Transfer):
+		token = header["token"]
+		ranges = split_ranges(header["length"], header["streams"])
+		streams = self.open_streams(token, header["streams"])
+		digests = [None] * len(streams)
+		try:
+			_run_streams(self._send_range, streams, ranges, digests, file_path, buffer_size, transfer)
+		finally:
+			for stream in streams:
+				Socket.close(stream)
+		self.send_reply(token, digests=digests)
+		if not self.wait_reply(token).get("ok"):
+			raise RuntimeError(f"File transfer error. Checksum mismatch for '{header['dest_path']}'.")
+
+	@staticmethod
+	def _send_range(stream: "Socket", offset: int, count: int, file_path: str, buffer_size: int, transfer: Transfer) -> str:
+		digest = hashlib.blake2b()
 		with open(file_path, "rb") as file:
-			while sent < length:
-				data = file.read(buffer_size)
-				if not data:
-					raise RuntimeError(f"File reading error. Total sent: {sent} bytes.")
-				self.send(data, len(data))
-				sent += len(data)
+			with stream.batch(more=count > 0):
+				stream.send(_RANGE.pack(offset, count), _RANGE.size)
+			file.seek(offset)
+			stream._send_file_chunked(file, offset + count, offset, buffer_size, transfer, digest)
+		return digest.hexdigest()
+
+	def open_streams(self, token: str, count: int) -> list["Socket"]:
+		host, port = self.sock.getpeername()[:2]
+		streams = []
+		try:
+			for index in range(count):
+				stream = Socket()
+				stream.sock.connect((host, port))
+				stream.set_nodelay()
+				stream.receive_msg()
+				stream.send_cmd(f"attach {token} {index}")
+				streams.append(stream)
+		except Exception as e:
+			for stream in streams:
+				stream.close()
+			raise e
+		return streams
+
+	def _send_file_chunked(self, file, length: int, sent: int, buffer_size: int, transfer: Transfer | None = None, digest=None):
+		if transfer is not None:
+			buffer_size = min(buffer_size, transfer.quantum)
+		buffer = self.pool.acquire(buffer_size)
+		try:
+			with memoryview(buffer) as view:
+				while sent < length:
+					size = file.readinto(view[:min(length - sent, buffer_size)])
+					if not size:
+						raise RuntimeError(f"File reading error. Total sent: {sent} bytes.")
+					if transfer is not None:
+						transfer.advance(size)
+					if digest is not None:
+						digest.update(view[:size])
+					self.send(view, size)
+					sent += size
+		finally:
+			self.pool.release(buffer)
+
+	def _send_file_compressed(self, file, length: int, codec: str, buffer_size: int, transfer: Transfer) -> int:
+		compressor = make_compressor(codec)
+		wire = 0
+		sent = 0
+		buffer = self.pool.acquire(buffer_size)
+		try:
+			with memoryview(buffer) as view:
+				while sent < length:
+					size = file.readinto(view[:min(length - sent, buffer_size)])
+					if not size:
+						raise RuntimeError(f"File reading error. Total sent: {sent} bytes.")
+					chunk = compressor.compress(view[:size])
+					transfer.advance(len(chunk), size)
+					if chunk:
+						self.send_frame(FRAME_DATA, chunk)
+						wire += len(chunk)
+					sent += size
+		finally:
+			self.pool.release(buffer)
+		chunk = compressor.flush()
+		transfer.advance(len(chunk), 0)
+		self.send_frame(FRAME_DATA, chunk, FRAME_FLAG_END)
+		return wire + len(chunk)
+
+	def _send_file_resume(self, file, file_path: str, header: dict, buffer_size: int, zero_copy: bool, transfer: Transfer) -> int:
+		length = header["length"]
+		header["block_size"] = RESUME_BLOCK
+		self._send_file_header(header)
+		remote = self.wait_reply(header["token"])["blocks"]
+		local = block_hashes(file_path, RESUME_BLOCK, min(length, len(remote) * RESUME_BLOCK))
+		matched = 0
+		while matched < len(local) and local[matched] == remote[matched]:
+			matched += 1
+		offset = matched * RESUME_BLOCK
+		digest = file_digest(file_path)
+		transfer.sent = offset
+		if self.protocol >= PROTOCOL_DATA_FRAMES:
+			self.send_reply(header["token"], offset=offset, digest=digest)
+			self._send_data_frames(file, offset, length, buffer_size, zero_copy, transfer)
+			return length - offset
+		with self._send_lock.hold(PRIORITY_BULK):
+			with self.batch(more=offset < length):
+				self.send_reply(header["token"], offset=offset, digest=digest)
+			self._send_file_raw(file, offset, length, buffer_size, zero_copy, transfer)
+		return length - offset
+
+	def _send_data_frames(self, file, offset: int, length: int, buffer_size: int, zero_copy: bool, transfer: Transfer):
+		sent = offset
+		while sent < length:
+			size = min(length - sent, CHANNEL_CHUNK, transfer.quantum)
+			transfer.advance(size)
+			with self._send_lock.hold(PRIORITY_BULK):
+				self.drain_outbound()
+				self._send_vectored((FRAME_HEADER.pack(FRAME_DATA, 0, size),), _SEND_MORE)
+				self._send_file_raw(file, sent, sent + size, buffer_size, zero_copy)
+			sent += size
+		self.send_frame(FRAME_DATA, b"", FRAME_FLAG_END)
+
+	def _send_file_delta(self, file, header: dict, transfer: Transfer) -> int:
+		header["block_size"] = delta_block_size(header["length"])
+		self._send_file_header(header)
+		signatures = self.wait_reply(header["token"])["signatures"]
+		encoder = DeltaEncoder(file, header["block_size"], signatures)
+		wire = 0
+		for op in encoder.ops():
+			if isinstance(op, tuple):
+				transfer.advance(_COPY_RUN.size, op[1] * header["block_size"])
+				self.send_frame(FRAME_DATA, _COPY_RUN.pack(*op), FRAME_FLAG_COPY)
+				wire += _COPY_RUN.size
+			else:
+				transfer.advance(len(op))
+				self.send_frame(FRAME_DATA, op)
+				wire += len(op)
+		self.send_frame(FRAME_DATA, encoder.digest.hexdigest().encode("ascii"), FRAME_FLAG_END)
+		return wire
 	
-	def receive_file(self, buffer_size: int = BUFFER_1MB) -> tuple[str, int]:
-		dest_path = self.receive_cmd(BUFFER_1KB).removeprefix("dest_path=")
-		length = int(self.receive_cmd().removeprefix("length="))
+	def receive_file(self, buffer_size: int = BUFFER_1MB, use_mmap: bool | None = None) -> tuple[str, int, TransferStats]:
+		with self._recv_lock:
+			header = self._receive_file_header()
+			digest = None
+			if header.get("offer"):
+				digest = header["digest"]
+				hit = self.cache is not None and self.cache.fetch(digest, header["dest_path"], header["length"])
+				self.post_reply(header["token"], hit=hit)
+				if hit:
+					stats = TransferStats(COMPRESSION_NONE, TRANSFER_CACHED)
+					stats.raw_bytes = header["length"]
+					return header["dest_path"], header["length"], stats.finish()
+				header = self._receive_file_header()
+			dest_path = header["dest_path"]
+			length = header["length"]
+			stats = TransferStats(header.get("compression", COMPRESSION_NONE), header.get("mode", TRANSFER_PLAIN))
+			stats.raw_bytes = length
+			stats.wire_bytes = length
+			if self.cache is not None and stats.mode in (TRANSFER_PLAIN, TRANSFER_CONTINUE):
+				self.cache.detach(dest_path)
+			if use_mmap is None:
+				use_mmap = length >= MMAP_THRESHOLD
+			if stats.mode in (TRANSFER_RESUME, TRANSFER_CONTINUE):
+				stats.wire_bytes = self._receive_file_resume(header, buffer_size)
+			elif stats.mode == TRANSFER_DELTA:
+				stats.wire_bytes = self._receive_file_delta(header)
+			elif stats.codec != COMPRESSION_NONE:
+				stats.wire_bytes = self._receive_file_compressed(dest_path, length, stats.codec)
+			elif header.get("streams", 1) > 1:
+				stats.streams = header["streams"]
+				self._receive_file_parallel(header, buffer_size)
+			elif use_mmap and length > 0:
+				self._receive_file_mmap(dest_path, length, buffer_size)
+			else:
+				with open(dest_path, "wb") as file:
+					self._receive_into_file(file, length, buffer_size)
+			if self.cache is not None and digest is not None:
+				if file_digest(dest_path) != digest:
+					raise RuntimeError(f"File receive error. Checksum mismatch for '{dest_path}'.")
+				self.cache.store(dest_path, digest)
+			return dest_path, length, stats.finish()
+
+	def _open_channel(self, header: dict):
+		if header.get("offer"):
+			hit = self.cache is not None and self.cache.fetch(header["digest"], header["dest_path"], header["length"])
+			self.post_reply(header["token"], hit=hit)
+			if hit:
+				stats = TransferStats(COMPRESSION_NONE, TRANSFER_CACHED)
+				stats.raw_bytes = header["length"]
+				self._received(header, stats.finish())
+				return
+		if header.get("streams", 1) > 1:
+			threading.Thread(target=self._receive_channel_parallel, args=(header,), daemon=True).start()
+			return
+		try:
+			if self.cache is not None:
+				self.cache.detach(header["dest_path"])
+			self._channels[header["channel"]] = ChannelSink(header)
+		except OSError as e:
+			self._channels[header["channel"]] = None
+			self.post_reply(header["token"], ok=False, error=str(e))
+
+	def _receive_chunk(self, flags: int, length: int):
+		channel = _CHANNEL.unpack(self.receive(_CHANNEL.size))[0]
+		size = length - _CHANNEL.size
+		sink = self._channels.get(channel)
+		done = flags & (FRAME_FLAG_END | FRAME_FLAG_ABORT)
+		target = None if sink is None else sink.target(size)
+		buffer = self.pool.acquire(0 if target is not None else size)
+		try:
+			with memoryview(buffer) as view:
+				if target is not None:
+					with target:
+						self.receive_into(target, size)
+				else:
+					self.receive_into(view, size)
+				if sink is None:
+					if done:
+						self._channels.pop(channel, None)
+					return
+				try:
+					if target is not None:
+						sink.advance(size)
+					else:
+						sink.write(view[:size])
+					if flags & FRAME_FLAG_END:
+						del self._channels[channel]
+						self._received(sink.header, sink.finish())
+						self.post_reply(sink.header["token"], ok=True)
+				except Exception as e:
+					sink.close()
+					self._channels[channel] = None
+					self.post_reply(sink.header["token"], ok=False, error=str(e))
+				if done:
+					sink.close()
+					self._channels.pop(channel, None)
+		finally:
+			self.pool.release(buffer)
+
+	def _receive_channel_parallel(self, header: dict):
+		stats = TransferStats()
+		stats.raw_bytes = stats.wire_bytes = header["length"]
+		stats.streams = header["streams"]
+		try:
+			if self.cache is not None:
+				self.cache.detach(header["dest_path"])
+			self._receive_file_parallel(header, BUFFER_1MB)
+			self._received(header, stats.finish())
+		except Exception as e:
+			logger.log_exception(e, f"Receiving '{header['dest_path']}' failed.", print_stack_trace=False, before=[])
+
+	def _received(self, header: dict, stats: TransferStats):
+		if self.cache is not None and "digest" in header and stats.mode != TRANSFER_CACHED:
+			self.cache.store(header["dest_path"], header["digest"])
+		if self.on_received is not None:
+			self.on_received(self, header["dest_path"], stats)
+
+	def _receive_file_compressed(self, dest_path: str, length: int, codec: str) -> int:
+		decompressor = make_decompressor(codec)
 		received = 0
+		wire = 0
 		with open(dest_path, "wb") as file:
-			while received < length:
-				data = self.receive(min(length - received, buffer_size))
-				if not data:
-					raise RuntimeError(f"File receive error. Total received: {received} bytes.")
+			while True:
+				_, flags, size = self.receive_frame(FRAME_DATA)
+				buffer = self.pool.acquire(size)
+				try:
+					with memoryview(buffer) as view:
+						self.receive_into(view, size)
+						data = decompressor.decompress(view[:size])
+				finally:
+					self.pool.release(buffer)
 				file.write(data)
 				received += len(data)
-		return dest_path, length
+				wire += size
+				if flags & FRAME_FLAG_END:
+					break
+			data = decompressor.flush()
+			file.write(data)
+			received += len(data)
+		if received != length:
+			raise RuntimeError(f"File receive error. Expected {length} bytes, decompressed {received} bytes.")
+		return wire
+
+	def _receive_file_resume(self, header: dict, buffer_size: int) -> int:
+		dest_path = header["dest_path"]
+		length = header["length"]
+		part_path = dest_path + ".part"
+		if header["mode"] == TRANSFER_RESUME and not os.path.exists(part_path) and os.path.exists(dest_path):
+			# A broken plain transfer leaves no `.part`, only a short `dest_path`.
+			part_path = dest_path
+			if self.cache is not None:
+				self.cache.detach(dest_path)
+		elif header["mode"] == TRANSFER_CONTINUE:
+			part_path = dest_path
+		have = min(os.path.getsize(part_path), length) if os.path.exists(part_path) else 0
+		self.post_reply(header["token"], blocks=block_hashes(part_path, header["block_size"], have))
+		decision = self.wait_reply(header["token"])
+		offset = decision["offset"]
+		with open(part_path, "r+b" if os.path.exists(part_path) else "wb") as file:
+			file.truncate(offset)
+			file.seek(offset)
+			if self.protocol >= PROTOCOL_DATA_FRAMES:
+				self._receive_data_frames(file, length - offset)
+			else:
+				self._receive_into_file(file, length - offset, buffer_size)
+		if file_digest(part_path) != decision["digest"]:
+			os.remove(part_path)
+			raise RuntimeError(f"File receive error. Checksum mismatch for '{dest_path}'.")
+		os.replace(part_path, dest_path)
+		return length - offset
+
+	def _receive_file_delta(self, header: dict) -> int:
+		dest_path = header["dest_path"]
+		block_size = header["block_size"]
+		delta_path = dest_path + ".delta"
+		self.post_reply(header["token"], signatures=block_signatures(dest_path, block_size))
+		digest = hashlib.blake2b()
+		wire = 0
+		basis = open(dest_path, "rb") if os.path.exists(dest_path) else None
+		try:
+			with open(delta_path, "wb") as file:
+				while True:
+					_, flags, size = self.receive_frame(FRAME_DATA)
+					data = self.receive(size)
+					wire += size
+					if flags & FRAME_FLAG_END:
+						break
+					if flags & FRAME_FLAG_COPY:
+						index, count = _COPY_RUN.unpack(data)
+						basis.seek(index * block_size)
+						data = basis.read(count * block_size)
+					digest.update(data)
+					file.write(data)
+		finally:
+			if basis is not None:
+				basis.close()
+		if digest.hexdigest() != data.decode("ascii"):
+			os.remove(delta_path)
+			raise RuntimeError(f"File receive error. Checksum mismatch for '{dest_path}'.")
+		os.replace(delta_path, dest_path)
+		return wire
+
+	def _receive_file_parallel(self, header: dict, buffer_size: int):
+		token = header["token"]
+		ranges = split_ranges(header["length"], header["streams"])
+		digests = [None] * header["streams"]
+		with open(header["dest_path"], "wb") as file:
+			file.truncate(header["length"])
+		streams = self.open_streams(token, header["streams"])
+		fd = os.open(header["dest_path"], os.O_WRONLY)
+		try:
+			_run_streams(self._receive_range, streams, ranges, digests, fd, buffer_size)
+		finally:
+			os.close(fd)
+			for stream in streams:
+				Socket.close(stream)
+		ok = self.wait_reply(token)["digests"] == digests
+		self.post_reply(token, ok=ok)
+		if not ok:
+			raise RuntimeError(f"File receive error. Checksum mismatch for '{header['dest_path']}'.")
+
+	@staticmethod
+	def _receive_range(stream: "Socket", offset: int, count: int, fd: int, buffer_size: int) -> str:
+		if _RANGE.unpack(stream.receive(_RANGE.size)) != (offset, count):
+			raise RuntimeError(f"File receive error. Unexpected range on stream.")
+		digest = hashlib.blake2b()
+		buffer = stream.pool.acquire(buffer_size)
+		received = 0
+		try:
+			with memoryview(buffer) as view:
+				while received < count:
+					size = stream.receive_some(view, min(count - received, buffer_size))
+					if size == 0:
+						raise RuntimeError(f"File receive error. Total received: {received} bytes.")
+					written = 0
+					while written < size:
+						written += os.pwrite(fd, view[written:size], offset + received + written)
+					digest.update(view[:size])
+					received += size
+		finally:
+			stream.pool.release(buffer)
+		return digest.hexdigest()
+
+	def _receive_data_frames(self, file, length: int):
+		received = 0
+		while True:
+			_, flags, size = self.receive_frame(FRAME_DATA)
+			buffer = self.pool.acquire(size)
+			try:
+				with memoryview(buffer) as view:
+					self.receive_into(view, size)
+					file.write(view[:size])
+			finally:
+				self.pool.release(buffer)
+			received += size
+			if flags & FRAME_FLAG_END:
+				break
+		if received != length:
+			raise RuntimeError(f"File receive error. Expected {length} bytes, received {received} bytes.")
+
+	def _receive_into_file(self, file, length: int, buffer_size: int):
+		buffer = self.pool.acquire(buffer_size)
+		received = 0
+		try:
+			with memoryview(buffer) as view:
+				while received < length:
+					size = self.receive_some(view, min(length - received, buffer_size))
+					if size == 0:
+						raise RuntimeError(f"File receive error. Total received: {received} bytes.")
+					file.write(view[:size])
+					received += size
+		finally:
+			self.pool.release(buffer)
+
+	def _receive_file_mmap(self, dest_path: str, length: int, buffer_size: int):
+		with open(dest_path, "w+b") as file:
+			file.truncate(length)
+			with mmap.mmap(file.fileno(), length) as mapped:
+				with memoryview(mapped) as view:
+					self.receive_into(view, length, buffer_size)
+
+def _run_streams(target, streams: list[Socket], ranges: list[tuple[int, int]], digests: list, *args):
+	errors = []
+
+	def run(index: int):
+		try:
+			offset, count = ranges[index] if index < len(ranges) else (0, 0)
+			digests[index] = target(streams[index], offset, count, *args)
+		except Exception as e:
+			errors.append(e)
+			for stream in streams:
+				try:
+					stream.sock.shutdown(socket.SHUT_RDWR)
+				except OSError:
+					pass
+
+	threads = [threading.Thread(target=run, args=(i,)) for i in range(len(streams))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	if errors:
+		raise errors[0]
 
 
 class ClientSocket(Socket):
 	def __init__(self, sock: socket.socket = None, address: tuple[str, int] = None):
 		super().__init__(sock)
 		self.address = address
+		self.id = 0
+		self.tags: set[str] = set()
+		self.server: "ServerSocket | None" = None
+		self.detached = False
+		self.session: str | None = None
 	
 	def __str__(self):
 		return f"ClientSocket(addr={self.address})"
 	
-	def close(self):
-		self.send_cmd("quit")
+	def close(self, order: str = "quit"):
+		if not self.detached and not self.is_closed():
+			try:
+				self.send_cmd(order)
+			except OSError:
+				pass
 		super().close()
 
+	def open_streams(self, token: str, count: int) -> list[Socket]:
+		if self.server is None:
+			return super().open_streams(token, count)
+		return self.server.wait_streams(token, count)
+
 	def connect(self, host: str, port: str):
 		self.sock.connect((host, port))
+		self.set_nodelay()
+
+	def reconnect(self, host: str, port: int):
+		if not self.is_closed():
+			self.sock.close()
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.reset()
+		self.connect(host, port)
+
+	def open_session(self, timeout: float = 2.0) -> bool:
+		self.send_cmd("session" if self.session is None else f"session {self.session}")
+		previous = self.sock.gettimeout()
+		pending, self._pending = self._pending, deque()
+		self.sock.settimeout(timeout)
+		try:
+			while True:
+				cmd = self.receive_cmd()
+				if cmd.startswith("session "):
+					_, self.session, client_id, state = cmd.split(" ")
+					self.id = int(client_id)
+					return state == "resumed"
+				pending.append(cmd)
+		except socket.timeout:
+			return False
+		finally:
+			self.sock.settimeout(previous)
+			self._pending = pending
 
 
 class ServerSocket(Socket):
 	def __init__(self, sock: socket.socket = None):
 		super().__init__(sock)
 		self._backlog = None
-		self.clients = []
+		self.clients = ClientRegistry()
+		self._streams: dict[str, dict[int, ClientSocket]] = {}
+		self._streams_cond = threading.Condition()
 
 	def __str__(self):
 		return f"ClientSocket(addr={self.sock.getsockname()}, backlog={self._backlog}, clients_nb={len(self.clients)}, clients={self.clients})"
 	
-	def close(self):
+	def close(self, order: str = "quit"):
 		self.sock._closed = True
 		for client in self.clients:
-			client.close()
+			client.close(order)
 		super().close()
 
 	def bind(self, host: str, port: int):
@@ -159,6 +1600,30 @@ class ServerSocket(Socket):
 	def accept(self, add_to_clients: bool = True) -> ClientSocket:
 		client_socket, client_address = self.sock.accept()
 		client = ClientSocket(client_socket, client_address)
+		client.server = self
+		client.set_nodelay()
+		client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
 		if add_to_clients:
 			self.clients.append(client)
 		return client
+
+	def handle_attach(self, client: ClientSocket, cmd: str) -> bool:
+		if not cmd.startswith("attach "):
+			return False
+		_, token, index = cmd.split(" ")
+		self.clients.discard(client)
+		client.detached = True
+		with self._streams_cond:
+			self._streams.setdefault(token, {})[int(index)] = client
+			self._streams_cond.notify_all()
+		return True
+
+	def wait_streams(self, token: str, count: int, timeout: float = STREAM_TIMEOUT) -> list[ClientSocket]:
+		with self._streams_cond:
+			if not self._streams_cond.wait_for(lambda: len(self._streams.get(token, ())) >= count, timeout):
+				streams = self._streams.pop(token, {})
+				for stream in streams.values():
+					stream.close()
+				raise TimeoutError(f"Only {len(streams)} of {count} streams attached for '{token}'.")
+			streams = self._streams.pop(token)
+		return [streams[index] for index in range(count)]
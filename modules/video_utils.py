@@ -1,63 +1,451 @@
+import os
+import json
+import bisect
+import shutil
+import tempfile
+import subprocess
+from fractions import Fraction
+from concurrent.futures import ProcessPoolExecutor
 import cv2
+import numpy as np
+from modules.pipeline_utils import Pipeline
+from modules.job_utils import job_share, process_context
 
 
 FOURCC_MP4 = *'mp4v',
 FOURCC_MOV = *'mp4v',
 FOURCC_XVID = *'XVID',
 
+SEEK_MIN = 32
+SEEK_EPSILON = 0.001
 
-def crop_video(src_path: str, dst_path: str, fourcc: str | list[str] | tuple[str], start_frame: int, end_frame: int) -> None:
-	video = cv2.VideoCapture(src_path)
+SEGMENT_MIN = 250
 
-	fps = video.get(cv2.CAP_PROP_FPS)
-	width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
-	height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+JOIN_BLOCK = 4
+JOIN_DEPTH = 3
 
-	fourcc = cv2.VideoWriter_fourcc(*fourcc)
-	out = cv2.VideoWriter(dst_path, fourcc, fps, (width, height))
+FFMPEG = shutil.which("ffmpeg")
+FFPROBE = shutil.which("ffprobe")
+
+
+def seek_frame(video: "cv2.VideoCapture", frame: int, times: list[float] | None = None) -> bool:
+	"""
+	Moves `video` so that the next read returns `frame`, decoding from the
+	keyframe before it. The landing is found from the probed `times` when
+	given (the reported frame count is wrong with B-frames or a variable
+	rate); if it is past `frame`, decodes from the start. Returns False if
+	the video is shorter.
+	"""
+	position = 0
+	if frame >= SEEK_MIN and video.set(cv2.CAP_PROP_POS_FRAMES, frame):
+		if times:
+			position = _landed(video.get(cv2.CAP_PROP_POS_MSEC) / 1000, times)
+		else:
+			position = int(video.get(cv2.CAP_PROP_POS_FRAMES))
+		if not 0 <= position <= frame:
+			video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+			position = 0
+	while position < frame:
+		if not video.grab():
+			return False
+		position += 1
+	return True
+
+
+def _landed(time: float, times: list[float]) -> int:
+	"""
+	Returns the frame after the one shown at `time`, or -1 if none is within
+	half a frame (0 means the backend had no timestamp).
+	"""
+	if time <= 0:
+		return -1
+	time += times[0]
+	index = bisect.bisect_left(times, time)
+	nearest = min((i for i in (index - 1, index) if 0 <= i < len(times)), key=lambda i: abs(times[i] - time))
+	gaps = [times[i + 1] - times[i] for i in (nearest - 1, nearest) if 0 <= i < len(times) - 1]
+	if abs(times[nearest] - time) > min(gaps, default=0) / 2:
+		return -1
+	return nearest + 1
+
+
+def frame_reader(video: "cv2.VideoCapture", count: int | None = None):
+	remaining = count
+
+	def read(buffer):
+		nonlocal remaining
+		if remaining is not None:
+			if remaining <= 0:
+				return None
+			remaining -= 1
+		ret, frame = video.read(buffer)
+		return frame if ret else None
+
+	return read
+
+
+class _Block:
+	"""
+	Up to `JOIN_BLOCK` frames of one source; frame i is written `repeats[i]`
+	times (0 drops it).
+	"""
+
+	def __init__(self):
+		self.source = 0
+		self.fps = 0.0
+		self.count = 0
+		self.indices = np.empty(JOIN_BLOCK, np.int64)
+		self.frames: np.ndarray | None = None
+		self.scaled: np.ndarray | None = None
+		self.output: np.ndarray | None = None
+		self.result: np.ndarray | None = None
+		self.repeats: np.ndarray | None = None
+
+
+def _buffer(buffer: np.ndarray | None, shape: tuple, dtype=np.uint8) -> np.ndarray:
+	if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+		return np.empty(shape, dtype)
+	return buffer
+
+
+class _JoinReader:
+	def __init__(self, srcs: list[str] | tuple[str], report: list[dict]):
+		self.report = report
+		self._srcs = iter(srcs)
+		self._video = None
+		self._fps = 0.0
+		self._index = 0
+		self._total = 0
+		self._pending = None
+
+	def __call__(self, block: _Block | None) -> _Block | None:
+		block = block or _Block()
+		block.count = 0
+		while block.count == 0:
+			if self._video is None and not self._open():
+				return None
+			block.source = len(self.report) - 1
+			block.fps = self._fps
+			entry = self.report[-1]
+			if self._pending is not None:
+				self._store(block, *self._pending)
+				self._pending = None
+			while block.count < JOIN_BLOCK and self._index < self._total:
+				index = self._index
+				self._index += 1
+				slot = block.frames[block.count] if block.frames is not None else None
+				ret, frame = self._video.read(slot)
+				if not ret:
+					entry["leaks"].append(index)
+					continue
+				entry["read"] += 1
+				if not self._store(block, index, frame):
+					self._pending = (index, frame)
+					break
+			if self._index >= self._total and self._pending is None:
+				self.close()
+		return block
+
+	def _open(self) -> bool:
+		vid_path = next(self._srcs, None)
+		if vid_path is None:
+			return False
+		self._video = cv2.VideoCapture(vid_path)
+		self._fps = self._video.get(cv2.CAP_PROP_FPS)
+		self._index = 0
+		self._total = int(self._video.get(cv2.CAP_PROP_FRAME_COUNT))
+		self.report.append(_report_entry(vid_path))
+		return True
+
+	@staticmethod
+	def _store(block: _Block, index: int, frame: np.ndarray) -> bool:
+		if block.frames is None or frame.shape != block.frames.shape[1:] or frame.dtype != block.frames.dtype:
+			if block.count:
+				return False
+			block.frames = np.empty((JOIN_BLOCK,) + frame.shape, frame.dtype)
+		slot = block.frames[block.count]
+		if not np.may_share_memory(frame, slot):
+			slot[...] = frame
+		block.indices[block.count] = index
+		block.count += 1
+		return True
+
+	def close(self):
+		if self._video is not None:
+			self._video.release()
+			self._video = None
+
+
+class _JoinNormalizer:
+	"""
+	Brings a block to 8-bit BGR at `size` (letterboxed or stretched) and
+	`fps` (by repeating or dropping frames).
+	"""
+
+	def __init__(self, size: tuple[int, int], fps: float, letterbox: bool = True):
+		self.size = size
+		self.fps = Fraction(fps).limit_denominator(1001) if fps > 0 else None
+		self.letterbox = letterbox
+
+	def __call__(self, block: _Block) -> _Block:
+		frames = _to_bgr8(block.frames[:block.count])
+		width, height = self.size
+		if frames.shape[1:3] != (height, width):
+			frames = self._resize(block, frames)
+		block.result = frames
+		block.repeats = self._repeats(block.indices[:block.count], block.fps)
+		return block
+
+	def _resize(self, block: _Block, frames: np.ndarray) -> np.ndarray:
+		width, height = self.size
+		src_height, src_width = frames.shape[1:3]
+		if self.letterbox:
+			scale = min(width / src_width, height / src_height)
+			scaled_width = min(width, max(1, round(src_width * scale)))
+			scaled_height = min(height, max(1, round(src_height * scale)))
+		else:
+			scaled_width, scaled_height = width, height
+		x = (width - scaled_width) // 2
+		y = (height - scaled_height) // 2
+		block.scaled = _buffer(block.scaled, (JOIN_BLOCK, scaled_height, scaled_width, 3))
+		block.output = _buffer(block.output, (JOIN_BLOCK, height, width, 3))
+		interpolation = cv2.INTER_AREA if scaled_width < src_width else cv2.INTER_LINEAR
+		for i in range(len(frames)):
+			cv2.resize(frames[i], (scaled_width, scaled_height), dst=block.scaled[i], interpolation=interpolation)
+		output = block.output[:len(frames)]
+		output[:, :y] = 0
+		output[:, y + scaled_height:] = 0
+		output[:, y:y + scaled_height, :x] = 0
+		output[:, y:y + scaled_height, x + scaled_width:] = 0
+		output[:, y:y + scaled_height, x:x + scaled_width] = block.scaled[:len(frames)]
+		return output
+
+	def _repeats(self, indices: np.ndarray, fps: float) -> np.ndarray:
+		"""
+		Output frame k shows source frame floor(k * fps / self.fps).
+		"""
+		if self.fps is None or fps <= 0:
+			return np.ones(len(indices), np.int64)
+		ratio = self.fps / Fraction(fps).limit_denominator(1001)
+		if ratio == 1:
+			return np.ones(len(indices), np.int64)
+		return -((-(indices + 1) * ratio.numerator) // ratio.denominator) + (-indices * ratio.numerator) // ratio.denominator
 
-	for i in range(end_frame + 1):
-		ret, frame = video.read()
-		if i < start_frame:
-			continue
-		if not ret:
-			break
 
-		out.write(frame)
+def _to_bgr8(frames: np.ndarray) -> np.ndarray:
+	if frames.dtype != np.uint8:
+		frames = (frames >> (8 * frames.dtype.itemsize - 8)).astype(np.uint8)
+	if frames.ndim == 3:
+		frames = frames[..., np.newaxis]
+	if frames.shape[3] == 1:
+		return np.repeat(frames, 3, axis=3)
+	if frames.shape[3] == 4:
+		return np.ascontiguousarray(frames[..., :3])
+	return frames
 
+
+class _JoinWriter:
+	def __init__(self, out: "cv2.VideoWriter", report: list[dict]):
+		self.out = out
+		self.report = report
+
+	def __call__(self, block: _Block):
+		for frame, repeat in zip(block.result, block.repeats.tolist()):
+			for _ in range(repeat):
+				self.out.write(frame)
+		entry = self.report[block.source]
+		entry["written"] += int(block.repeats.sum())
+		entry["dropped"] += int(np.count_nonzero(block.repeats == 0))
+
+
+def probe_video(path: str, packets: bool = False) -> dict | None:
+	"""
+	Returns codec, size and frame rate and, with `packets`, the presentation
+	times and keyframe indices. None without ffprobe or on error.
+	"""
+	if FFPROBE is None:
+		return None
+	entries = "stream=codec_tag_string,width,height,r_frame_rate" + (":packet=pts_time,flags" if packets else "")
+	try:
+		output = subprocess.run([FFPROBE, "-v", "error", "-select_streams", "v:0", "-show_entries", entries,
+			"-of", "json", path], capture_output=True, check=True, text=True).stdout
+		info = json.loads(output)
+		stream = info["streams"][0]
+		frames = sorted((float(packet["pts_time"]), "K" in packet["flags"]) for packet in info.get("packets", ())
+			if packet.get("pts_time", "N/A") != "N/A")
+		return {
+			"codec": stream["codec_tag_string"].lower(),
+			"size": (stream["width"], stream["height"]),
+			"fps": stream["r_frame_rate"],
+			"times": [pts for pts, _ in frames],
+			"keyframes": [i for i, (_, key) in enumerate(frames) if key],
+		}
+	except (OSError, subprocess.CalledProcessError, ValueError, KeyError, IndexError):
+		return None
+
+
+def _fourcc_tag(fourcc: str | list[str] | tuple[str]) -> str:
+	return "".join(fourcc).lower()
+
+
+def _ffmpeg(*args: str) -> bool:
+	try:
+		subprocess.run([FFMPEG, "-v", "error", "-y", *args], capture_output=True, check=True)
+	except (OSError, subprocess.CalledProcessError):
+		return False
+	return True
+
+
+def copy_crop(src_path: str, dst_path: str, fourcc: str | list[str] | tuple[str], start_frame: int, end_frame: int,
+			  snap: bool = False) -> bool:
+	"""
+	Cuts without re-encoding, if the source has the codec and the cut starts
+	on a keyframe (or, with `snap`, may start at the one before). Returns
+	False when it has to be re-encoded.
+	"""
+	if FFMPEG is None:
+		return False
+	info = probe_video(src_path, packets=True)
+	if info is None or info["codec"] != _fourcc_tag(fourcc):
+		return False
+	start_frame = max(start_frame, 0)
+	end_frame = min(end_frame, len(info["times"]) - 1)
+	keyframes = [frame for frame in info["keyframes"] if frame <= start_frame]
+	if not keyframes or end_frame < start_frame or (keyframes[-1] != start_frame and not snap):
+		return False
+	start_frame = keyframes[-1]
+	return _ffmpeg("-ss", f"{info['times'][start_frame] + SEEK_EPSILON:.6f}", "-i", src_path, "-map", "0:v:0",
+		"-frames:v", str(end_frame - start_frame + 1), "-c", "copy", dst_path)
+
+
+def copy_join(srcs: list[str] | tuple[str], dst_path: str, fourcc: str | list[str] | tuple[str]) -> bool:
+	if FFMPEG is None or not srcs:
+		return False
+	infos = [probe_video(vid_path) for vid_path in srcs]
+	if None in infos:
+		return False
+	expected = (_fourcc_tag(fourcc), infos[0]["size"], infos[0]["fps"])
+	if any((info["codec"], info["size"], info["fps"]) != expected for info in infos):
+		return False
+	return _concat(srcs, dst_path)
+
+
+def _concat(srcs: list[str] | tuple[str], dst_path: str) -> bool:
+	with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as listing:
+		for vid_path in srcs:
+			listing.write("file '" + os.path.abspath(vid_path).replace("'", "'\\''") + "'\n")
+	try:
+		return _ffmpeg("-f", "concat", "-safe", "0", "-i", listing.name, "-map", "0:v:0", "-c", "copy", dst_path)
+	finally:
+		os.remove(listing.name)
+
+
+def crop_video(src_path: str, dst_path: str, fourcc: str | list[str] | tuple[str], start_frame: int, end_frame: int,
+			   snap: bool = False, workers: int | None = None) -> None:
+	if copy_crop(src_path, dst_path, fourcc, start_frame, end_frame, snap):
+		return
+	start_frame = max(start_frame, 0)
+	if workers is None:
+		workers = job_share()
+	if workers > 1 and FFMPEG is not None:
+		video = cv2.VideoCapture(src_path)
+		total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+		video.release()
+		end = min(end_frame, total_frames - 1)
+		count = min(workers, (end - start_frame + 1) // SEGMENT_MIN)
+		if count > 1:
+			bounds = [start_frame + (end - start_frame + 1) * i // count for i in range(count + 1)]
+			tasks = [(_encode_crop, src_path, fourcc, bounds[i], bounds[i + 1] - 1) for i in range(count)]
+			if _encode_segments(tasks, dst_path, count) is not None:
+				return
+	_encode_crop(src_path, dst_path, fourcc, start_frame, end_frame)
+
+
+def join_video(srcs: list[str] | tuple[str], dst_path: str, fourcc: str | list[str] | tuple[str],
+			   workers: int | None = None, letterbox: bool = True) -> list[dict]:
+	"""
+	Joins `srcs` at the size and frame rate of the first one. Returns one
+	report per source, in order: `path`, frames `read`, `written` and
+	`dropped`, and the unreadable ones (`leaks`).
+	"""
+	if copy_join(srcs, dst_path, fourcc):
+		report = []
+		for vid_path in srcs:
+			video = cv2.VideoCapture(vid_path)
+			count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+			video.release()
+			report.append(_report_entry(vid_path, read=count, written=count))
+		return report
+	video = cv2.VideoCapture(srcs[0])
+	fps = video.get(cv2.CAP_PROP_FPS)
+	size = (int(video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
 	video.release()
-	out.release()
+	if fps <= 0 or min(size) <= 0:
+		raise ValueError(f"Cannot read the frame rate and size of '{srcs[0]}'.")
+	if workers is None:
+		workers = job_share()
+	if workers > 1 and FFMPEG is not None and len(srcs) > 1:
+		tasks = [(_encode_join, [vid_path], fourcc, fps, size, letterbox) for vid_path in srcs]
+		results = _encode_segments(tasks, dst_path, min(workers, len(srcs)))
+		if results is not None:
+			# One source per segment, in order.
+			return [entry for result in results for entry in result]
+	return _encode_join(srcs, dst_path, fourcc, fps, size, letterbox)
 
 
-def join_video(srcs: list[str] | tuple[str], dst_path: str, fourcc: str | list[str] | tuple[str]) -> dict[str: list[int]]:
-	out = None
-	leaks = {}
+def _report_entry(vid_path: str, read: int = 0, written: int = 0) -> dict:
+	return {"path": vid_path, "read": read, "written": written, "dropped": 0, "leaks": []}
 
-	for vid_path in srcs:
-		video = cv2.VideoCapture(vid_path)
 
-		if out is None:
-			fps = video.get(cv2.CAP_PROP_FPS)
-			width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
-			height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+def _encode_segments(tasks: list[tuple], dst_path: str, workers: int) -> list | None:
+	"""
+	Runs `fn(src, part_path, *args)` for each task on `workers` processes,
+	then concatenates the parts. Returns the results, or None if the concat
+	failed.
+	"""
+	parts = tempfile.mkdtemp(prefix=".segments-", dir=os.path.dirname(os.path.abspath(dst_path)))
+	extension = os.path.splitext(dst_path)[1]
+	try:
+		paths = [os.path.join(parts, f"{i}{extension}") for i in range(len(tasks))]
+		with ProcessPoolExecutor(workers, mp_context=process_context()) as pool:
+			futures = [pool.submit(fn, src, path, *args) for (fn, src, *args), path in zip(tasks, paths)]
+			results = [future.result() for future in futures]
+		if not _concat(paths, dst_path):
+			return None
+		return results
+	finally:
+		shutil.rmtree(parts, ignore_errors=True)
 
-			fourcc = cv2.VideoWriter_fourcc(*fourcc)
-			out = cv2.VideoWriter(dst_path, fourcc, fps, (width, height))
 
-		frame = 0
-		total_frames = video.get(cv2.CAP_PROP_FRAME_COUNT)
-		frame_leaks = []
-		while frame != total_frames:
-			ret, frame = video.read()
-			if not ret:
-				frame_leaks.append(frame)
-				continue
-			out.write(frame)
-			frame += 1
-		if len(frame_leaks):
-			leaks[vid_path] = frame_leaks
+def _encode_crop(src_path: str, dst_path: str, fourcc: str | list[str] | tuple[str], start_frame: int, end_frame: int):
+	video = cv2.VideoCapture(src_path)
 
+	fps = video.get(cv2.CAP_PROP_FPS)
+	width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+	height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+	fourcc = cv2.VideoWriter_fourcc(*fourcc)
+	out = cv2.VideoWriter(dst_path, fourcc, fps, (width, height))
+
+	start_frame = max(start_frame, 0)
+	info = probe_video(src_path, packets=True) if start_frame >= SEEK_MIN else None
+	try:
+		if seek_frame(video, start_frame, info and info["times"]):
+			Pipeline(frame_reader(video, end_frame - start_frame + 1), out.write).run()
+	finally:
 		video.release()
+		out.release()
+
+
+def _encode_join(srcs: list[str] | tuple[str], dst_path: str, fourcc: str | list[str] | tuple[str],
+				 fps: float, size: tuple[int, int], letterbox: bool = True) -> list[dict]:
+	fourcc = cv2.VideoWriter_fourcc(*fourcc)
+	out = cv2.VideoWriter(dst_path, fourcc, fps, size)
 
-	out.release()
-	return leaks
+	report = []
+	reader = _JoinReader(srcs, report)
+	try:
+		Pipeline(reader, _JoinWriter(out, report), _JoinNormalizer(size, fps, letterbox), depth=JOIN_DEPTH).run()
+	finally:
+		reader.close()
+		out.release()
+	return report
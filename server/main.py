@@ -1,24 +1,31 @@
 import sys
 sys.path.append(sys.path[0][:sys.path[0].rfind("/")])
 
+import os
+import time
+import json
+import secrets
 import threading
 import modules.logger as logger
-from modules.socket_utils import Socket, ServerSocket, ClientSocket
-from modules.command_utils import Command, ServerCommand, parse_addr
-from modules.video_utils import crop_video, join_video, FOURCC_MP4, FOURCC_MOV, FOURCC_XVID
+from modules.socket_utils import Socket, ServerSocket, ClientSocket, TransferStats, TRANSFER_PLAIN, TRANSFER_RESUME, TRANSFER_DELTA, TRANSFER_CONTINUE, STREAMS_MAX, \
+	PROTOCOL_FRAMED, PROTOCOL_CALLS, CALL_TIMEOUT, OUTBOUND_TIMEOUT, SLOW_DROP, SLOW_EVICT, HEARTBEAT_INTERVAL, HEARTBEAT_MISSES
+from modules.command_utils import CommandRegistry, ServerCommand, join_command
+from modules.compression_utils import COMPRESSION_NONE, COMPRESSION_AUTO, available_codecs
+from modules.delta_utils import file_digest
+from modules.relay_utils import RelayTracker, relay_tree, relay_send, RELAY_FANOUT, RELAY_TIMEOUT, STATE_DONE, STATE_FAILED
+from modules.event_utils import EventLoop, FanoutStats, fanout
+from modules.session_utils import SessionStore, SESSION_RETRIES
+from modules.scheduler_utils import default_scheduler, parse_rate, format_rate
+from modules.video_utils import crop_video, join_video, FOURCC_MP4, FOURCC_MOV, FOURCC_XVID, SEGMENT_MIN
+from modules.job_utils import JobEngine, Job, JOB_WORKERS, JOB_DONE, JOB_FAILED
 
 
 server = ServerSocket()
-server.bind("", 1234)
-server.listen(5)
-
-logger.log_embed("Server is running...",
-	f"  > Host: {server.sock.getsockname()[0]}",
-	f"  > Port: {server.sock.getsockname()[1]}",
-	f"  > Link: http://{server.get_llink()}/",
-	f"  > Backlog: {server._backlog}",
-	f"  > Clients: {len(server.clients)}",
-	before=[], after=["", ""])
+relays = RelayTracker()
+sessions = SessionStore(server.clients)
+last_broadcast: FanoutStats | None = None
+outbound_defaults = {"policy": SLOW_DROP, "timeout": OUTBOUND_TIMEOUT}
+jobs = JobEngine()
 
 
 class HelpCommand(ServerCommand):
@@ -40,20 +47,108 @@ class BroadcastCommand(ServerCommand):
 		if len(args) == 0:
 			logger.log("Error: Parameter '<command...>' is missing.", flag=logger.FLAG_ERROR)
 			return False
-		exceptions = []
-		broadcast = " ".join(args)
-		logger.log(f"Broadcasting to {len(self.server.clients)} clients:  {broadcast}")
-		for client in self.server.clients:
-			logger.log(f"  > Sending to {client.address}:  {broadcast}", flag=logger.FLAG_COMMAND)
+		global last_broadcast
+		clients = self.server.clients.snapshot()
+		if len(args) > 1 and args[0].lower() == "-g":
+			clients = self.server.clients.select(args[1])
+			args = args[2:]
+		if len(args) == 0:
+			logger.log("Error: Parameter '<command...>' is missing.", flag=logger.FLAG_ERROR)
+			return False
+		broadcast = join_command(args)
+		logger.log(f"Broadcasting to {len(clients)} clients:  {broadcast}")
+		last_broadcast = fanout(clients, broadcast)
+		logger.log(f"  > {last_broadcast}")
+		return True
+
+
+class OutboundCommand(ServerCommand):
+	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
+		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
+			self.log_usage()
+			return True
+		if len(args) == 0:
+			logger.log(f"Outbound queues ({len(self.server.clients)} clients, {loop.evicted} evicted):")
+			for client in self.server.clients:
+				logger.log(f"  > {client.address}: {client.outbound_bytes} bytes queued, stalled {client.outbound_stalled():.1f} s, "
+					f"policy={client.slow_policy}, timeout={client.send_timeout:.0f} s")
+			if last_broadcast is not None:
+				logger.log(f"Last broadcast: {last_broadcast}")
+			return True
+		if len(args) == 1:
+			logger.log("Error: Parameter '<value>' is missing.", flag=logger.FLAG_ERROR)
+			return False
+		clients = self.server.clients.snapshot()
+		if len(args) > 2:
+			clients = self.server.clients.select(args[2])
+			if not clients:
+				logger.log(f"Error: No client matches '{args[2]}'.", flag=logger.FLAG_ERROR)
+				return False
+		if args[0] == "policy":
+			if args[1] not in (SLOW_DROP, SLOW_EVICT):
+				logger.log(f"Error: Unknown policy '{args[1]}'.", flag=logger.FLAG_ERROR)
+				return False
+			if len(args) == 2:
+				outbound_defaults["policy"] = args[1]
+			for client in clients:
+				client.slow_policy = args[1]
+		elif args[0] == "timeout":
 			try:
-				client.send_cmd(broadcast)
-			except Exception as e:
-				logger.log(f"  ### Fail. (See ERRO:{len(exceptions)}) ###", flag=logger.FLAG_ERROR)
-				exceptions.append(e)
-		if len(exceptions) > 0:
-			logger.log()
-		for i, e in enumerate(exceptions):
-			logger.log_exception(e, f"Failings  -  ERRO:{i}", before=[])
+				timeout = float(args[1])
+			except ValueError:
+				logger.log("Error: Parameter '<seconds>' is incorrect.", flag=logger.FLAG_ERROR)
+				return False
+			if len(args) == 2:
+				outbound_defaults["timeout"] = timeout
+			for client in clients:
+				client.send_timeout = timeout
+		else:
+			logger.log(f"Error: Unknown setting '{args[0]}'.", flag=logger.FLAG_ERROR)
+			return False
+		logger.log(f"Outbound {args[0]} set to {args[1]} for {len(clients)} clients.")
+		return True
+
+
+class TransfersCommand(ServerCommand):
+	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
+		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
+			self.log_usage()
+			return True
+		if len(args) == 0:
+			transfers = default_scheduler.transfers()
+			logger.log(f"Transfers ({len(transfers)} running, limit {format_rate(default_scheduler.rate)} in total, "
+				f"{format_rate(default_scheduler.client_rate)} per client):")
+			for transfer in transfers:
+				logger.log(f"  > #{getattr(transfer.flow, 'id', '?')} {transfer}")
+			for client in self.server.clients:
+				rate = default_scheduler.flow_rate(client)
+				if rate != default_scheduler.client_rate:
+					logger.log(f"  > #{client.id} limited to {format_rate(rate)}")
+			return True
+		if args[0] != "limit":
+			logger.log(f"Error: Unknown setting '{args[0]}'.", flag=logger.FLAG_ERROR)
+			return False
+		if len(args) == 1:
+			logger.log("Error: Parameter '<rate>' is missing.", flag=logger.FLAG_ERROR)
+			return False
+		try:
+			rate = parse_rate(args[1])
+		except ValueError:
+			logger.log("Error: Parameter '<rate>' is incorrect.", flag=logger.FLAG_ERROR)
+			return False
+		if len(args) == 2:
+			default_scheduler.set_rate(rate)
+			logger.log(f"Transfers limited to {format_rate(rate)} in total.")
+			return True
+		clients = self.server.clients.select(args[2])
+		if args[2] == "*":
+			default_scheduler.client_rate = rate
+		elif not clients:
+			logger.log(f"Error: No client matches '{args[2]}'.", flag=logger.FLAG_ERROR)
+			return False
+		for client in clients:
+			default_scheduler.set_flow_rate(client, rate)
+		logger.log(f"Transfers limited to {format_rate(rate)} for {len(clients)} clients.")
 		return True
 
 
@@ -62,12 +157,48 @@ class InfoCommand(ServerCommand):
 		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
 			self.log_usage()
 			return True
+		latencies = sorted(c.heartbeat.percentile(50) for c in self.server.clients if c.heartbeat.rtts)
+		latency = "n/a"
+		if latencies:
+			latency = f"median {latencies[len(latencies) // 2] * 1000:.2f} ms, worst {latencies[-1] * 1000:.2f} ms"
+		running, queued = jobs.counts()
 		logger.log("Server is running...",
 			f"  > Host: {self.server.sock.getsockname()[0]}",
 			f"  > Port: {self.server.sock.getsockname()[1]}",
 			f"  > Link: http://{self.server.get_llink()}/",
 			f"  > Backlog: {self.server._backlog}",
-			f"  > Clients: {len(self.server.clients)}")
+			f"  > Clients: {len(self.server.clients)}",
+			f"  > Sessions: {len(sessions)}",
+			f"  > Jobs: {running} running, {queued} queued",
+			f"  > Latency: {latency}",
+			f"  > Heartbeat: every {loop.heartbeat_interval:g} s, evict after {loop.heartbeat_misses} missed")
+		return True
+
+
+class HeartbeatCommand(ServerCommand):
+	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
+		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
+			self.log_usage()
+			return True
+		if len(args) == 0:
+			logger.log(f"Heartbeat: every {loop.heartbeat_interval:g} s, evict after {loop.heartbeat_misses} missed, {loop.evicted} evicted")
+			return True
+		if len(args) == 1:
+			logger.log("Error: Parameter '<value>' is missing.", flag=logger.FLAG_ERROR)
+			return False
+		try:
+			if args[0] == "interval":
+				loop.heartbeat_interval = float(args[1])
+			elif args[0] == "misses":
+				loop.heartbeat_misses = max(int(args[1]), 1)
+			else:
+				logger.log(f"Error: Unknown setting '{args[0]}'.", flag=logger.FLAG_ERROR)
+				return False
+		except ValueError:
+			logger.log("Error: Parameter '<value>' is incorrect.", flag=logger.FLAG_ERROR)
+			return False
+		loop.wake()
+		logger.log(f"Heartbeat {args[0]} set to {args[1]}.")
 		return True
 
 
@@ -76,9 +207,40 @@ class ListCommand(ServerCommand):
 		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
 			self.log_usage()
 			return True
-		logger.log(f"Clients ({len(self.server.clients)}):")
-		for client in self.server.clients:
-			logger.log(f"  > {client.address}")
+		clients = self.server.clients.snapshot() if len(args) == 0 else self.server.clients.select(args[0])
+		logger.log(f"Clients ({len(clients)}):")
+		for client in clients:
+			tags = f"  [{', '.join(sorted(client.tags))}]" if client.tags else ""
+			logger.log(f"  > #{client.id} {client.address}  {client.heartbeat}{tags}")
+		groups = self.server.clients.tags()
+		if len(args) == 0 and groups:
+			logger.log(f"Groups: {', '.join(f'@{tag} ({count})' for tag, count in sorted(groups.items()))}")
+		return True
+
+
+class TagCommand(ServerCommand):
+	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
+		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
+			self.log_usage()
+			return True
+		if len(args) == 0:
+			logger.log("Error: Parameter '<selector>' is missing.", flag=logger.FLAG_ERROR)
+			return False
+		if len(args) == 1:
+			logger.log("Error: Parameter '<tag...>' is missing.", flag=logger.FLAG_ERROR)
+			return False
+		clients = self.server.clients.select(args[0])
+		if not clients:
+			logger.log(f"Error: No client matches '{args[0]}'.", flag=logger.FLAG_ERROR)
+			return False
+		tags = [tag.removeprefix("@") for tag in args[1:]]
+		for client in clients:
+			if label == "untag":
+				self.server.clients.untag(client, *tags)
+			else:
+				self.server.clients.tag(client, *tags)
+		sessions.save()
+		logger.log(f"{'Untagged' if label == 'untag' else 'Tagged'} {len(clients)} clients:  {', '.join(tags)}")
 		return True
 
 
@@ -88,27 +250,90 @@ class SendCommand(ServerCommand):
 			self.log_usage()
 			return True
 		if len(args) == 0:
-			logger.log("Error: Parameter '<address>' is missing.", flag=logger.FLAG_ERROR)
+			logger.log("Error: Parameter '<selector>' is missing.", flag=logger.FLAG_ERROR)
 			return False
 		if len(args) == 1:
 			logger.log("Error: Parameter '<command...>' is missing.", flag=logger.FLAG_ERROR)
 			return False
-		address = parse_addr(args[0])
-		command = "".join(args[1:])
-		client: ClientSocket = None
-		for c in self.server.clients:
-			if c.address == address:
-				client = c
-				break
-		if client is None:
-			logger.log(f"Error: Client {address} not found.", flag=logger.FLAG_ERROR)
+		clients = self.server.clients.select(args[0])
+		command = join_command(args[1:])
+		if not clients:
+			logger.log(f"Error: No client matches '{args[0]}'.", flag=logger.FLAG_ERROR)
 			return False
-		logger.log(f"Sending to {address}:  {command}", flag=logger.FLAG_COMMAND)
-		try:
-			client.send_cmd(command)
-		except Exception as e:
-			logger.log_exception(e, before=[], after=[])
+		if len(clients) == 1:
+			logger.log(f"Sending to {clients[0].address}:  {command}", flag=logger.FLAG_COMMAND)
+			try:
+				clients[0].send_cmd(command)
+			except Exception as e:
+				logger.log_exception(e, before=[], after=[])
+				return False
+			return True
+		logger.log(f"Sending to {len(clients)} clients ({args[0]}):  {command}", flag=logger.FLAG_COMMAND)
+		logger.log(f"  > {fanout(clients, command)}")
+		return True
+
+
+class CallCommand(ServerCommand):
+	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
+		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
+			self.log_usage()
+			return True
+		timeout = CALL_TIMEOUT
+		count = 1
+		while len(args) > 1 and args[0].lower() in ("-t", "-n"):
+			try:
+				if args[0].lower() == "-t":
+					timeout = float(args[1])
+				else:
+					count = max(int(args[1]), 1)
+			except ValueError:
+				logger.log(f"Error: Parameter '<{'timeout' if args[0].lower() == '-t' else 'count'}>' is incorrect.", flag=logger.FLAG_ERROR)
+				return False
+			del args[:2]
+		if len(args) == 0:
+			logger.log("Error: Parameter '<selector>' is missing.", flag=logger.FLAG_ERROR)
+			return False
+		if len(args) == 1:
+			logger.log("Error: Parameter '<command...>' is missing.", flag=logger.FLAG_ERROR)
 			return False
+		clients = self.server.clients.select(args[0])
+		command = join_command(args[1:])
+		if not clients:
+			logger.log(f"Error: No client matches '{args[0]}'.", flag=logger.FLAG_ERROR)
+			return False
+		logger.log(f"Calling {len(clients)} clients ({args[0]}){f' {count} times' if count > 1 else ''}:  {command}", flag=logger.FLAG_COMMAND)
+		started = time.monotonic()
+		calls = {}
+		for client in clients:
+			if client.protocol < PROTOCOL_CALLS:
+				logger.log(f"  > #{client.id}: cannot answer calls (protocol {client.protocol})", flag=logger.FLAG_ERROR)
+				continue
+			calls[client] = [client.call(command, timeout) for _ in range(count)]
+		for client, futures in calls.items():
+			replies = []
+			errors = []
+			for future in futures:
+				try:
+					replies.append(future.result(max(started + timeout - time.monotonic(), 0)))
+				except Exception as e:
+					errors.append(str(e) or type(e).__name__)
+			if count == 1:
+				if errors:
+					logger.log(f"  > #{client.id}: {errors[0]}", flag=logger.FLAG_ERROR)
+				else:
+					logger.log(f"  > #{client.id}: {format_reply(replies[0])}")
+				continue
+			latencies = sorted(reply["latency"] for reply in replies)
+			failed = sum(not is_success(reply) for reply in replies)
+			summary = f"{len(replies)}/{count} answered, {failed} failed"
+			if latencies:
+				elapsed = time.monotonic() - started
+				summary += (f", latency p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, "
+					f"p99 {latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000:.2f} ms, "
+					f"{len(replies) / elapsed:.0f} calls/s")
+			if errors:
+				summary += f" ({errors[0]})"
+			logger.log(f"  > #{client.id}: {summary}", flag=logger.FLAG_ERROR if errors or failed else logger.FLAG_INFO)
 		return True
 
 
@@ -117,8 +342,35 @@ class FileTransferCommand(ServerCommand):
 		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
 			self.log_usage()
 			return True
+		compression = COMPRESSION_NONE
+		for i in range(len(args) - 1):
+			if args[i].lower() == "-z":
+				compression = args[i + 1].lower()
+				del args[i:i + 2]
+				break
+		if compression not in (COMPRESSION_NONE, COMPRESSION_AUTO, *available_codecs()):
+			logger.log(f"Error: Unknown compression '{compression}'.", flag=logger.FLAG_ERROR)
+			return False
+		streams = 1
+		for i in range(len(args) - 1):
+			if args[i].lower() == "-p":
+				try:
+					streams = int(args[i + 1])
+				except ValueError:
+					logger.log("Error: Parameter '<streams>' is incorrect.", flag=logger.FLAG_ERROR)
+					return False
+				del args[i:i + 2]
+				break
+		mode = TRANSFER_PLAIN
+		for flag, flag_mode in (("-r", TRANSFER_RESUME), ("-d", TRANSFER_DELTA)):
+			if flag in args:
+				if mode != TRANSFER_PLAIN:
+					logger.log("Error: Options '-r' and '-d' cannot be combined.", flag=logger.FLAG_ERROR)
+					return False
+				args.remove(flag)
+				mode = flag_mode
 		if len(args) == 0:
-			logger.log("Error: Parameter '<address>' is missing.", flag=logger.FLAG_ERROR)
+			logger.log("Error: Parameter '<selector>' is missing.", flag=logger.FLAG_ERROR)
 			return False
 		if len(args) == 1:
 			logger.log("Error: Parameter '<src_path>' is missing.", flag=logger.FLAG_ERROR)
@@ -126,34 +378,190 @@ class FileTransferCommand(ServerCommand):
 		if len(args) == 2:
 			logger.log("Error: Parameter '<dst_path>' is missing.", flag=logger.FLAG_ERROR)
 			return False
-		address = parse_addr(args[0])
+		clients = self.server.clients.select(args[0])
 		src_path = args[1]
 		dst_path = args[2]
-		client: ClientSocket = None
-		for c in self.server.clients:
-			if c.address == address:
-				client = c
+		if not clients:
+			logger.log(f"Error: No client matches '{args[0]}'.", flag=logger.FLAG_ERROR)
+			return False
+		for client in clients:
+			logger.log(f"Sending file:",
+				 f"  from {self.server.sock.getsockname()}:  {src_path}",
+				 f"  to {client.address}:  {dst_path}", flag=logger.FLAG_COMMAND)
+			loop.submit(send_logged, client, src_path, dst_path, compression, mode, streams)
+		return True
+
+
+class FileBroadcastCommand(ServerCommand):
+	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
+		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
+			self.log_usage()
+			return True
+		if len(args) > 0 and args[0].lower() == "status":
+			return self.log_status()
+		relay_fanout = RELAY_FANOUT
+		for i in range(len(args) - 1):
+			if args[i].lower() == "-f":
+				try:
+					relay_fanout = max(int(args[i + 1]), 1)
+				except ValueError:
+					logger.log("Error: Parameter '<fanout>' is incorrect.", flag=logger.FLAG_ERROR)
+					return False
+				del args[i:i + 2]
 				break
-		if client is None:
-			logger.log(f"Error: Client {address} not found.", flag=logger.FLAG_ERROR)
+		clients = self.server.clients.snapshot()
+		for i in range(len(args) - 1):
+			if args[i].lower() == "-g":
+				clients = self.server.clients.select(args[i + 1])
+				del args[i:i + 2]
+				break
+		if len(args) == 0:
+			logger.log("Error: Parameter '<src_path>' is missing.", flag=logger.FLAG_ERROR)
+			return False
+		if len(args) == 1:
+			logger.log("Error: Parameter '<dst_path>' is missing.", flag=logger.FLAG_ERROR)
 			return False
-		logger.log(f"Sending file:",
-			 f"  from {self.server.sock.getsockname()}:  {src_path}",
-			 f"  to {address}:  {dst_path}", flag=logger.FLAG_COMMAND)
+		src_path = args[0]
+		dst_path = args[1]
 		try:
-			client.send_cmd("filereceive")
-			client.send_file(src_path, dst_path)
-		except Exception as e:
+			length = os.path.getsize(src_path)
+			digest = file_digest(src_path)
+		except OSError as e:
 			logger.log_exception(e, before=[], after=[])
 			return False
+		token = secrets.token_hex(8)
+		clients = list(clients)
+		nodes, ports, legacy = self.prepare(token, clients)
+		tree = relay_tree(len(nodes), relay_fanout)
+		addresses = [(node.address[0], ports[node]) for node in nodes]
+		relays.start(token, dst_path, length, [str(client.address) for client in clients])
+		logger.log(f"Broadcasting file {token}:",
+			f"  from {self.server.sock.getsockname()}:  {src_path}",
+			f"  to {len(clients)} clients:  {dst_path}",
+			f"  relay tree: {len(nodes)} clients, fanout {relay_fanout}, {len(legacy)} direct", flag=logger.FLAG_COMMAND)
+		for i, node in enumerate(nodes):
+			try:
+				node.send_cmd(join_command(["relaystart", token, json.dumps({"dest_path": dst_path, "length": length,
+					"digest": digest, "children": [addresses[j] for j in tree[i]]})]))
+			except Exception as e:
+				relays.update(token, str(node.address), 0, STATE_FAILED)
+				logger.log_exception(e, before=[], after=[])
+		threading.Thread(target=self.feed, args=(token, src_path, dst_path, length,
+			[addresses[j] for j in tree[-1]], nodes, legacy)).start()
+		return True
+
+	def prepare(self, token: str, clients: list[ClientSocket]) -> tuple[list[ClientSocket], dict, list[ClientSocket]]:
+		nodes = []
+		legacy = []
+		for client in clients:
+			if client.protocol < PROTOCOL_FRAMED:
+				legacy.append(client)
+				continue
+			try:
+				client.send_cmd(f"relayprepare {token}")
+				nodes.append(client)
+			except Exception as e:
+				logger.log_exception(e, before=[], after=[])
+		ports = {}
+		deadline = time.monotonic() + RELAY_TIMEOUT
+		for node in nodes:
+			try:
+				ports[node] = node.wait_reply(token, max(deadline - time.monotonic(), 0))["port"]
+			except Exception as e:
+				legacy.append(node)
+				logger.log_exception(e, f"Client {node.address} will be sent the file directly.", before=[], after=[])
+				try:
+					node.send_cmd(f"relaycancel {token}")
+				except Exception:
+					pass
+		return [node for node in nodes if node in ports], ports, legacy
+
+	def feed(self, token: str, src_path: str, dst_path: str, length: int,
+			 roots: list[tuple[str, int]], nodes: list[ClientSocket], legacy: list[ClientSocket]):
+		"""
+		Feeds the roots of the tree and the legacy clients, then sends the file
+		directly to nodes that failed or stopped reporting, resuming.
+		"""
+		try:
+			relay_send(src_path, length, roots, token)
+		except Exception as e:
+			logger.log_exception(e, f"Relay {token}: feeding the tree failed.")
+		for client in legacy:
+			self.send_direct(token, client, src_path, dst_path, length, TRANSFER_PLAIN)
+		handled = {str(client.address) for client in legacy}
+		by_address = {str(node.address): node for node in nodes}
+		while unfinished := relays.unfinished(token, handled):
+			for address in unfinished:
+				handled.add(address)
+				logger.log(f"Relay {token}: sending the file directly to {address}.", flag=logger.FLAG_LINK)
+				self.send_direct(token, by_address[address], src_path, dst_path, length, TRANSFER_RESUME)
+
+	def send_direct(self, token: str, client: ClientSocket, src_path: str, dst_path: str, length: int, mode: str):
+		try:
+			client.send_file(src_path, dst_path, mode=mode, announce="filereceive")
+			relays.update(token, str(client.address), length, STATE_DONE)
+		except Exception as e:
+			relays.update(token, str(client.address), 0, STATE_FAILED)
+			logger.log_exception(e)
+
+	def log_status(self) -> bool:
+		snapshot = relays.snapshot()
+		logger.log(f"File broadcasts ({len(snapshot)}):")
+		for token, relay in snapshot.items():
+			done = sum(1 for _, state in relay["clients"].values() if state == STATE_DONE)
+			logger.log(f"  > {token}: {relay['dest_path']} ({relay['length']} bytes), {done}/{len(relay['clients'])} done")
+			for address, (received, state) in relay["clients"].items():
+				percent = 100 * received / relay["length"] if relay["length"] else 100
+				logger.log(f"    - {address}: {state} {percent:.1f}%")
+		return True
+
+
+class RelayProgressCommand(ServerCommand):
+	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
+		if len(args) < 3 or sender is None:
+			return False
+		try:
+			relays.update(args[0], str(sender.address), int(args[1]), args[2])
+		except ValueError:
+			return False
+		if args[2] in (STATE_DONE, STATE_FAILED):
+			logger.log(f"Relay {args[0]}: {sender.address} {args[2]} ({args[1]} bytes).", flag=logger.FLAG_LINK)
+		return True
+
+
+class CacheStatsCommand(ServerCommand):
+	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
+		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
+			self.log_usage()
+			return True
+		clients = self.server.clients.snapshot()
+		if len(args) > 0:
+			clients = self.server.clients.select(args[0])
+			if not clients:
+				logger.log(f"Error: No client matches '{args[0]}'.", flag=logger.FLAG_ERROR)
+				return False
+		logger.log(f"File caches ({len(clients)}):")
+		for client in clients:
+			token = secrets.token_hex(8)
+			try:
+				client.send_cmd(f"cache stats {token}")
+				stats = client.wait_reply(token, RELAY_TIMEOUT)
+			except Exception as e:
+				logger.log(f"  > {client.address}: unavailable ({e})")
+				continue
+			logger.log(f"  > {client.address}: {stats['entries']} entries, {stats['size']} bytes, "
+				f"{stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%}), {stats['saved_bytes']} bytes saved")
 		return True
 
 
 class FileReceiveCommand(ServerCommand):
 	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
+		if sender is None:
+			logger.log("Error: Files are received from clients only.", flag=logger.FLAG_ERROR)
+			return False
 		try:
-			result = self.server.receive_file()
-			logger.log(f"Received file:  {result[0]} ({result[1]} bytes)")
+			result = sender.receive_file()
+			logger.log(f"Received file:  {result[0]} ({result[2]})")
 		except Exception as e:
 			logger.log_exception(e, before=[], after=[])
 			return False
@@ -172,8 +580,7 @@ class VideoCropCommand(ServerCommand):
 		for i in range(len(args) - 1):
 			if args[i].lower() == "-c":
 				codec = args[i + 1]
-				args.pop(i)
-				args.pop(i + 1)
+				del args[i:i + 2]
 				break
 		if codec == "-mp4":
 			codec = FOURCC_MP4
@@ -181,6 +588,19 @@ class VideoCropCommand(ServerCommand):
 			codec = FOURCC_MOV
 		elif codec == "-xvid":
 			codec = FOURCC_XVID
+		workers = None
+		for i in range(len(args) - 1):
+			if args[i].lower() == "-w":
+				try:
+					workers = max(int(args[i + 1]), 1)
+				except ValueError:
+					logger.log("Error: Parameter '<workers>' is incorrect.", flag=logger.FLAG_ERROR)
+					return False
+				del args[i:i + 2]
+				break
+		snap = "-k" in args
+		if snap:
+			args.remove("-k")
 		if len(args) == 0:
 			logger.log("Error: Parameter '<src_path>' is missing.", flag=logger.FLAG_ERROR)
 			return False
@@ -211,11 +631,8 @@ class VideoCropCommand(ServerCommand):
 			 f"  from path:  {src_path}",
 			 f"  to path:  {dst_path}",
 			 f"  frames: {from_frame} to {to_frame}")
-		try:
-			crop_video(src_path, dst_path, codec, from_frame, to_frame)
-		except Exception as e:
-			logger.log_exception(e, before=[], after=[])
-			return False
+		job = jobs.submit(f"videocrop {dst_path}", crop_video, src_path, dst_path, codec, from_frame, to_frame, snap, workers, on_done=log_job)
+		logger.log(f"Job #{job.id} queued, see 'job status {job.id}'.")
 		return True
 
 
@@ -228,8 +645,7 @@ class VideoJoinCommand(ServerCommand):
 		for i in range(len(args) - 1):
 			if args[i].lower() == "-c":
 				codec = args[i + 1]
-				args.pop(i)
-				args.pop(i + 1)
+				del args[i:i + 2]
 				break
 		if codec == "-mp4":
 			codec = FOURCC_MP4
@@ -237,6 +653,19 @@ class VideoJoinCommand(ServerCommand):
 			codec = FOURCC_MOV
 		elif codec == "-xvid":
 			codec = FOURCC_XVID
+		workers = None
+		for i in range(len(args) - 1):
+			if args[i].lower() == "-w":
+				try:
+					workers = max(int(args[i + 1]), 1)
+				except ValueError:
+					logger.log("Error: Parameter '<workers>' is incorrect.", flag=logger.FLAG_ERROR)
+					return False
+				del args[i:i + 2]
+				break
+		letterbox = "-s" not in args
+		if not letterbox:
+			args.remove("-s")
 		if len(args) == 0:
 			logger.log("Error: Parameter '<srcs_path>' is missing.", flag=logger.FLAG_ERROR)
 			return False
@@ -248,103 +677,261 @@ class VideoJoinCommand(ServerCommand):
 		logger.log(f"Joining video",
 			 f"  from path:  {srcs_path}",
 			 f"  to path:  {dst_path}")
+		job = jobs.submit(f"videojoin {dst_path}", join_video, srcs_path, dst_path, codec, workers, letterbox, on_done=log_job)
+		logger.log(f"Job #{job.id} queued, see 'job status {job.id}'.")
+		return True
+
+
+class JobCommand(ServerCommand):
+	def execute(self, sender: Socket | None, label: str, args: list[str]) -> bool:
+		if len(args) > 0 and (args[0] == "?" or args[0].lower() == "help"):
+			self.log_usage()
+			return True
+		if len(args) == 0:
+			running, queued = jobs.counts()
+			logger.log(f"Jobs ({running} running, {queued} queued, {jobs.workers} at a time):")
+			for job in jobs.jobs():
+				logger.log(f"  > {job}")
+			return True
+		action = args[0].lower()
+		if action not in ("status", "cancel"):
+			logger.log(f"Error: Unknown action '{args[0]}'.", flag=logger.FLAG_ERROR)
+			return False
+		if len(args) == 1:
+			logger.log("Error: Parameter '<id>' is missing.", flag=logger.FLAG_ERROR)
+			return False
 		try:
-			join_video(srcs_path, dst_path, codec)
-		except Exception as e:
-			logger.log_exception(e, before=[], after=[])
+			job_id = int(args[1].removeprefix("#"))
+		except ValueError:
+			logger.log("Error: Parameter '<id>' is incorrect.", flag=logger.FLAG_ERROR)
 			return False
+		job = jobs.get(job_id)
+		if job is None:
+			logger.log(f"Error: No job #{job_id}.", flag=logger.FLAG_ERROR)
+			return False
+		if action == "status":
+			logger.log(f"Job {job}")
+			return True
+		if not jobs.cancel(job_id):
+			logger.log(f"Error: Job #{job_id} cannot be cancelled ({job.state}).", flag=logger.FLAG_ERROR)
+			return False
+		logger.log(f"Job #{job_id} cancelled.")
 		return True
 
 
-commands: list[Command] = [
+commands = CommandRegistry([
 	HelpCommand(server, "help", "?",
 		description="Display all available commands", syntax="help"),
 	BroadcastCommand(server, "broadcast", "bc",
 		description="Send command to all clients",
-		syntax="broadcast <command...>"),
+		syntax=[
+			"broadcast [-g <selector>] <command...>",
+			"Selector: '*', '@<tag>', '#<id>', '<host>[:<port>]', comma separated"
+		]),
+	OutboundCommand(server, "outbound", "ob",
+		description="Show outbound queues or set the slow client policy",
+		syntax=[
+			"outbound",
+			f"outbound policy <{SLOW_DROP} | {SLOW_EVICT}> [<selector>]",
+			"outbound timeout <seconds> [<selector>]",
+			f"Default: policy '{SLOW_DROP}', timeout {OUTBOUND_TIMEOUT:.0f} s"
+		]),
+	TransfersCommand(server, "transfers", "tf",
+		description="Show running file transfers or limit their bandwidth",
+		syntax=[
+			"transfers",
+			"transfers limit <rate> [<selector>]",
+			"Rate in bytes/s with an optional K, M or G suffix, 0 for unlimited",
+			"Without selector the limit is shared by all clients; '*' also applies to new clients"
+		]),
 	InfoCommand(server, "info", "infos",
 		description="Display information about the server",
 		syntax="info"),
+	HeartbeatCommand(server, "heartbeat", "hb",
+		description="Show or set the heartbeat used to detect dead clients",
+		syntax=[
+			"heartbeat",
+			"heartbeat interval <seconds>",
+			"heartbeat misses <count>",
+			f"Default: every {HEARTBEAT_INTERVAL:g} s, evict after {HEARTBEAT_MISSES} missed (interval 0 disables)"
+		]),
 	ListCommand(server, "list", "clients",
 		description="Display the client list",
-		syntax="info"),
+		syntax="list [<selector>]"),
+	TagCommand(server, "tag", "untag",
+		description="Add clients to groups, or remove them",
+		syntax=["tag <selector> <tag...>", "untag <selector> <tag...>"]),
 	SendCommand(server, "send",
-		description="Send command to client",
-		syntax="send <address> <command...>"),
+		description="Send command to clients",
+		syntax="send <selector> <command...>"),
+	CallCommand(server, "call",
+		description="Run a command on clients and wait for their results",
+		syntax=[
+			"call [-t <timeout>] [-n <count>] <selector> <command...>",
+			"-n: send the command <count> times without waiting, to measure latency",
+			f"Default timeout: {CALL_TIMEOUT:g} s"
+		]),
 	FileTransferCommand(server, "filesend", "fs",
 		description="Transfer file to client",
-		syntax="filesend <address> <src_path> <dst_path>"),
+		syntax=[
+			"filesend <selector> <src_path> <dst_path> [-z <compression>] [-r | -d] [-p <streams>]",
+			"-r: resume a broken transfer, -d: only send blocks that changed",
+			f"-p: number of parallel data connections (default: 1, max {STREAMS_MAX})",
+			f"Compression can be: {COMPRESSION_NONE}, {COMPRESSION_AUTO}, {', '.join(available_codecs())}",
+			f"Default compression: '{COMPRESSION_NONE}'"
+		]),
+	FileBroadcastCommand(server, "filebroadcast", "fb",
+		description="Distribute a file to all clients through a relay tree",
+		syntax=[
+			"filebroadcast <src_path> <dst_path> [-f <fanout>] [-g <selector>]",
+			"filebroadcast status",
+			f"Default fanout: {RELAY_FANOUT}"
+		]),
+	RelayProgressCommand(server, "relayprogress",
+		description="Report relay progress (sent by clients)",
+		syntax="relayprogress <token> <received> <state>"),
+	CacheStatsCommand(server, "cachestats", "cs",
+		description="Show the file cache statistics of clients",
+		syntax="cachestats [<selector>]"),
 	FileReceiveCommand(server, "filereceive", "fr",
 		description="Waiting for file from clients",
 		syntax="filereceive"),
 	VideoCropCommand(server, "videocrop", "vc",
 		description="Crop video by frame",
 		syntax=[
-			"videocrop <src_path> <dst_path> <from_frame> <to_frame> [-c <codec>]",
+			"videocrop <src_path> <dst_path> <from_frame> <to_frame> [-c <codec>] [-k] [-w <workers>]",
 			"Codec can be: -mp4, -mov, -xvid, or <custom_codec>",
+			"Streams are copied without re-encoding when ffmpeg is installed, the source has the codec",
+			"and <from_frame> is a keyframe; -k: start at the keyframe before <from_frame> to allow it",
+			f"-w: processes encoding segments of at least {SEGMENT_MIN} frames (default: the job's share of the cores, needs ffmpeg)",
 			f"Default codec: '{FOURCC_MP4}'"
 		]),
 	VideoJoinCommand(server, "videojoin", "vj",
 		description="Join videos",
 		syntax=[
-			"videojoin <srcs_path...> <dst_path> [-c <codec>]",
+			"videojoin <srcs_path...> <dst_path> [-c <codec>] [-w <workers>] [-s]",
 			"Codec can be: -mp4, -mov, -xvid, or <custom_codec>",
+			"Streams are copied without re-encoding when ffmpeg is installed and all sources share",
+			"the codec, size and frame rate",
+			"-w: processes encoding one source each (default: the job's share of the cores, needs ffmpeg)",
+			"Sources are fitted to the size and frame rate of the first one; -s: stretch instead of letterboxing",
 			f"Default codec: '{FOURCC_MP4}'"
 		]),
-]
+	JobCommand(server, "jobs", "job",
+		description="Show background jobs (video processing) or cancel one",
+		syntax=[
+			"jobs",
+			"job status <id>",
+			"job cancel <id>",
+			f"Up to {JOB_WORKERS} jobs run at a time, the others are queued"
+		]),
+])
 
 
-def incoming_thread_func():
-	while not server.is_closed():
-		try:
+def is_success(reply: dict) -> bool:
+	return reply["found"] and reply["error"] is None and reply["result"] is not False
 
-			client = server.accept(add_to_clients=False)
-			if server.is_closed():
-				continue
-			server.clients.append(client)
-			logger.log(f"Connection accepted from {client.address}.", flag=logger.FLAG_LINK)
-			client.send_msg(">>> Welcome to the server! <<<")
-			threading.Thread(target=client_thread_func, args=(client,)).start()
 
-		except ConnectionResetError as e:
-			logger.log_exception(e)
-		except BrokenPipeError as e:
-			logger.log_exception(e)
-		except Exception as e:
-			logger.log_exception(e)
+def format_reply(reply: dict) -> str:
+	if not reply["found"]:
+		return f"command not found ({reply['latency'] * 1000:.2f} ms)"
+	outcome = f"error {reply['error']}" if reply["error"] is not None else f"returned {reply['result']}"
+	return f"{outcome} ({reply['latency'] * 1000:.2f} ms round trip, {reply['elapsed'] * 1000:.2f} ms running)"
 
 
-def client_thread_func(client: ClientSocket):
-	try:
+def log_job(job: Job):
+	if job.state == JOB_FAILED:
+		logger.log(f"Job {job}", flag=logger.FLAG_ERROR)
+		return
+	logger.log(f"Job {job}")
+	if job.state == JOB_DONE and job.result:
+		for report in job.result:
+			leaks = f", {len(report['leaks'])} could not be read" if report["leaks"] else ""
+			logger.log(f"  > {report['path']}: {report['written']} frames written from {report['read']} read, "
+				f"{report['dropped']} dropped{leaks}")
 
-		while not server.is_closed():
-			cmd = client.receive_cmd()
-			if not server.is_closed():
-				logger.log(f"Received from {client.address}:  {cmd}", flag=logger.FLAG_COMMAND)
-			if cmd == "quit":
-				server.clients.remove(client)
-				if not server.is_closed():
-					logger.log(f"Connection closed from {client.address}.", flag=logger.FLAG_LINK)
-				try:
-					client.send_cmd("end")
-				except Exception:
-					pass
-				break
-			else:
-				command_found = False
-				for command in commands:
-					result = command.handle(client, cmd)
-					if result is not None:
-						command_found = True
-						break
-				if not command_found:
-					logger.log(f"Command not found:  {cmd}", flag=logger.FLAG_ERROR)
 
+def send_tracked(client: ClientSocket, src_path: str, dst_path: str, compression: str, mode: str,
+				 streams: int = 1, attempts: int = 1):
+	sessions.track(client, {"src_path": src_path, "dest_path": dst_path, "compression": compression,
+		"mode": TRANSFER_RESUME if mode == TRANSFER_RESUME else TRANSFER_CONTINUE, "attempts": attempts})
+	stats = client.send_file(src_path, dst_path, compression=compression, mode=mode, streams=streams, announce="filereceive")
+	sessions.untrack(client, dst_path)
+	return stats
+
+
+def send_logged(client: ClientSocket, src_path: str, dst_path: str, compression: str, mode: str, streams: int):
+	try:
+		stats = send_tracked(client, src_path, dst_path, compression, mode, streams)
+		logger.log(f"Sent file to #{client.id}:  {dst_path} ({stats})")
 	except Exception as e:
-		logger.log_exception(e)
+		if not server.is_closed():
+			logger.log_exception(e, before=[], after=[])
+
+
+def log_received(client: ClientSocket, dest_path: str, stats: TransferStats):
+	logger.log(f"Received file from #{client.id}:  {dest_path} ({stats})")
+
+
+def replay_transfers(client: ClientSocket):
+	for transfer in sessions.transfers(client):
+		if transfer["attempts"] >= SESSION_RETRIES:
+			sessions.untrack(client, transfer["dest_path"])
+			logger.log(f"Giving up on {transfer['dest_path']} for #{client.id} after {transfer['attempts']} attempts.", flag=logger.FLAG_ERROR)
+			continue
+		logger.log(f"Resuming transfer to #{client.id}:  {transfer['dest_path']}", flag=logger.FLAG_COMMAND)
+		try:
+			stats = send_tracked(client, transfer["src_path"], transfer["dest_path"], transfer["compression"],
+				transfer["mode"], attempts=transfer["attempts"] + 1)
+			logger.log(f"Sent file:  {transfer['dest_path']} ({stats})")
+		except Exception as e:
+			logger.log_exception(e, before=[], after=[])
+			return
+
+
+def accept_client(client: ClientSocket):
+	client.slow_policy = outbound_defaults["policy"]
+	client.send_timeout = outbound_defaults["timeout"]
+	client.on_received = log_received
+	client.on_call = commands.answer
+	server.clients.append(client)
+	logger.log(f"Connection accepted from {client.address}.", flag=logger.FLAG_LINK)
+	client.send_msg(">>> Welcome to the server! <<<")
+
+
+def serve_client(client: ClientSocket) -> bool:
+	cmd = client.poll_cmd()
+	if cmd is None or server.is_closed():
+		return not server.is_closed()
+	if client.handle_negotiation(cmd):
+		logger.log(f"Protocol {client.protocol} negotiated with {client.address}.", flag=logger.FLAG_LINK)
+		return True
+	if server.handle_attach(client, cmd):
+		logger.log(f"Data stream attached from {client.address}.", flag=logger.FLAG_LINK)
+		return False
+	state = sessions.handle(client, cmd)
+	if state is not None:
+		logger.log(f"Session of #{client.id} {state} from {client.address}.", flag=logger.FLAG_LINK)
+		if sessions.transfers(client):
+			loop.submit(replay_transfers, client)
+		return True
+	logger.log(f"Received from {client.address}:  {cmd}", flag=logger.FLAG_COMMAND)
+	if cmd == "quit":
+		server.clients.discard(client)
+		sessions.close(client)
+		logger.log(f"Connection closed from {client.address}.", flag=logger.FLAG_LINK)
+		try:
+			client.send_cmd("end")
+		except Exception:
+			pass
+		return False
+	if commands.dispatch(client, cmd) is None:
+		logger.log(f"Command not found:  {cmd}", flag=logger.FLAG_ERROR)
+	return True
 
 
 def input_thread_func():
+	global close_order
 	try:
 
 		while not server.is_closed():
@@ -354,42 +941,52 @@ def input_thread_func():
 			if not cmd:
 				continue
 
-			if cmd == "quit":
-				host, port = server.sock.getsockname()
-				server.close()
-				closing_client = ClientSocket()
-				closing_client.connect(host, port)
+			if cmd in ("quit", "quit -a"):
+				close_order = "quit" if cmd == "quit -a" else "reconnect"
+				loop.stop()
 				break
 			else:
-				command_found = False
-				for command in commands:
-					result = command.handle(None, cmd)
-					if result is not None:
-						command_found = True
-						break
-				if not command_found:
+				if commands.dispatch(None, cmd) is None:
 					logger.log(f"Command not found:  {cmd}", flag=logger.FLAG_ERROR)
 
 	except Exception as e:
 		logger.log_exception(e)
 
 
-incoming_thread = threading.Thread(target=incoming_thread_func)
-input_thread = threading.Thread(target=input_thread_func)
+if __name__ == "__main__":
+	server.bind("", 1234)
+	server.listen(5)
 
-try:
+	logger.log_embed("Server is running...",
+		f"  > Host: {server.sock.getsockname()[0]}",
+		f"  > Port: {server.sock.getsockname()[1]}",
+		f"  > Link: http://{server.get_llink()}/",
+		f"  > Backlog: {server._backlog}",
+		f"  > Clients: {len(server.clients)}",
+		before=[], after=["", ""])
+
+	close_order = "reconnect"
+	loop = EventLoop(server, accept_client, serve_client, sessions.lost)
+	sessions.on_replaced = lambda client: loop.evict(client, "session resumed elsewhere")
+	loop_thread = threading.Thread(target=loop.run)
+	input_thread = threading.Thread(target=input_thread_func)
+
+	try:
 
-	incoming_thread.start()
-	input_thread.start()
+		loop_thread.start()
+		input_thread.start()
 
-	incoming_thread.join()
-	input_thread.join()
+		loop_thread.join()
+		input_thread.join()
 
-except KeyboardInterrupt:
-	logger.log_embed("Keyboard interrupt. Closing client...",
-		"Press enter to close...", flag=logger.FLAG_ERROR)
+	except KeyboardInterrupt:
+		logger.log_embed("Keyboard interrupt. Closing client...",
+			"Press enter to close...", flag=logger.FLAG_ERROR)
+		loop.stop()
 
-else:
-	logger.log_embed("Closing server...", flag=logger.FLAG_ERROR)
+	else:
+		logger.log_embed("Closing server...", flag=logger.FLAG_ERROR)
 
-server.close()
+	jobs.shutdown()
+	server.close(close_order)
+	sessions.save()
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+from modules.cache_utils import ContentCache
+from modules.delta_utils import file_digest
+
+
+class ContentCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.root = os.path.join(self.tmp, "objects")
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp, ignore_errors=True)
+
+	def write(self, path: str, data: bytes = b"data") -> str:
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "wb") as file:
+			file.write(data)
+		return path
+
+	def test_reopen_indexes_only_entries(self):
+		src = self.write(os.path.join(self.tmp, "src.bin"))
+		digest = file_digest(src)
+		ContentCache(self.root).store(src, digest)
+		prefix = os.path.join(self.root, digest[:2])
+		placing = self.write(os.path.join(prefix, f"{digest}.12.34.tmp"))
+		foreign = [
+			self.write(os.path.join(self.root, "sessions.json")),
+			self.write(os.path.join(self.root, "sessions.json.12.tmp")),
+			self.write(os.path.join(prefix, "notes.tmp")),
+			self.write(os.path.join(self.root, "zz", digest)),
+		]
+
+		cache = ContentCache(self.root)
+		self.assertEqual(cache.stats()["entries"], 1)
+		self.assertEqual(cache.stats()["size"], 4)
+		self.assertFalse(os.path.exists(placing))
+		for path in foreign:
+			self.assertTrue(os.path.exists(path), path)
+
+		cache.clear()
+		for path in foreign:
+			self.assertTrue(os.path.exists(path), path)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,108 @@
+import re
+import random
+import unittest
+from modules.command_utils import split_command, join_command
+
+
+ALPHABET = "ab '\"\\"
+
+# Inputs the reference parser got wrong (empty arguments from extra spaces,
+# a bare word after a closing quote, a leading or trailing backslash), and
+# backslash pairs before a quote, which only split_command unescapes.
+_REFERENCE_BUGS = re.compile(r"^ |  | $|\\$|['\"] |(^| |['\"])\\|\\\\['\"]")
+
+
+def reference_split(command: str) -> list[str] | None:
+	"""
+	The character-by-character parser split_command replaced, kept as is.
+	"""
+	length = len(command)
+	args = []
+	arg = None
+	separator = None
+	i = 0
+	while i < length:
+		if arg is None:
+			arg = ""
+			if command[i] in " '\"":
+				separator = command[i]
+			else:
+				arg += command[i]
+				separator = " "
+		else:
+			if command[i] == "\\" and len(command) >= i and command[i + 1] == separator:
+				arg += separator
+				i += 1
+			elif command[i] == separator:
+				if args != "" or separator != " ":
+					args.append(arg)
+				arg = None
+			else:
+				arg += command[i]
+		i += 1
+	if arg is None:
+		pass
+	elif separator == " ":
+		if args != "":
+			args.append(arg)
+	else:
+		return None
+	return args
+
+
+def random_string(rng: random.Random, size: int) -> str:
+	return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, size)))
+
+
+class SplitCommandTest(unittest.TestCase):
+	def test_matches_reference(self):
+		rng = random.Random(18)
+		compared = 0
+		for _ in range(50000):
+			command = random_string(rng, 12)
+			if _REFERENCE_BUGS.search(command):
+				continue
+			self.assertEqual(split_command(command), reference_split(command), command)
+			compared += 1
+		self.assertGreater(compared, 10000)
+
+	def test_reference_bugs(self):
+		self.assertEqual(split_command("  a  b "), ["a", "b"])
+		self.assertEqual(split_command("'a' 'b'"), ["a", "b"])
+		self.assertEqual(split_command("a\\"), ["a\\"])
+		self.assertEqual(split_command("\\ a"), [" a"])
+
+	def test_quoted_backslashes(self):
+		self.assertEqual(split_command("'it\\'s'"), ["it's"])
+		self.assertEqual(split_command("'C:\\data\\\\' x"), ["C:\\data\\", "x"])
+		self.assertEqual(split_command("\"\\\\server\\share\""), ["\\\\server\\share"])
+		self.assertEqual(split_command("'a\\\\\\'b'"), ["a\\'b"])
+		self.assertIsNone(split_command("'a\\'"))
+		self.assertIsNone(split_command("'unterminated"))
+
+	def test_never_raises(self):
+		rng = random.Random(19)
+		for _ in range(50000):
+			split_command(random_string(rng, 20))
+
+	def test_cached_results_are_copies(self):
+		args = split_command("x y")
+		args.append("z")
+		self.assertEqual(split_command("x y"), ["x", "y"])
+
+
+class JoinCommandTest(unittest.TestCase):
+	def test_round_trip(self):
+		rng = random.Random(17)
+		for _ in range(50000):
+			args = [random_string(rng, 6) for _ in range(rng.randint(0, 5))]
+			self.assertEqual(split_command(join_command(args)), args, args)
+
+	def test_windows_paths(self):
+		args = ["fs", "C:\\data\\", "D:\\My Videos\\", "\\\\server\\share"]
+		self.assertEqual(join_command(args), "fs 'C:\\data\\\\' 'D:\\My Videos\\\\' \\\\server\\share")
+		self.assertEqual(split_command(join_command(args)), args)
+
+
+if __name__ == "__main__":
+	unittest.main()
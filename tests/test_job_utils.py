@@ -0,0 +1,37 @@
+import os
+import time
+import unittest
+from unittest import mock
+from modules.job_utils import JobEngine, job_share, JOB_DONE
+
+
+def share_after(delay: float) -> int:
+	time.sleep(delay)
+	return job_share()
+
+
+class JobShareTest(unittest.TestCase):
+	def shares(self, processes: bool) -> list[int]:
+		with mock.patch("os.cpu_count", return_value=8):
+			engine = JobEngine(workers=3, processes=processes)
+			# The first job ends well before the others, so the fourth starts
+			# next to two running jobs.
+			jobs = [engine.submit(f"share{i}", share_after, delay) for i, delay in enumerate((0.5, 2.0, 2.0, 0.1))]
+			deadline = time.monotonic() + 30
+			while not all(job.is_finished() for job in jobs) and time.monotonic() < deadline:
+				time.sleep(0.05)
+		self.assertEqual([job.state for job in jobs], [JOB_DONE] * 4)
+		return [job.result for job in jobs]
+
+	def test_decreasing_allowance_on_threads(self):
+		self.assertEqual(self.shares(False), [8, 4, 2, 2])
+
+	def test_decreasing_allowance_in_processes(self):
+		self.assertEqual(self.shares(True), [8, 4, 2, 2])
+
+	def test_outside_jobs(self):
+		self.assertEqual(job_share(), os.cpu_count() or 1)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,108 @@
+import time
+import random
+import threading
+import unittest
+from modules.pipeline_utils import Pipeline, PIPELINE_DEPTH
+
+ITEMS = 500
+
+
+class Source:
+	"""
+	Reads `count` items into the buffers it is given back, allocating one
+	only when given None, and raises at item `fail_at` if set.
+	"""
+
+	def __init__(self, count: int = ITEMS, fail_at: int | None = None):
+		self.count = count
+		self.fail_at = fail_at
+		self.index = 0
+		self.allocated = 0
+
+	def __call__(self, buffer: list | None) -> list | None:
+		if self.index == self.fail_at:
+			raise ValueError("read failed")
+		if self.index >= self.count:
+			return None
+		if buffer is None:
+			buffer = [None]
+			self.allocated += 1
+		buffer[0] = self.index
+		self.index += 1
+		return buffer
+
+
+def jitter(item: list) -> list:
+	if random.random() < 0.05:
+		time.sleep(0.001)
+	return item
+
+
+def failing(at: int):
+	def fn(item: list) -> list:
+		if item[0] == at:
+			raise ValueError("stage failed")
+		return item
+	return fn
+
+
+class PipelineTest(unittest.TestCase):
+	def run_pipeline(self, pipeline: Pipeline) -> int:
+		# Bounds the run so that a deadlock fails instead of hanging.
+		result = {}
+
+		def target():
+			try:
+				result["count"] = pipeline.run()
+			except BaseException as e:
+				result["error"] = e
+
+		runner = threading.Thread(target=target, name="runner", daemon=True)
+		runner.start()
+		runner.join(10)
+		self.assertFalse(runner.is_alive(), "pipeline did not finish")
+		self.assertEqual([thread.name for thread in threading.enumerate() if thread.name.startswith("pipeline")], [])
+		if "error" in result:
+			raise result["error"]
+		return result["count"]
+
+	def test_order(self):
+		written = []
+		source = Source()
+		pipeline = Pipeline(source, lambda item: written.append(item[0]), jitter, jitter)
+		self.assertEqual(self.run_pipeline(pipeline), ITEMS)
+		self.assertEqual(written, list(range(ITEMS)))
+
+	def test_buffers_are_reused(self):
+		for depth in (1, 3, PIPELINE_DEPTH):
+			with self.subTest(depth=depth):
+				source = Source()
+				self.run_pipeline(Pipeline(source, jitter, jitter, depth=depth))
+				self.assertEqual(source.allocated, depth)
+
+	def test_errors_are_raised(self):
+		cases = {
+			"read": lambda: Pipeline(Source(fail_at=50), jitter, jitter),
+			"transform": lambda: Pipeline(Source(), jitter, jitter, failing(50), jitter),
+			"write": lambda: Pipeline(Source(), failing(50), jitter),
+			"first read": lambda: Pipeline(Source(fail_at=0), jitter),
+		}
+		for stage, pipeline in cases.items():
+			with self.subTest(stage=stage):
+				with self.assertRaises(ValueError):
+					self.run_pipeline(pipeline())
+
+	def test_stops_reading_after_an_error(self):
+		source = Source(count=10 ** 6)
+		with self.assertRaises(ValueError):
+			self.run_pipeline(Pipeline(source, failing(10), depth=4))
+		self.assertLess(source.index, 100)
+
+	def test_empty(self):
+		written = []
+		self.assertEqual(self.run_pipeline(Pipeline(Source(count=0), written.append, jitter)), 0)
+		self.assertEqual(written, [])
+
+
+if __name__ == "__main__":
+	unittest.main()
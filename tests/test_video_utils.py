@@ -0,0 +1,262 @@
+import os
+import math
+import shutil
+import tempfile
+import subprocess
+import unittest
+from unittest import mock
+from fractions import Fraction
+
+try:
+	import cv2
+	import numpy as np
+	from modules import video_utils
+except ImportError:
+	cv2 = None
+
+SIZE = (160, 120)
+FPS = 25.0
+FRAMES = 400
+BITS = 12
+
+# (start, end) pairs: before SEEK_MIN, on and between keyframes, and past the end.
+RANGES = [(0, 20), (31, 40), (100, 160), (213, 250), (377, 399), (390, 500)]
+
+
+def encode_indices(path: str, count: int, fourcc: str = "mp4v", size: tuple[int, int] = SIZE, fps: float = FPS):
+	"""
+	Writes `count` frames, each showing its own index as a grid of bright and
+	dark blocks over noise, so a decoded frame says where it came from.
+	"""
+	width, height = size
+	out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+	rng = np.random.default_rng(0)
+	for index in range(count):
+		frame = rng.integers(0, 60, (height, width, 3), dtype=np.uint8)
+		for bit in range(BITS):
+			if index >> bit & 1:
+				y, x = divmod(bit, 4)
+				frame[y * height // 3:(y + 1) * height // 3, x * width // 4:(x + 1) * width // 4] += 180
+		out.write(frame)
+	out.release()
+
+
+def decode_index(frame) -> int:
+	height, width = frame.shape[:2]
+	index = 0
+	for bit in range(BITS):
+		y, x = divmod(bit, 4)
+		block = frame[y * height // 3 + height // 12:(y + 1) * height // 3 - height // 12,
+			x * width // 4 + width // 16:(x + 1) * width // 4 - width // 16]
+		if block.mean() > 140:
+			index |= 1 << bit
+	return index
+
+
+def read_frames(path: str) -> list:
+	video = cv2.VideoCapture(path)
+	frames = []
+	while True:
+		ret, frame = video.read()
+		if not ret:
+			break
+		frames.append(frame)
+	video.release()
+	return frames
+
+
+def decode_indices(path: str) -> list[int]:
+	return [decode_index(frame) for frame in read_frames(path)]
+
+
+@unittest.skipUnless(cv2, "needs OpenCV and numpy")
+class CropVideoTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.src = os.path.join(self.tmp, "src.mp4")
+		encode_indices(self.src, FRAMES)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp, ignore_errors=True)
+
+	def crop(self, src: str, start: int, end: int, name: str) -> list[int]:
+		dst = os.path.join(self.tmp, name + ".avi")
+		# XVID differs from the source codec, so the cut is always re-encoded.
+		video_utils.crop_video(src, dst, video_utils.FOURCC_XVID, start, end, workers=1)
+		return decode_indices(dst)
+
+	def check_crops(self, src: str):
+		frames = decode_indices(src)
+		for start, end in RANGES:
+			with self.subTest(start=start, end=end):
+				seeked = self.crop(src, start, end, f"seek_{start}")
+				with mock.patch.object(video_utils, "SEEK_MIN", len(frames) + 1):
+					decoded = self.crop(src, start, end, f"decode_{start}")
+				self.assertEqual(seeked, decoded)
+				self.assertEqual(seeked, frames[start:end + 1])
+
+	def test_source_decodes(self):
+		self.assertEqual(decode_indices(self.src), list(range(FRAMES)))
+
+	def test_crop_matches_decoding_from_start(self):
+		self.check_crops(self.src)
+
+	def test_seek_frame(self):
+		times = [index / FPS for index in range(FRAMES)]
+		video = cv2.VideoCapture(self.src)
+		try:
+			for frame in (32, 47, 199, 300, 399):
+				for probed in (None, times):
+					self.assertTrue(video_utils.seek_frame(video, frame, probed))
+					self.assertEqual(decode_index(video.read()[1]), frame)
+			self.assertFalse(video_utils.seek_frame(video, FRAMES + 10, times))
+		finally:
+			video.release()
+
+	def test_seek_frame_unplaced(self):
+		# Timestamps that end before where it landed are not trusted: it
+		# decodes from 0.
+		# Wraps the capture rather than subclassing it: Python subclasses of
+		# cv2.VideoCapture crash the garbage collector.
+		class Capture:
+			def __init__(self, path: str):
+				self.video = cv2.VideoCapture(path)
+				self.grabs = 0
+
+			def __getattr__(self, name: str):
+				return getattr(self.video, name)
+
+			def grab(self) -> bool:
+				self.grabs += 1
+				return self.video.grab()
+
+		times = [index / 1000 for index in range(FRAMES)]
+		video = Capture(self.src)
+		try:
+			self.assertTrue(video_utils.seek_frame(video, 250, times))
+			self.assertEqual(video.grabs, 250)
+			self.assertEqual(decode_index(video.read()[1]), 250)
+		finally:
+			video.release()
+
+	@unittest.skipUnless(shutil.which("ffmpeg") and shutil.which("ffprobe"), "needs ffmpeg")
+	def test_crop_segments(self):
+		# Two workers encode two segments of at least SEGMENT_MIN frames each
+		# in parallel, and ffmpeg concatenates them.
+		src = os.path.join(self.tmp, "long.mp4")
+		encode_indices(src, 2 * video_utils.SEGMENT_MIN + 100)
+		dst = os.path.join(self.tmp, "segments.avi")
+		start, end = 50, 2 * video_utils.SEGMENT_MIN + 59
+		with mock.patch.object(video_utils, "_encode_segments", wraps=video_utils._encode_segments) as segments:
+			video_utils.crop_video(src, dst, video_utils.FOURCC_XVID, start, end, workers=2)
+		self.assertEqual(segments.call_count, 1)
+		self.assertEqual(len(segments.call_args.args[0]), 2)
+		self.assertEqual(decode_indices(dst), list(range(start, end + 1)))
+		self.assertFalse([name for name in os.listdir(self.tmp) if name.startswith(".segments-")])
+
+	@unittest.skipUnless(shutil.which("ffmpeg") and shutil.which("ffprobe"), "needs ffmpeg")
+	def test_crop_b_frames_and_variable_rate(self):
+		# Drops two of every three frames after the first 100 but keeps their
+		# timestamps, so the rate falls to a third, and encodes with B-frames.
+		src = os.path.join(self.tmp, "vfr.mp4")
+		args = ["ffmpeg", "-v", "error", "-y", "-i", self.src, "-vf", r"select='lt(n\,100)+not(mod(n\,3))'",
+			"-fps_mode", "vfr", "-c:v", "libx264", "-bf", "3", "-g", "48", "-qp", "0", src]
+		if subprocess.run(args, capture_output=True).returncode != 0:
+			self.skipTest("ffmpeg cannot encode H.264")
+		self.check_crops(src)
+
+
+@unittest.skipUnless(cv2, "needs OpenCV and numpy")
+class JoinVideoTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.intro = os.path.join(self.tmp, "intro.mp4")
+		encode_indices(self.intro, 40)
+		self.dst = os.path.join(self.tmp, "joined.avi")
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp, ignore_errors=True)
+
+	def join(self, srcs: list[str]) -> list[dict]:
+		return video_utils.join_video(srcs, self.dst, video_utils.FOURCC_XVID, workers=1)
+
+	def test_heterogeneous_sources(self):
+		# 16:9 at twice the rate is letterboxed to 160x90 and shows every
+		# other frame; a tall one at half the rate is pillarboxed to 80x120
+		# and shows every frame twice.
+		wide = os.path.join(self.tmp, "wide.mp4")
+		encode_indices(wide, 40, size=(320, 180), fps=FPS * 2)
+		tall = os.path.join(self.tmp, "tall.mp4")
+		encode_indices(tall, 20, size=(80, 120), fps=FPS / 2)
+
+		report = self.join([self.intro, wide, tall, self.intro])
+		frames = read_frames(self.dst)
+		self.assertEqual(len(frames), 140)
+		self.assertEqual(frames[0].shape, (120, 160, 3))
+
+		intro, wide_frames, tall_frames, outro = frames[:40], frames[40:60], frames[60:100], frames[100:]
+		self.assertEqual([decode_index(frame) for frame in intro], list(range(40)))
+		self.assertEqual([decode_index(frame[15:105]) for frame in wide_frames], list(range(0, 40, 2)))
+		self.assertEqual([decode_index(frame[:, 40:120]) for frame in tall_frames], [i // 2 for i in range(40)])
+		self.assertEqual([decode_index(frame) for frame in outro], list(range(40)))
+		# Bars, less the two pixels next to the picture the codec blurs.
+		for frame in wide_frames:
+			self.assertLess(max(frame[:13].mean(), frame[107:].mean()), 2)
+		for frame in tall_frames:
+			self.assertLess(max(frame[:, :38].mean(), frame[:, 122:].mean()), 2)
+
+		self.assertEqual(report, [
+			{"path": self.intro, "read": 40, "written": 40, "dropped": 0, "leaks": []},
+			{"path": wide, "read": 40, "written": 20, "dropped": 20, "leaks": []},
+			{"path": tall, "read": 20, "written": 40, "dropped": 0, "leaks": []},
+			{"path": self.intro, "read": 40, "written": 40, "dropped": 0, "leaks": []},
+		])
+
+	def test_unreadable_first_source(self):
+		missing = os.path.join(self.tmp, "missing.mp4")
+		with self.assertRaises(ValueError):
+			self.join([missing, self.intro])
+
+	def test_unreadable_later_source(self):
+		missing = os.path.join(self.tmp, "missing.mp4")
+		report = self.join([self.intro, missing, self.intro])
+		self.assertEqual(decode_indices(self.dst), list(range(40)) * 2)
+		self.assertEqual(report[1], {"path": missing, "read": 0, "written": 0, "dropped": 0, "leaks": []})
+		self.assertEqual([entry["written"] for entry in report], [40, 0, 40])
+
+	def test_normalize_pixel_formats(self):
+		normalizer = video_utils._JoinNormalizer(SIZE, FPS)
+		width, height = SIZE
+		for shape, dtype, value, expected in [
+			((height, width), np.uint8, 90, (90, 90, 90)),
+			((height, width, 3), np.uint16, 0xB4FF, (0xB4, 0xB4, 0xB4)),
+			((height, width, 4), np.uint8, (10, 20, 30, 255), (10, 20, 30)),
+		]:
+			with self.subTest(shape=shape, dtype=dtype):
+				block = video_utils._Block()
+				block.count = 2
+				block.fps = FPS
+				block.indices[:2] = (0, 1)
+				block.frames = np.empty((video_utils.JOIN_BLOCK,) + shape, dtype)
+				block.frames[...] = value
+				result = normalizer(block).result
+				self.assertEqual(result.shape, (2, height, width, 3))
+				self.assertEqual(result.dtype, np.uint8)
+				self.assertTrue((result == expected).all())
+
+	def test_frame_rate_mapping(self):
+		# Output frame k shows source frame floor(k * fps_in / fps_out).
+		normalizer = video_utils._JoinNormalizer(SIZE, FPS)
+		for fps in (30000 / 1001, 24.0, 50.0, 12.5, 60.0, FPS):
+			with self.subTest(fps=fps):
+				ratio = Fraction(fps).limit_denominator(1001) / Fraction(FPS)
+				shown = []
+				for start in range(0, 120, video_utils.JOIN_BLOCK):
+					indices = np.arange(start, start + video_utils.JOIN_BLOCK)
+					shown += np.repeat(indices, normalizer._repeats(indices, fps)).tolist()
+				self.assertEqual(shown, [math.floor(k * ratio) for k in range(len(shown))])
+				self.assertEqual(len(shown), math.ceil(120 / ratio))
+
+
+if __name__ == "__main__":
+	unittest.main()